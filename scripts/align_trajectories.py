@@ -8,6 +8,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import math
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from poses import load_pose_file
+from sync import sync_movement_speeds, fit_device_to_tracker
 
 
 class pose_data:
@@ -19,29 +24,18 @@ class pose_data:
         self.frame_zs = np.array(None)
 
 
-def load_data(lines):
-    lines = list(lines)
-    n = len(lines)
+def load_data(path, stride=1):
+    # Uses the binary pose store instead of parsing the JSONL, if one has been
+    # converted with src/convert_poses.py
+    # TODO: probably tracker data should come out as quaternions, and
+    # device data should be quaternion like before (although transformed into camera matrix still)
+    poses = load_pose_file(path, stride=stride)
     data = pose_data()
-    data.ts = np.zeros(n)
-    data.ps = np.zeros((3, n))
-    data.frame_xs = np.zeros((3, n))
-    data.frame_ys = np.zeros((3, n))
-    data.frame_zs = np.zeros((3, n))
-    for i, line in enumerate(lines):
-        j = json.loads(line)
-        data.ts[i] = j["time"]
-        data.ps[:, i] = [
-            j["position"]["x"],
-            j["position"]["y"],
-            j["position"]["z"],
-        ]
-        # TODO: probably tracker data should come out as quaternions, and
-        # device data should be quaternion like before (although transformed into camera matrix still)
-        if "rotation" in j:
-            data.frame_xs[:, i] = j["rotation"]["col0"]
-            data.frame_ys[:, i] = j["rotation"]["col1"]
-            data.frame_zs[:, i] = j["rotation"]["col2"]
+    data.ts = poses.t
+    data.ps = poses.p
+    data.frame_xs = poses.r[:, 0, :]
+    data.frame_ys = poses.r[:, 1, :]
+    data.frame_zs = poses.r[:, 2, :]
     return data
 
 
@@ -67,11 +61,35 @@ if __name__ == "__main__":
         dest="output_file",
         help="Device data transformed into tracking space",
     )
+    parser.add_argument(
+        "--tracker_stride",
+        dest="tracker_stride",
+        help="Only use every Nth line of the tracker data (downsampling while loading, instead of downsample.sh)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--sync_precision_ms",
+        dest="sync_precision_ms",
+        help="Search sync coarse-to-fine down to this precision (milliseconds), instead of a fixed grid of sync candidates",
+        type=float,
+    )
+    parser.add_argument(
+        "--with_scale",
+        dest="with_scale",
+        help="Also fit scale between device and tracking space (similarity instead of rigid transform)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of worker processes for evaluating sync candidates",
+        type=int,
+        default=1,
+    )
     args = parser.parse_args()
-    with open(args.tracker_input, "r") as f:
-        tracker = load_data(f)
-    with open(args.device_input, "r") as f:
-        device = load_data(f)
+    tracker = load_data(args.tracker_input, args.tracker_stride)
+    device = load_data(args.device_input)
 
     # For now, we first align device data to start at 0, since tracker data does.
     # However, tracker data will have real timestamps later, that should be similar to device timestamps,
@@ -91,77 +109,30 @@ if __name__ == "__main__":
         device.ps[:, 1:-1] - device.ps[:, 0:-2], axis=0, keepdims=True
     )
 
-    def tracker_idx_to_device_idx(n, sync_device_to_tracker):
-        t = tracker.ts[n]
-        return np.argmin( (device.ts + sync_device_to_tracker) < t )
-
-    def sync_errors(sync: float, N: int):
-        # Find M from Nth tracker frame
-        M_tracker = np.identity(4)
-        M_tracker[0:3, 3] = tracker.ps[0:3, N]
-        M_tracker[:3, 0] = tracker.frame_xs[:3, N]
-        M_tracker[:3, 1] = tracker.frame_ys[:3, N]
-        M_tracker[:3, 2] = tracker.frame_zs[:3, N]
-        # print(M_tracker)
-
-        corresponding_device_N = tracker_idx_to_device_idx(N, sync)
-        # print('corresponding_device_N', corresponding_device_N)
-        M_device = np.identity(4)
-        M_device[0:3, 3] = device.ps[0:3, corresponding_device_N]
-        M_device[:3, 0] = device.frame_xs[:3, corresponding_device_N]
-        M_device[:3, 1] = device.frame_ys[:3, corresponding_device_N]
-        M_device[:3, 2] = device.frame_zs[:3, corresponding_device_N]
-        # print(M_device)
-        # NOTE ds should be scaled by (ts[n] - ts[n-1]), since sampling freq is different
-
-        M_device_to_tracker = M_tracker @ np.linalg.inv(M_device)
-        errors = []
-        n_tracker = len(tracker.ts)
-        transform_test_indices = range(0, n_tracker, 30)
-        for tracker_idx in transform_test_indices:
-            device_idx = tracker_idx_to_device_idx(tracker_idx, sync)
-            tracker_point = tracker.ps[0:3, tracker_idx]
-            device_test_point = device.ps[0:3, device_idx]
-            test_point_in_tracker_space = M_device_to_tracker[:3, :3] @ device_test_point + M_device_to_tracker[0:3, 3]
-            dp = test_point_in_tracker_space - tracker_point
-            # TODO: error is not really fully error, there is supposed to be a constant distance
-            # between tracker and device pose in real-world coords.
-            # Perhaps we should be comparing to the mean? (variance)
-            # However, seems useful to minimize.
-            error = np.linalg.norm(dp)
-            errors.append(error)
-        return np.mean(errors), M_device_to_tracker
-
-    # Try different sync candidates, pick one that minimizes average distance from
-    # transformed device position to the tracker position.
-    # Currently for the transform we just try some pairs of tracker and device poses,
-    # and calculate M directly from that (instead of some global optimization that would
-    # minimize total error when considering the whole trajectories).
-    errors_per_sync = []
-    M_per_sync = []
-
+    # Try different sync candidates, pick one that minimizes the RMS distance from
+    # transformed device positions to the corresponding tracker positions.
+    # For each sync, the transform is the least-squares rigid (or similarity, with --with_scale)
+    # transform over all matched positions of the whole trajectories.
+    # TODO: error is not really fully error, there is supposed to be a constant distance
+    # between tracker and device pose in real-world coords.
     # Note: tracker recording must start before and end after VIO recording
-    device_length = device.ts[-1] - device.ts[0]
-    tracker_length = tracker.ts[-1] - tracker.ts[0]
-    max_sync = tracker_length - device_length
-
-    sync_candidates = np.linspace(0.0, max_sync, 1001)
-    # TODO more intelligent picking for candidates
-    N_candidates = [math.floor(i * 0.2 * tracker.ts.shape[0]) for i in range(1, 5) ]
-    print('N_candidates:', N_candidates)
-    for sync in sync_candidates:
-        sync_errors_for_N = []
-        Ms_for_N = []
-        for N in N_candidates:
-            mean_error, M = sync_errors(sync, N)
-            sync_errors_for_N.append(mean_error)
-            Ms_for_N.append(M)
-        best_N_index = np.argmin(sync_errors_for_N)
-        errors_per_sync.append(sync_errors_for_N[best_N_index])
-        M_per_sync.append(Ms_for_N[best_N_index])
-    best_sync = sync_candidates[np.argmin(errors_per_sync)]
-    best_M = M_per_sync[np.argmin(errors_per_sync)]
-    print('Optimal sync error:', min(errors_per_sync))
+    best_sync, sync_candidates, scores = sync_movement_speeds(
+        device.ts,
+        device.ps,
+        tracker.ts,
+        tracker.ps,
+        with_scale=args.with_scale,
+        precision_ms=args.sync_precision_ms,
+        workers=args.workers,
+        return_scores=True,
+    )
+    errors_per_sync = -scores
+    best_M, best_scale, best_error = fit_device_to_tracker(
+        device.ts, device.ps, tracker.ts, tracker.ps, best_sync, args.with_scale
+    )
+    best_R = best_M[:3, :3] / best_scale
+    print('Optimal sync:', best_sync)
+    print('Optimal sync error:', best_error)
 
     # Plot
     fig, axs = plt.subplots(3, 1, constrained_layout=True)
@@ -197,7 +168,7 @@ if __name__ == "__main__":
     axs[1].plot(sync_candidates, errors_per_sync)
     axs[1].set_title('Transform errors for syncs')
     axs[1].set_xlabel('tracker-device time offset (seconds)')
-    axs[1].set_ylabel('mean position error (meters)')
+    axs[1].set_ylabel('RMS position error (meters)')
 
     # Distances scaled by dt, time sync version
     synced_device_ts = device.ts + best_sync
@@ -245,9 +216,9 @@ if __name__ == "__main__":
                 j["position"]["y"] = transformed_p[1]
                 j["position"]["z"] = transformed_p[2]
                 if "rotation" in j:
-                    c0 = best_M[:3, :3] @ np.array(j["rotation"]["col0"])
-                    c1 = best_M[:3, :3] @ np.array(j["rotation"]["col1"])
-                    c2 = best_M[:3, :3] @ np.array(j["rotation"]["col2"])
+                    c0 = best_R @ np.array(j["rotation"]["col0"])
+                    c1 = best_R @ np.array(j["rotation"]["col1"])
+                    c2 = best_R @ np.array(j["rotation"]["col2"])
                     j["rotation"] = {
                         "col0": list(c0),
                         "col1": list(c1),
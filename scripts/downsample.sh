@@ -1,2 +1,3 @@
 #!/bin/sh
+# Note: keeps every Nth line regardless of timestamps; src/resample.py resamples by time (interpolating) instead
 awk -v rate="$1" 'NR % rate == 0' "$2"
@@ -1,39 +1,239 @@
 import argparse
+import itertools
 import sys
 import json
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from poses import load_tracker_data
+
+# Find and clean up the problems of tracker recordings in one streaming pass, instead of printing the jumps and
+# deleting lines by hand (like for tracker-ds1000-nozero.jsonl):
+# - all-zero poses, which OpenVR reports when the tracker loses tracking, are dropped
+# - stalled duplicates (exactly the same pose as the previous one) are dropped, unless --keep_duplicates
+# - jumps (position changes of more than --jump_distance between kept samples) are reported
+# Kept lines are written as-is. The report splits the kept data into segments of continuous tracking,
+# broken by jumps, lost tracking and gaps longer than --max_gap.
+CHUNK_LINES = 8192
+
+KEPT = 0
+ZERO = 1
+DUPLICATE = 2
+
+
+def _runs(mask):
+    """(start, end) index arrays of the runs of True values in a boolean array"""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+class PoseCleaner:
+    """
+    Classifies tracker pose lines chunk by chunk (vectorized within chunks), and returns the lines to keep.
+    Only a timestamp, a kind and a jump flag per sample are kept for the report.
+    """
+
+    def __init__(self, jump_distance=0.2, max_gap=0.1, keep_duplicates=False):
+        self.jump_distance = jump_distance
+        self.max_gap = max_gap
+        self.keep_duplicates = keep_duplicates
+        self.previous_row = None  # Position and rotation of the previous non-zero sample
+        self.previous_kept_position = None
+        self.n = 0  # Number of processed samples
+        self.ts = []
+        self.kinds = []
+        self.jumps = []
+        self.jump_distances = []
+
+    def process(self, lines):
+        """Kept lines of a chunk of tracker data lines"""
+        poses = load_tracker_data(lines)
+        n = len(poses.t)
+        if n == 0:
+            return []
+        rows = np.concatenate([poses.p, poses.r.reshape(9, n)])
+        kinds = np.full(n, KEPT, dtype=np.int8)
+        zero = (poses.p == 0.0).all(axis=0)
+        kinds[zero] = ZERO
+
+        # Duplicates of the previous non-zero sample (which can be in the previous chunk)
+        nonzero = np.flatnonzero(~zero)
+        nonzero_rows = rows[:, nonzero]
+        if self.previous_row is not None:
+            nonzero_rows = np.concatenate([self.previous_row[:, np.newaxis], nonzero_rows], axis=1)
+        duplicate = (nonzero_rows[:, 1:] == nonzero_rows[:, :-1]).all(axis=0)
+        if self.previous_row is None:
+            duplicate = np.concatenate([[False], duplicate])
+        if len(nonzero) > 0:
+            self.previous_row = rows[:, nonzero[-1]]
+        if not self.keep_duplicates:
+            kinds[nonzero[duplicate]] = DUPLICATE
+
+        # Jumps between consecutive kept samples
+        kept = np.flatnonzero(kinds == KEPT)
+        kept_positions = poses.p[:, kept]
+        if self.previous_kept_position is not None:
+            kept_positions = np.concatenate([self.previous_kept_position[:, np.newaxis], kept_positions], axis=1)
+        distances = np.linalg.norm(np.diff(kept_positions, axis=1), axis=0)
+        if self.previous_kept_position is None:
+            distances = np.concatenate([[0.0], distances])
+        if len(kept) > 0:
+            self.previous_kept_position = poses.p[:, kept[-1]]
+        jumps = distances > self.jump_distance
+        self.jumps.append(self.n + kept[jumps])
+        self.jump_distances.append(distances[jumps])
+        self.n += n
+
+        self.ts.append(poses.t.copy())
+        self.kinds.append(kinds)
+        return [lines[i] for i in kept]
+
+    def report(self):
+        """Summary of the processed data: counts, jumps, lost tracking and stalls, and the continuous segments"""
+        ts = np.concatenate(self.ts) if self.ts else np.zeros(0)
+        kinds = np.concatenate(self.kinds) if self.kinds else np.zeros(0, dtype=np.int8)
+        jumps = np.concatenate(self.jumps).astype(int) if self.jumps else np.zeros(0, dtype=int)
+        jump_distances = np.concatenate(self.jump_distances) if self.jump_distances else np.zeros(0)
+
+        zero_starts, zero_ends = _runs(kinds == ZERO)
+        duplicate_starts, duplicate_ends = _runs(kinds == DUPLICATE)
+        # A stall lasts from the original sample (just before the duplicates) until the last duplicate
+        stall_durations = ts[duplicate_ends - 1] - ts[np.maximum(duplicate_starts - 1, 0)]
+        long_stalls = stall_durations > self.max_gap
+
+        # Segments break at jumps, lost tracking and long gaps (including long stalls) between kept samples
+        kept = np.flatnonzero(kinds == KEPT)
+        zeros_before = np.cumsum(kinds == ZERO)
+        is_jump = np.zeros(len(ts), dtype=bool)
+        is_jump[jumps] = True
+        breaks = np.flatnonzero(
+            is_jump[kept[1:]]
+            | (zeros_before[kept[1:]] != zeros_before[kept[:-1]])
+            | (np.diff(ts[kept]) > self.max_gap)
+        ) + 1
+        segment_starts = np.concatenate([[0], breaks]) if len(kept) > 0 else np.zeros(0, dtype=int)
+        segment_ends = np.concatenate([breaks, [len(kept)]]) if len(kept) > 0 else np.zeros(0, dtype=int)
+
+        return {
+            "samples": len(ts),
+            "kept": len(kept),
+            "zero": int((kinds == ZERO).sum()),
+            "duplicate": int((kinds == DUPLICATE).sum()),
+            "jumps": [{"time": float(ts[i]), "distance": float(d)} for i, d in zip(jumps, jump_distances)],
+            "lost_tracking": [
+                {"start_time": float(ts[a]), "end_time": float(ts[b - 1]), "samples": int(b - a)}
+                for a, b in zip(zero_starts, zero_ends)
+            ],
+            "stalls": [
+                {"start_time": float(ts[max(a - 1, 0)]), "end_time": float(ts[b - 1]), "samples": int(b - a)}
+                for a, b in zip(duplicate_starts[long_stalls], duplicate_ends[long_stalls])
+            ],
+            "segments": [
+                {"start_time": float(ts[kept[a]]), "end_time": float(ts[kept[b - 1]]), "samples": int(b - a)}
+                for a, b in zip(segment_starts, segment_ends)
+            ],
+        }
+
+
+def clean_tracker_data(input_file, output_file=None, **options):
+    """Write the kept lines of tracker data into output_file (if given), returns the report"""
+    cleaner = PoseCleaner(**options)
+    lines = iter(input_file)
+    while True:
+        chunk = list(itertools.islice(lines, CHUNK_LINES))
+        if not chunk:
+            break
+        kept = cleaner.process(chunk)
+        if output_file is not None:
+            output_file.writelines(kept)
+    return cleaner.report()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', dest='input', help='Input file with position data (stdin if not given)')
+    parser.add_argument('-o', '--output', dest='output', help='Output file for the cleaned data (not written if not given)')
+    parser.add_argument('--report', dest='report', help='Output file for the JSON report (printed if not given)')
+    parser.add_argument(
+        '--jump_distance',
+        dest='jump_distance',
+        help='Position change (m) between consecutive samples that counts as a jump',
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        '--max_gap',
+        dest='max_gap',
+        help='Longest time (s) between kept samples (or longest stall) within a segment',
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        '--keep_duplicates',
+        dest='keep_duplicates',
+        help='Keep samples with exactly the same pose as the previous sample',
+        action='store_true',
+    )
     args = parser.parse_args()
-    ts = []
-    xs = []
-    ys = []
-    zs = []
     f = sys.stdin if args.input is None else open(args.input, 'r')
-    for line in f:
-        j = json.loads(line)
-        ts.append(j["time"])
-        xs.append(j["position"]["x"])
-        ys.append(j["position"]["y"])
-        zs.append(j["position"]["z"])
+    output = open(args.output, 'w') if args.output is not None else None
+    report = clean_tracker_data(
+        f, output, jump_distance=args.jump_distance, max_gap=args.max_gap, keep_duplicates=args.keep_duplicates
+    )
     if f is not sys.stdin:
         f.close()
+    if output is not None:
+        output.close()
+
+    if args.report is not None:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        for jump in report["jumps"]:
+            print('At t={}, jump of {:.2f}m'.format(jump["time"], jump["distance"]))
+        for lost in report["lost_tracking"]:
+            print('From t={} to t={}, lost tracking ({} zero poses)'.format(lost["start_time"], lost["end_time"], lost["samples"]))
+        for stall in report["stalls"]:
+            print('From t={} to t={}, stalled ({} duplicates)'.format(stall["start_time"], stall["end_time"], stall["samples"]))
+        for segment in report["segments"]:
+            print('Segment t={}..{} ({} samples)'.format(segment["start_time"], segment["end_time"], segment["samples"]))
+    print('Kept {} of {} samples ({} zero, {} duplicates), {} segments'.format(
+        report["kept"], report["samples"], report["zero"], report["duplicate"], len(report["segments"])
+    ), file=sys.stderr)
+
+
+def test_clean_tracker_data():
+    import io
+
+    def line(t, p):
+        return json.dumps({"time": t, "position": dict(zip("xyz", p)),
+                           "rotation": {"col0": [1, 0, 0], "col1": [0, 1, 0], "col2": [0, 0, 1]}}) + "\n"
+
+    ts = np.arange(3000) / 1000.0
+    ps = np.stack([0.1 * ts, np.zeros(3000), np.ones(3000)], axis=1)
+    ps[1::2] = ps[0::2]  # every other sample repeats the previous pose
+    ps[1000:1050] = 0.0  # lost tracking
+    ps[2000:] += [1.0, 0.0, 0.0]  # jump
+    ps[2500:2700] = ps[2499]  # stall
+    lines = [line(t, p) for t, p in zip(ts, ps)]
+
+    for chunk_lines in [CHUNK_LINES, 7]:
+        output = io.StringIO()
+        cleaner = PoseCleaner()
+        for i in range(0, len(lines), chunk_lines):
+            output.writelines(cleaner.process(lines[i:i + chunk_lines]))
+        report = cleaner.report()
+        kept = [json.loads(l)["time"] for l in output.getvalue().splitlines()]
+        assert report["zero"] == 50 and report["kept"] == len(kept)
+        assert report["duplicate"] == 1575
+        assert kept[:3] == [0.0, 0.002, 0.004] and 1.02 not in kept
+        assert [j["time"] for j in report["jumps"]] == [2.0]
+        assert report["lost_tracking"] == [{"start_time": 1.0, "end_time": 1.049, "samples": 50}]
+        assert [(s["start_time"], s["end_time"]) for s in report["stalls"]] == [(2.498, 2.699)]
+        assert [(s["start_time"], s["end_time"]) for s in report["segments"]] == [
+            (0.0, 0.998), (1.05, 1.998), (2.0, 2.498), (2.7, 2.998)
+        ]
 
-    # plot distances between p(t) and p(t+1) for each frame
-    ps = [ np.array([x,y,z]) for (x,y,z) in zip(xs, ys, zs) ]
-    ds = [ np.linalg.norm(ps[i] - ps[i+1]) for i in range(len(xs)-1) ]
-
-    # print jumps
-    for i, t, d in zip(range(len(ts)), ts[:-1], ds):
-        if d > 0.2:
-            print('At t={}, jump of {:.2f}m'.format(t, d))
-            print('    ps[{}]: {}'.format(i, ps[i]))
-            print('    ps[{}]: {}'.format(i+1, ps[i+1]))
-            if (ps[i] == np.array([0.0, 0.0, 0.0])).all():
-                print('    delete until {0} (including {0})'.format(i))
-            if (ps[i+1] == np.array([0.0, 0.0, 0.0])).all():
-                print('    delete from', i+1)
+    report = clean_tracker_data(io.StringIO("".join(lines)), None, keep_duplicates=True)
+    assert report["kept"] == 2950 and report["stalls"] == []
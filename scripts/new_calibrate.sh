@@ -72,27 +72,10 @@ fi
 #         -o "$OUTPUT_DIR"/vio_camera_matrices_automatically_aligned.jsonl
 # fi
 
-build_config=Debug
-# build_config=RelWithDebInfo
-# build_config=Release
-if [ ! -d libs/find_tag_space_poses/build ]; then
-    echo "--- Generate find_tag_poses CMake build ---"
-    cmake -Hlibs/find_tag_space_poses -Blibs/find_tag_space_poses/build -DCMAKE_PREFIX_PATH=$OPENCV_BUILD_PATH
-    mkdir -p libs/find_tag_space_poses/build
-    mkdir -p libs/find_tag_space_poses/build/{Debug,RelWithDebInfo,Release}
-    cp $OPENCV_BUILD_PATH/x64/vc15/bin/opencv_world451d.dll libs/find_tag_space_poses/build/Debug/
-    cp $OPENCV_BUILD_PATH/x64/vc15/bin/opencv_world451.dll libs/find_tag_space_poses/build/RelWithDebInfo/
-    cp $OPENCV_BUILD_PATH/x64/vc15/bin/opencv_world451.dll libs/find_tag_space_poses/build/Release/
-fi
-
-echo "--- Build find_tag_poses ---"
-time cmake --build libs/find_tag_space_poses/build \
-    --config $build_config \
-    --target find_tag_space_poses
-
 if [ ! -f $OUTPUT_DIR/vio_with_tag_space_poses.jsonl ]; then
     echo "--- Find tag space poses ---"
-    time libs/find_tag_space_poses/build/$build_config/find_tag_space_poses.exe \
+    # Note: replaces libs/find_tag_space_poses (no build needed); also adds 'tag_reprojection_error' per frame
+    time python ./src/tag_pose.py \
         -i $OUTPUT_DIR/vio_camera_matrices.jsonl \
         -o $OUTPUT_DIR/vio_with_tag_space_poses.jsonl \
         -s $TAG_SIDE_LENGTH
@@ -103,9 +86,7 @@ python src/sync.py \
     -d $OUTPUT_DIR/vio_with_tag_space_poses.jsonl \
     -t $OUTPUT_DIR/ds"$TRACKER_DOWNSAMPLING"_tracker_minusfirst.jsonl \
     --pose_name tag_space_pose \
+    --calibrate \
     --plot
 
-# TODO: calibration; what is in calibrate.py didn't seem to work yet,
-# perhaps some problem with the math or data?
-
 echo "--- Done ---"
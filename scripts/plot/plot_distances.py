@@ -4,28 +4,20 @@ import json
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+from poses import load_pose_file, load_tracker_data
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', dest='input', help='Input file with position data (stdin if not given)')
     args = parser.parse_args()
-    ts = []
-    xs = []
-    ys = []
-    zs = []
-    f = sys.stdin if args.input is None else open(args.input, 'r')
-    for line in f:
-        j = json.loads(line)
-        ts.append(j["time"])
-        xs.append(j["position"]["x"])
-        ys.append(j["position"]["y"])
-        zs.append(j["position"]["z"])
-    if f is not sys.stdin:
-        f.close()
+    poses = load_tracker_data(sys.stdin) if args.input is None else load_pose_file(args.input)
+    ts = poses.t
 
     # plot distances between p(t) and p(t+1) for each frame
-    ps = [ np.array([x,y,z]) for (x,y,z) in zip(xs, ys, zs) ]
-    ds = [ np.linalg.norm(ps[i] - ps[i+1]) for i in range(len(xs)-1) ]
+    ds = np.linalg.norm(poses.p[:, 1:] - poses.p[:, :-1], axis=0)
     fig = plt.figure()
     ax = fig.add_subplot(111)
     # ax.plot(range(1, len(ps)), ds, '.')
@@ -4,6 +4,42 @@ import json
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from poses import load_pose_file, load_tracker_data
+
+
+def glyph_indices(ts, interval):
+    """Indices of the first samples at or after every `interval` seconds, so glyph density does not depend on the sample rate"""
+    glyph_times = ts[0] + np.arange(int(np.floor((ts[-1] - ts[0]) / interval)) + 1) * interval
+    return np.unique(np.minimum(np.searchsorted(ts, glyph_times), len(ts) - 1))
+
+
+class OrientationGlyphs:
+    """
+    Orientation axes (x red, y green, z blue) of poses every `interval` seconds, as one line collection per axis.
+    The collections are created once, and update() only changes which of the segments are shown.
+    """
+
+    def __init__(self, ax, poses, interval, length):
+        indices = glyph_indices(poses.t, interval)
+        self.ts = poses.t[indices]
+        p = poses.p[:, indices].T
+        # Segments (Kx2x3) from the position along each rotation matrix column
+        self.segments = [np.stack([p, p + length * poses.r[:, c, indices].T], axis=1) for c in range(3)]
+        self.collections = [Line3DCollection([], colors=color) for color in "rgb"]
+        for collection in self.collections:
+            ax.add_collection(collection)
+
+    def update(self, t_start, t_end):
+        """Show the glyphs from t_start to t_end"""
+        start, end = np.searchsorted(self.ts, [t_start, t_end], side="right")
+        for collection, segments in zip(self.collections, self.segments):
+            collection.set_segments(segments[start:end])
+        return self.collections
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -19,40 +55,33 @@ if __name__ == "__main__":
         dest="sample_rate",
         help="How many samples to skip between samples (since input can be very high-res)",
     )
+    parser.add_argument(
+        "--glyph_interval",
+        dest="glyph_interval",
+        help="Seconds between orientation glyphs",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "--glyph_window",
+        dest="glyph_window",
+        help="Only show orientation glyphs of this many last seconds (by default, all until the current time)",
+        type=float,
+    )
     args = parser.parse_args()
-    ts = []
-    xs = []
-    ys = []
-    zs = []
-    frame_xs = []
-    frame_ys = []
-    frame_zs = []
-    f = sys.stdin if args.input is None else open(args.input, "r")
-    for line in f:
-        j = json.loads(line)
-        ts.append(j["time"])
-        xs.append(j["position"]["x"])
-        ys.append(j["position"]["y"])
-        zs.append(j["position"]["z"])
-        if "rotation" in j:
-            frame_xs.append(np.array(j["rotation"]["col0"]))
-            frame_ys.append(np.array(j["rotation"]["col1"]))
-            frame_zs.append(np.array(j["rotation"]["col2"]))
-    if f is not sys.stdin:
-        f.close()
-
-    # downsample (note: much faster to use sample_rate=1 and downsample data beforehand)
+    # downsample while loading, so skipped lines are not even parsed
     sample_rate = int(args.sample_rate or "1")
-    ts = np.array(ts[::sample_rate])
-    xs = np.array(xs[::sample_rate])
-    ys = np.array(ys[::sample_rate])
-    zs = np.array(zs[::sample_rate])
-    frame_xs = np.array(frame_xs[::sample_rate])
-    frame_ys = np.array(frame_ys[::sample_rate])
-    frame_zs = np.array(frame_zs[::sample_rate])
+    if args.input is None:
+        poses = load_tracker_data(sys.stdin, stride=sample_rate)
+    else:
+        poses = load_pose_file(args.input, stride=sample_rate)
+    ts = poses.t
+    xs, ys, zs = poses.p
+    # No orientation glyphs if the data has no rotations
+    has_rotations = (poses.r != 0.0).any()
 
     fig = plt.figure()
-    ax = Axes3D(fig)
+    ax = fig.add_subplot(projection="3d")
 
     # TODO: center on the interesting part
     axis_min = min(min(xs), min(ys), min(zs))
@@ -65,6 +94,7 @@ if __name__ == "__main__":
 
     line = ax.plot(xs, ys, zs, linestyle="-", marker="")[0]
     title = ax.set_title("Tracker position at t=0")
+    glyphs = OrientationGlyphs(ax, poses, args.glyph_interval, (axis_max - axis_min) * 0.03) if has_rotations else None
     fps = 60.0
     framerate = 1.0 / fps
     frames = fps * ts[-1]
@@ -72,28 +102,16 @@ if __name__ == "__main__":
     def update_graph(frame):
         frame = frame % frames
         expected_t = frame * framerate
-        t = np.argmax(expected_t < ts)
+        # Samples until the current time (data is in time order)
+        t = min(np.searchsorted(ts, expected_t, side="right"), len(ts) - 1)
         line.set_data([xs[:t], ys[:t]])
         line.set_3d_properties(zs[:t])
 
-        def draw_quivers(vs, color, quiver_rate):
-            ax.quiver(
-                xs[::quiver_rate],
-                ys[::quiver_rate],
-                zs[::quiver_rate],
-                vs[:, 0][::quiver_rate],
-                vs[:, 1][::quiver_rate],
-                vs[:, 2][::quiver_rate],
-                color=color,
-                length=(axis_max - axis_min) * 0.03,
-            )
-
-        if len(frame_xs) > 0:
-            draw_quivers(frame_xs, 'r', 30)
-            draw_quivers(frame_ys, 'g', 30)
-            draw_quivers(frame_zs, 'b', 30)
         title.set_text("Tracker position at t={}".format(ts[t]))
-        return title, line
+        if glyphs is None:
+            return title, line
+        window_start = ts[t] - args.glyph_window if args.glyph_window is not None else -np.inf
+        return (title, line, *glyphs.update(window_start, ts[t]))
 
     from matplotlib.animation import FuncAnimation
 
@@ -101,3 +119,30 @@ if __name__ == "__main__":
     anim = FuncAnimation(fig, update_graph, len(xs), interval=framerate, blit=True)
 
     plt.show()
+
+
+def test_orientation_glyphs():
+    from poses import Poses
+
+    poses = Poses()
+    # 1000Hz with duplicated timestamps and a gap
+    poses.t = np.concatenate([np.arange(5000), np.arange(5000), np.arange(8000, 10000)]) / 1000.0
+    poses.t.sort()
+    poses.p = np.stack([poses.t, 0 * poses.t, 0 * poses.t])
+    poses.r = np.repeat(np.identity(3)[:, :, np.newaxis], len(poses.t), axis=2)
+
+    indices = glyph_indices(poses.t, 0.5)
+    assert poses.t[indices].tolist() == [0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 8.0, 8.5, 9.0, 9.5]
+
+    fig = plt.figure()
+    ax = fig.add_subplot(projection="3d")
+    glyphs = OrientationGlyphs(ax, poses, 0.5, 0.1)
+    n_collections = len(ax.collections)
+    for t_start, t_end, n in [(-np.inf, 1.2, 3), (-np.inf, 9.9, 14), (8.0, 9.0, 2)]:
+        collections = glyphs.update(t_start, t_end)
+        fig.canvas.draw()  # projects the 3D segments
+        assert len(ax.collections) == n_collections
+        assert [len(c.get_segments()) for c in collections] == [n, n, n]
+    # y axis glyphs point along y
+    assert np.allclose(glyphs.segments[1][0], [[0.0, 0.0, 0.0], [0.0, 0.1, 0.0]])
+    plt.close(fig)
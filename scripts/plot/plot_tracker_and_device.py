@@ -2,9 +2,20 @@ import argparse
 import sys
 import json
 import time
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from poses import load_pose_file
+
+# Each export worker holds its own figure and a copy of the plot data, so keep the default small
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
 
 
 class position_data:
@@ -16,79 +27,67 @@ class position_data:
         self.frame_zs = np.array(None)
 
 
-def load_data(lines):
-    lines = list(lines)
-    n = len(lines)
+def load_data(path, stride=1):
+    # Uses the binary pose store instead of parsing the JSONL, if one has been
+    # converted with src/convert_poses.py
+    poses = load_pose_file(path, stride=stride)
     data = position_data()
-    data.ts = np.zeros(n)
-    data.ps = np.zeros((3, n))
-    data.frame_xs = np.zeros((3, n))
-    data.frame_ys = np.zeros((3, n))
-    data.frame_zs = np.zeros((3, n))
-    for i, line in enumerate(lines):
-        j = json.loads(line)
-        data.ts[i] = j["time"]
-        data.ps[:, i] = [
-            j["position"]["x"],
-            j["position"]["y"],
-            j["position"]["z"],
-        ]
-        if "rotation" in j:
-            data.frame_xs[:, i] = j["rotation"]["col0"]
-            data.frame_ys[:, i] = j["rotation"]["col1"]
-            data.frame_zs[:, i] = j["rotation"]["col2"]
+    data.ts = poses.t
+    data.ps = poses.p
+    data.frame_xs = poses.r[:, 0, :]
+    data.frame_ys = poses.r[:, 1, :]
+    data.frame_zs = poses.r[:, 2, :]
     return data
 
 
+def level_of_detail_indices(ps, max_points):
+    """
+    Sorted indices of positions (3xN) to draw, at most about max_points of them: consecutive samples are
+    split into buckets, and of each bucket only the first and last samples and the minimum and maximum of
+    each coordinate are kept, so that spikes and turns stay visible (unlike keeping every Nth sample).
+    """
+    n = ps.shape[1]
+    # Up to 8 kept samples per bucket
+    bucket_size = int(np.ceil(8 * n / max_points)) if max_points > 0 else 1
+    if bucket_size <= 2:
+        return np.arange(n)
+    n_buckets = int(np.ceil(n / bucket_size))
+    starts = np.arange(n_buckets) * bucket_size
+    # Last bucket is padded with its last value, padding indices get clipped to it
+    buckets = np.pad(ps, ((0, 0), (0, n_buckets * bucket_size - n)), mode="edge").reshape(3, n_buckets, bucket_size)
+    indices = np.concatenate([
+        starts,
+        np.minimum(starts + bucket_size - 1, n - 1),
+        np.minimum((buckets.argmin(axis=2) + starts).ravel(), n - 1),
+        np.minimum((buckets.argmax(axis=2) + starts).ravel(), n - 1),
+    ])
+    return np.unique(indices)
+
+
+def positions_until(data, lod_indices, t):
+    """Positions to draw for samples at or before time t: decimated ones, then all samples after the last of those"""
+    n = np.searchsorted(data.ts, t, side="right")
+    j = np.searchsorted(lod_indices, n)
+    start = lod_indices[j - 1] + 1 if j > 0 else 0
+    return data.ps[:, np.concatenate([lod_indices[:j], np.arange(start, n)])]
+
+
+def load_plot_data(args):
+    tracker = load_data(args.tracker_input, args.tracker_stride)
+    devices = [load_data(device_file) for device_file in args.device_input]
+    return tracker, devices
+
+
 # TODO: might not need to treat tracker input as a separate thing from VIO inputs
 # (all are handled the same currently)
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-t",
-        "--tracker_input",
-        dest="tracker_input",
-        help="Input file with tracker position and rotation data",
-        required=True,
-    )
-    parser.add_argument(
-        "-d",
-        "--device_input",
-        dest="device_input",
-        action='append',
-        help="Input file with device position data",
-        required=True,
-    )
-    parser.add_argument(
-        "-a",
-        "--animate",
-        dest="animate",
-        help="Animate the plot by timestamps instead of showing whole data at once",
-        action='store_true'
-    )
-    parser.add_argument(
-        "--animation_speed",
-        dest="animation_speed",
-        help="Animation speed",
-        type=float,
-        default=1.0,
-    )
-    parser.add_argument(
-        "--loop",
-        dest="loop",
-        help="Loop animation",
-        action='store_true'
-    )
-    args = parser.parse_args()
-    with open(args.tracker_input, "r") as f:
-        tracker = load_data(f)
-    devices = []
-    for device_file in args.device_input:
-        with open(device_file, "r") as f:
-            devices.append(load_data(f))
+def create_plot(tracker, devices, tracker_label, device_labels, max_points):
+    """Figure of the trajectories, and a function drawing them until time t (returns the changed artists)"""
+    # Note: data is in time order, so samples until the current time are found with searchsorted on every frame
+    tracker_lod = level_of_detail_indices(tracker.ps, max_points)
+    device_lods = [level_of_detail_indices(device.ps, max_points) for device in devices]
 
     fig = plt.figure()
-    ax = Axes3D(fig)
+    ax = fig.add_subplot(projection="3d")
 
     axis_min = min(
         tracker.ps.min(),
@@ -108,7 +107,7 @@ if __name__ == "__main__":
         zs=[],
         linestyle="-",
         marker="",
-        label=args.tracker_input,
+        label=tracker_label,
     )
     device_plots = [ax.plot(
         xs=[],
@@ -116,8 +115,8 @@ if __name__ == "__main__":
         zs=[],
         linestyle="-",
         marker="",
-        label=filename,
-    ) for filename in args.device_input]
+        label=label,
+    ) for label in device_labels]
     ax.plot(
         xs=[0.0],
         ys=[0.0],
@@ -133,26 +132,8 @@ if __name__ == "__main__":
 
     title = ax.set_title("Positions at t=0.00s")
 
-    # Note: timestamps may be negative
-    first_data_timestamp = min(tracker.ts.min(), min([d.ts.min() for d in devices]))
-    last_data_timestamp = max(tracker.ts.max(), max([d.ts.max() for d in devices]))
-    total_animation_length = last_data_timestamp - first_data_timestamp
-
-    def update_graph(frame):
-        # Time in seconds since animation start
-        t = (time.time() - anim_start) * args.animation_speed
-
-        if args.loop:
-            while t > last_data_timestamp:
-                t -= total_animation_length
-        else:
-            # Stop time at end
-            t = min(t, last_data_timestamp, last_data_timestamp)
-
-        if not args.animate:
-            t = last_data_timestamp
-
-        tracker_positions_until_now = tracker.ps[:, np.where(tracker.ts <= t)[0]]
+    def draw_until(t):
+        tracker_positions_until_now = positions_until(tracker, tracker_lod, t)
         tracker_plot[0].set_data(
             tracker_positions_until_now[0, :],
             tracker_positions_until_now[1, :],
@@ -161,8 +142,8 @@ if __name__ == "__main__":
             tracker_positions_until_now[2, :],
         )
 
-        for plot, device in zip(device_plots, devices):
-            device_positions_until_now = device.ps[:, np.where(device.ts <= t)[0]]
+        for plot, device, device_lod in zip(device_plots, devices, device_lods):
+            device_positions_until_now = positions_until(device, device_lod, t)
             plot[0].set_data(
                 device_positions_until_now[0, :],
                 device_positions_until_now[1, :],
@@ -176,6 +157,206 @@ if __name__ == "__main__":
         ax.set_title(title_text)
         return tracker_plot[0], *[plot[0] for plot in device_plots], title
 
+    return fig, draw_until
+
+
+def data_time_range(tracker, devices):
+    # Note: timestamps may be negative
+    first_data_timestamp = min(tracker.ts.min(), min([d.ts.min() for d in devices]))
+    last_data_timestamp = max(tracker.ts.max(), max([d.ts.max() for d in devices]))
+    return first_data_timestamp, last_data_timestamp
+
+
+def export_frame_times(first_timestamp, last_timestamp, fps, animation_speed):
+    """Data timestamps of the video frames, from first to last timestamp; independent of how fast frames render"""
+    n_frames = int(np.floor((last_timestamp - first_timestamp) * fps / animation_speed + 1e-9)) + 1
+    return first_timestamp + np.arange(n_frames) * animation_speed / fps
+
+
+def frame_segments(n_frames, n_segments):
+    """Consecutive (start, end) frame ranges of about equal length, one per worker"""
+    bounds = np.linspace(0, n_frames, n_segments + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def render_frames(fig, draw_until, times, write):
+    """Render frames at the given data timestamps, and write each as raw RGBA pixels"""
+    for t in times:
+        draw_until(t)
+        fig.canvas.draw()
+        write(fig.canvas.buffer_rgba())
+
+
+def segment_ffmpeg_command(width, height, fps, segment_path):
+    """ffmpeg arguments encoding raw RGBA frames from stdin into a video segment"""
+    return [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgba", "-s", "{}x{}".format(width, height), "-r", str(fps), "-i", "-",
+        # H.264 with yuv420p needs even dimensions
+        "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+        segment_path,
+    ]
+
+
+def concat_list_lines(paths):
+    """Lines of an ffmpeg concat demuxer list of the paths; quotes in paths are escaped as '\\''"""
+    return ["file '{}'\n".format(path.replace("'", "'\\''")) for path in paths]
+
+
+def concat_ffmpeg_command(list_path, output_path):
+    """ffmpeg arguments concatenating the segments listed in list_path into output_path, without re-encoding"""
+    return [
+        "ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy",
+        output_path,
+    ]
+
+
+# Plot data of export worker processes, set once per worker (instead of each worker loading the data again)
+_export_data = None
+
+
+def _set_export_data(tracker, devices):
+    global _export_data
+    _export_data = (tracker, devices)
+
+
+def export_segment(args, times, segment_path):
+    """Render frames at the given timestamps (in a worker process) into a video segment with ffmpeg"""
+    matplotlib.use("Agg")
+    tracker, devices = _export_data
+    fig, draw_until = create_plot(tracker, devices, args.tracker_input, args.device_input, args.max_points)
+    width, height = fig.canvas.get_width_height()
+    ffmpeg = subprocess.Popen(segment_ffmpeg_command(width, height, args.fps, segment_path), stdin=subprocess.PIPE)
+    with ffmpeg.stdin:
+        render_frames(fig, draw_until, times, ffmpeg.stdin.write)
+    if ffmpeg.wait() != 0:
+        raise RuntimeError("ffmpeg failed to write {}".format(segment_path))
+    return len(times)
+
+
+def export_video(args, tracker, devices):
+    """
+    Export the animation into args.export without showing it: frames are split into one segment per worker
+    process, each rendered with the Agg backend and encoded separately, and then concatenated by ffmpeg
+    (without re-encoding).
+    """
+    times = export_frame_times(*data_time_range(tracker, devices), args.fps, args.animation_speed)
+    segments = frame_segments(len(times), args.workers)
+    output_dir = os.path.dirname(os.path.abspath(args.export))
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        segment_paths = [os.path.join(tmp_dir, "segment{}.mp4".format(i)) for i in range(len(segments))]
+        with ProcessPoolExecutor(args.workers, initializer=_set_export_data, initargs=(tracker, devices)) as executor:
+            list(executor.map(
+                export_segment,
+                [args] * len(segments),
+                [times[start:end] for start, end in segments],
+                segment_paths,
+            ))
+        list_path = os.path.join(tmp_dir, "segments.txt")
+        with open(list_path, "w") as f:
+            f.writelines(concat_list_lines(segment_paths))
+        subprocess.run(concat_ffmpeg_command(list_path, args.export), check=True)
+    print("Exported {} frames ({:.1f}s of data) into {}".format(len(times), times[-1] - times[0], args.export))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t",
+        "--tracker_input",
+        dest="tracker_input",
+        help="Input file with tracker position and rotation data",
+        required=True,
+    )
+    parser.add_argument(
+        "-d",
+        "--device_input",
+        dest="device_input",
+        action='append',
+        help="Input file with device position data",
+        required=True,
+    )
+    parser.add_argument(
+        "-a",
+        "--animate",
+        dest="animate",
+        help="Animate the plot by timestamps instead of showing whole data at once",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--animation_speed",
+        dest="animation_speed",
+        help="Animation speed",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--loop",
+        dest="loop",
+        help="Loop animation",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--tracker_stride",
+        dest="tracker_stride",
+        help="Only use every Nth line of the tracker data (downsampling while loading, instead of downsample.sh)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max_points",
+        dest="max_points",
+        help="Draw at most about this many points per trajectory (min/max-preserving decimation), 0 to draw all",
+        type=int,
+        default=5000,
+    )
+    parser.add_argument(
+        "--export",
+        dest="export",
+        help="Export the animation into this video file (e.g. trajectory.mp4) with ffmpeg, instead of showing it",
+    )
+    parser.add_argument(
+        "--fps",
+        dest="fps",
+        help="Frames per second of the exported video",
+        type=int,
+        default=30,
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of processes rendering the exported video",
+        type=int,
+        default=DEFAULT_WORKERS,
+    )
+    args = parser.parse_args()
+    tracker, devices = load_plot_data(args)
+
+    if args.export is not None:
+        matplotlib.use("Agg")
+        export_video(args, tracker, devices)
+        sys.exit(0)
+
+    fig, draw_until = create_plot(tracker, devices, args.tracker_input, args.device_input, args.max_points)
+    first_data_timestamp, last_data_timestamp = data_time_range(tracker, devices)
+    total_animation_length = last_data_timestamp - first_data_timestamp
+
+    def update_graph(frame):
+        # Time in seconds since animation start
+        t = (time.time() - anim_start) * args.animation_speed
+
+        if args.loop:
+            while t > last_data_timestamp:
+                t -= total_animation_length
+        else:
+            # Stop time at end
+            t = min(t, last_data_timestamp, last_data_timestamp)
+
+        if not args.animate:
+            t = last_data_timestamp
+
+        return draw_until(t)
+
     from matplotlib.animation import FuncAnimation
 
     # Plot tracker and VIO device trajectories as animation
@@ -183,11 +364,61 @@ if __name__ == "__main__":
     anim_start = time.time()
     plt.show()
 
-    # import math
-    # import matplotlib.animation as animation
-    # Writer = animation.writers['ffmpeg']
-    # writer = Writer(fps=15, metadata=dict(artist='Me'), bitrate=1800)
-    # frames = int(math.ceil(total_animation_length * 1.0 / 0.015))
-    # anim = FuncAnimation(fig, update_graph, frames, interval=15, blit=True)
-    # anim_start = time.time()
-    # anim.save('results/trajectory{}.mp4'.format(int(time.time())), writer=writer)
\ No newline at end of file
+
+def test_level_of_detail():
+    rng = np.random.default_rng(0)
+    data = position_data()
+    data.ts = np.arange(100000) / 1000.0
+    data.ps = np.cumsum(rng.normal(size=(3, 100000)), axis=1)
+    data.ps[1, 54321] = 1000.0  # spike
+    lod = level_of_detail_indices(data.ps, 5000)
+    assert len(lod) <= 5000 and 54321 in lod
+    assert np.array_equal(data.ps.min(axis=1), data.ps[:, lod].min(axis=1))
+    assert np.array_equal(data.ps.max(axis=1), data.ps[:, lod].max(axis=1))
+    assert np.array_equal(level_of_detail_indices(data.ps[:, :10], 5000), np.arange(10))
+
+    for t in [-1.0, 0.0, 12.3456, 54.321, 99.999, 200.0]:
+        ps = positions_until(data, lod, t)
+        exact = data.ps[:, data.ts <= t]
+        # Decimated points are a subset in order, and the latest position is exact
+        assert ps.shape[1] == exact.shape[1] == 0 or np.array_equal(ps[:, -1], exact[:, -1])
+        # At most the decimated points and one bucket (160 samples) after them
+        assert ps.shape[1] <= min(exact.shape[1], len(lod) + 160)
+
+
+def test_render_frames():
+    matplotlib.use("Agg")
+    data = position_data()
+    data.ts = np.arange(1000) / 100.0
+    data.ps = np.stack([np.cos(data.ts), np.sin(data.ts), data.ts / 10.0])
+
+    times = export_frame_times(data.ts[0], data.ts[-1], 5, 2.0)
+    assert len(times) == 25 and times[-1] <= data.ts[-1]
+    segments = frame_segments(len(times), 4)
+    assert segments[0][0] == 0 and segments[-1][1] == len(times)
+    assert all(a[1] == b[0] for a, b in zip(segments[:-1], segments[1:]))
+
+    # Frames only depend on their timestamps, so segments can be rendered separately
+    def render(times):
+        fig, draw_until = create_plot(data, [data], "tracker", ["device"], 5000)
+        frames = []
+        render_frames(fig, draw_until, times, lambda frame: frames.append(bytes(frame)))
+        plt.close(fig)
+        return frames
+
+    start, end = segments[1]
+    assert render(times[start:end]) == render(times)[start:end]
+
+
+def test_ffmpeg_commands():
+    assert concat_list_lines(["/tmp/a/segment0.mp4", "/tmp/it's/segment1.mp4"]) == [
+        "file '/tmp/a/segment0.mp4'\n",
+        "file '/tmp/it'\\''s/segment1.mp4'\n",
+    ]
+    command = segment_ffmpeg_command(641, 480, 30, "segment0.mp4")
+    assert command[0] == "ffmpeg" and command[-1] == "segment0.mp4"
+    assert command[command.index("-s") + 1] == "641x480" and command[command.index("-r") + 1] == "30"
+    assert command[command.index("-i") + 1] == "-"
+    command = concat_ffmpeg_command("segments.txt", "out put.mp4")
+    assert command[command.index("-f") + 1] == "concat" and command[command.index("-i") + 1] == "segments.txt"
+    assert command[-3:] == ["-c", "copy", "out put.mp4"]
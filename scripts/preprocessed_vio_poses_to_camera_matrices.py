@@ -1,71 +1,36 @@
 import sys
+import os
 import json
+import itertools
 import numpy as np
 
-# q is quaternion with elements (x, y, z, w)
-def quat2rmat(q: np.array):
-    return np.array(
-        [
-            [
-                q[0] * q[0] + q[1] * q[1] - q[2] * q[2] - q[3] * q[3],
-                2 * q[1] * q[2] - 2 * q[0] * q[3],
-                2 * q[1] * q[3] + 2 * q[0] * q[2],
-            ],
-            [
-                2 * q[1] * q[2] + 2 * q[0] * q[3],
-                q[0] * q[0] - q[1] * q[1] + q[2] * q[2] - q[3] * q[3],
-                2 * q[2] * q[3] - 2 * q[0] * q[1],
-            ],
-            [
-                2 * q[1] * q[3] - 2 * q[0] * q[2],
-                2 * q[2] * q[3] + 2 * q[0] * q[1],
-                q[0] * q[0] - q[1] * q[1] - q[2] * q[2] + q[3] * q[3],
-            ],
-        ]
-    )
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from extract_vio_poses import camera_rotations
 
+# Lines are converted in chunks, with all poses of a chunk converted with a few array operations
+CHUNK_LINES = 8192
 
-# Quick tool for recovering the camera pose matrix from VIO data.
-# In VIO data, it is stored as orientation=R, position=-R.t() * p
-# Therefore view matrix is (R, -Rp), and camera matrix is inverse of that
-if __name__ == "__main__":
-    for line in sys.stdin:
-        j = json.loads(line)
-        p = np.array(
-            [
-                [
-                    j["cameraExtrinsics"]["position"]["x"],
-                ],
-                [
-                    j["cameraExtrinsics"]["position"]["y"],
-                ],
-                [
-                    j["cameraExtrinsics"]["position"]["z"],
-                ],
-            ]
-        )
-        q = np.array(
-            [
-                j["cameraExtrinsics"]["orientation"]["x"],
-                j["cameraExtrinsics"]["orientation"]["y"],
-                j["cameraExtrinsics"]["orientation"]["z"],
-                j["cameraExtrinsics"]["orientation"]["w"],
-            ]
-        )
-        R = quat2rmat(q)
-
-        # Recover original view matrix
-        V = np.identity(4)
-        V[:3, :3] = R
-        V[:3, 3:4] = -R @ p
 
-        # Recover camera matrix from view matrix
-        C = np.linalg.inv(V)
+def convert_lines(lines):
+    js = [json.loads(line) for line in lines]
+    p = np.array([[j["cameraExtrinsics"]["position"][k] for k in "xyz"] for j in js]).T
+    q = np.array([[j["cameraExtrinsics"]["orientation"][k] for k in "xyzw"] for j in js])
+    # 3x4 camera matrices [C | p] as Python lists, since json.dumps() of numpy values is slow
+    M = np.concatenate([camera_rotations(q), p[:, np.newaxis, :]], axis=1)
+    output = []
+    for j, m in zip(js, M.transpose(2, 0, 1).tolist()):
+        j["VIO_pose"] = m
+        output.append(json.dumps(j) + "\n")
+    return output
 
-        j["VIO_pose"] = [
-            [ C[0, 0], C[0, 1], C[0, 2], C[0, 3] ],
-            [ C[1, 0], C[1, 1], C[1, 2], C[1, 3] ],
-            [ C[2, 0], C[2, 1], C[2, 2], C[2, 3] ],
-        ]
 
-        print(json.dumps(j))
+# Quick tool for recovering the camera pose matrix from VIO data.
+# In VIO data, it is stored as orientation=R, position=-R.t() * p
+# Therefore view matrix is (R, -Rp), and camera matrix is inverse of that (see extract_vio_poses.camera_rotations)
+if __name__ == "__main__":
+    lines = iter(sys.stdin)
+    while True:
+        chunk = list(itertools.islice(lines, CHUNK_LINES))
+        if not chunk:
+            break
+        sys.stdout.writelines(convert_lines(chunk))
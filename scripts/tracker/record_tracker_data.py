@@ -1,37 +1,314 @@
-import openvr as vr
+import argparse
+import os
+import sys
+import threading
 import time
 import json
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from poses import TRACKER_RECORD_DTYPE, load_tracker_records
+
+# Note: openvr is imported in main(), so that the recording loop can be tested with a fake openvr module
+
+# Polling loop only copies pose matrices into a ring buffer, and a writer thread serializes and writes them
+# in batches, so slow disk or pipe does not delay polling (which would show up as gaps in tracker timestamps).
+# If the writer cannot keep up and the buffer fills, new poses are dropped and counted.
+BUFFER_SIZE = 1 << 16
+WRITE_INTERVAL = 0.05  # seconds
 
-def main():
-    vr_system = vr.init(vr.VRApplication_Background)
 
+def find_trackers(vr, vr_system):
     trackers = []
     for i in range(vr.k_unMaxTrackedDeviceCount):
         device_class = vr_system.getTrackedDeviceClass(i)
         if device_class == vr.TrackedDeviceClass_GenericTracker:
             trackers.append(i)
+    return trackers
+
+
+def pose_json(t, i, m):
+    j = {}
+    j["time"] = t
+    j["tracker"] = i
+    j["position"] = { "x": m[0][3], "y": m[1][3], "z": m[2][3] }
+    j["rotation"] = {
+        "col0": [ m[0][0], m[0][1], m[0][2], ],
+        "col1": [ m[1][0], m[1][1], m[1][2], ],
+        "col2": [ m[2][0], m[2][1], m[2][2], ],
+    }
+    return json.dumps(j)
+
+
+class PoseRingBuffer:
+    def __init__(self, capacity=BUFFER_SIZE):
+        self.records = np.zeros(capacity, dtype=TRACKER_RECORD_DTYPE)
+        self.capacity = capacity
+        # Total numbers of pushed and popped records; only the polling thread changes n_pushed,
+        # and only the writer thread changes n_popped
+        self.n_pushed = 0
+        self.n_popped = 0
+        self.n_dropped = 0
+
+    def push(self, t, i, m):
+        if self.n_pushed - self.n_popped >= self.capacity:
+            self.n_dropped += 1
+            return
+        self.records[self.n_pushed % self.capacity] = (t, i, [list(row) for row in m])
+        self.n_pushed += 1
+
+    def pop_all(self):
+        start, end = self.n_popped, self.n_pushed
+        indices = np.arange(start, end) % self.capacity
+        records = self.records[indices]
+        self.n_popped = end
+        return records
+
+
+class PoseWriter(threading.Thread):
+    def __init__(self, buffer, output, binary=False, interval=WRITE_INTERVAL):
+        super().__init__(daemon=True)
+        self.buffer = buffer
+        self.output = output
+        self.binary = binary
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.write_buffered()
+        self.write_buffered()
 
+    def write_buffered(self):
+        records = self.buffer.pop_all()
+        if len(records) == 0:
+            return
+        if self.binary:
+            self.output.write(records.tobytes())
+        else:
+            self.output.write("".join(
+                pose_json(t, i, m) + "\n"
+                for t, i, m in zip(records["time"].tolist(), records["tracker"].tolist(), records["m"].tolist())
+            ))
+        self.output.flush()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+
+def record(vr, vr_system, write, rate=None, keep_duplicates=False, max_polls=None,
+           clock=time.monotonic, wall_clock=time.time, sleep=time.sleep):
+    """
+    Poll tracker poses and write(t, tracker, m) each of them, where m is the 3x4 pose matrix.
+    rate: polls per second, scheduled against the monotonic clock so that the rate does not drift
+        (if polling falls behind, missed polls are skipped instead of bursting to catch up).
+        By default poll as fast as possible, like before.
+    max_polls: stop after this many polls (skipped polls are not counted)
+    keep_duplicates: by default, a pose identical to the previous pose of the same tracker is not written,
+        since the tracker pose is only updated at the tracking rate, and polling faster just repeats it
+    Returns number of written poses.
+    """
+    trackers = find_trackers(vr, vr_system)
+    previous = {}
     poses = []
-    t_start = time.time()
-    while True:
-        t_now = time.time()
+    n_written = 0
+    n_polls = 0  # Polls done, skipped scheduled polls do not count towards max_polls
+    n_scheduled = 0
+    t_first = clock()
+    while max_polls is None or n_polls < max_polls:
+        if rate is not None:
+            t_next = t_first + n_scheduled / rate
+            delay = t_next - clock()
+            if delay > 0:
+                sleep(delay)
+            elif delay < -1.0 / rate:
+                # Fell behind by more than one period, skip the missed polls and poll now
+                n_scheduled = int((t_next - delay - t_first) * rate)
+        n_scheduled += 1
+        n_polls += 1
+        t_now = wall_clock()
         poses = vr_system.getDeviceToAbsoluteTrackingPose(vr.TrackingUniverseSeated, 0.0, poses)
         for i in trackers:
             m = poses[i].mDeviceToAbsoluteTracking
-            j = {}
-            j["time"] = t_now
-            j["tracker"] = i
-            j["position"] = { "x": m[0][3], "y": m[1][3], "z": m[2][3] }
-            j["rotation"] = {
-                "col0": [ m[0][0], m[0][1], m[0][2], ],
-                "col1": [ m[1][0], m[1][1], m[1][2], ],
-                "col2": [ m[2][0], m[2][1], m[2][2], ],
-            }
-            print(json.dumps(j))
+            if not keep_duplicates:
+                values = tuple(tuple(row) for row in m)
+                if previous.get(i) == values:
+                    continue
+                previous[i] = values
+            write(t_now, i, m)
+            n_written += 1
+    return n_written
+
+
+def record_with_writer(vr, vr_system, output, binary=False, buffer_size=BUFFER_SIZE, **options):
+    """Record (see record()) through the ring buffer and writer thread, returns numbers of written and dropped poses"""
+    buffer = PoseRingBuffer(buffer_size)
+    writer = PoseWriter(buffer, output, binary)
+    writer.start()
+    try:
+        record(vr, vr_system, buffer.push, **options)
+    finally:
+        writer.stop()
+        print("Recorded {} poses, dropped {}".format(buffer.n_pushed, buffer.n_dropped), file=sys.stderr)
+    return buffer.n_pushed, buffer.n_dropped
+
+
+def main(rate=None, keep_duplicates=False, output_path=None, binary=False, buffer_size=BUFFER_SIZE):
+    import openvr as vr
+
+    vr_system = vr.init(vr.VRApplication_Background)
+    if output_path is None:
+        output = sys.stdout.buffer if binary else sys.stdout
+    else:
+        output = open(output_path, "wb" if binary else "w")
+    try:
+        record_with_writer(
+            vr, vr_system, output, binary, buffer_size, rate=rate, keep_duplicates=keep_duplicates
+        )
+    finally:
+        if output_path is not None:
+            output.close()
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        help="Target number of pose polls per second (by default poll as fast as possible)",
+        type=float,
+    )
+    parser.add_argument(
+        "--keep_duplicates",
+        dest="keep_duplicates",
+        help="Also write poses that are identical to the previous pose of the same tracker",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Output file (by default, write to stdout)",
+    )
+    parser.add_argument(
+        "--binary",
+        dest="binary",
+        help="Write fixed-size binary records (time, tracker, 3x4 matrix) instead of JSONL; "
+             "use a .trackerbin file name to load them with src/poses.py",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--buffer_size",
+        dest="buffer_size",
+        help="Number of poses buffered for the writer thread, before dropping new poses",
+        type=int,
+        default=BUFFER_SIZE,
+    )
+    args = parser.parse_args()
     try:
-        main()
+        main(args.rate, args.keep_duplicates, args.output, args.binary, args.buffer_size)
     except KeyboardInterrupt:
         # Recording ended by pressing Ctrl+C, which raises KeyboardInterrupt
-        pass
\ No newline at end of file
+        pass
+
+
+class FakePose:
+    def __init__(self, x):
+        self.mDeviceToAbsoluteTracking = [
+            [1.0, 0.0, 0.0, x],
+            [0.0, 1.0, 0.0, 0.0],
+            [0.0, 0.0, 1.0, 0.0],
+        ]
+
+
+class FakeVRSystem:
+    # Device 1 is a tracker that moves on every other poll, device 2 is not a tracker
+    def __init__(self):
+        self.n_polls = 0
+
+    def getTrackedDeviceClass(self, i):
+        return "tracker" if i == 1 else "other"
+
+    def getDeviceToAbsoluteTrackingPose(self, universe, seconds_to_photon, poses):
+        self.n_polls += 1
+        return [FakePose(0.0), FakePose(float(self.n_polls // 2)), FakePose(0.0)]
+
+
+class FakeOpenVR:
+    k_unMaxTrackedDeviceCount = 3
+    TrackedDeviceClass_GenericTracker = "tracker"
+    TrackingUniverseSeated = 0
+
+
+class FakeClock:
+    def __init__(self, poll_duration):
+        self.t = 100.0
+        self.poll_duration = poll_duration
+
+    def __call__(self):
+        self.t += self.poll_duration
+        return self.t
+
+    def sleep(self, seconds):
+        self.t += seconds
+
+
+def test_record_deduplicates():
+    written = []
+    n = record(FakeOpenVR, FakeVRSystem(), lambda t, i, m: written.append((i, m[0][3])), max_polls=10)
+    assert n == len(written) == 6
+    assert written == [(1, float(x)) for x in range(6)]
+
+    written = []
+    record(FakeOpenVR, FakeVRSystem(), lambda t, i, m: written.append(i), keep_duplicates=True, max_polls=10)
+    assert written == [1] * 10
+
+
+def test_record_rate():
+    clock = FakeClock(0.001)
+    times = []
+    record(FakeOpenVR, FakeVRSystem(), lambda t, i, m: times.append(t), rate=100.0, keep_duplicates=True,
+           max_polls=50, clock=clock, wall_clock=clock, sleep=clock.sleep)
+    # Polls are scheduled at exactly 10ms intervals, time spent polling does not accumulate
+    assert len(times) == 50
+    assert abs((times[-1] - times[0]) - 0.49) < 0.005
+
+    # Polls that take longer than the period are skipped instead of drifting, and do not count as polls
+    clock = FakeClock(0.025)
+    times = []
+    n = record(FakeOpenVR, FakeVRSystem(), lambda t, i, m: times.append(t), rate=100.0, keep_duplicates=True,
+               max_polls=50, clock=clock, wall_clock=clock, sleep=clock.sleep)
+    assert n == 50
+    assert np.diff(times).min() >= 0.02
+
+
+def test_ring_buffer_drops_when_full():
+    buffer = PoseRingBuffer(4)
+    m = FakePose(1.0).mDeviceToAbsoluteTracking
+    for i in range(6):
+        buffer.push(float(i), 1, m)
+    assert buffer.n_dropped == 2
+    assert buffer.pop_all()["time"].tolist() == [0.0, 1.0, 2.0, 3.0]
+    for i in range(3):
+        buffer.push(float(i + 10), 1, m)
+    # Wraps around the end of the buffer
+    assert buffer.pop_all()["time"].tolist() == [10.0, 11.0, 12.0]
+    assert len(buffer.pop_all()) == 0
+
+
+def test_record_with_writer(tmp_path):
+    import io
+
+    output = io.StringIO()
+    n_written, n_dropped = record_with_writer(FakeOpenVR, FakeVRSystem(), output, max_polls=10)
+    assert (n_written, n_dropped) == (6, 0)
+    lines = output.getvalue().splitlines()
+    assert [json.loads(line)["position"]["x"] for line in lines] == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+
+    path = tmp_path / "tracker.trackerbin"
+    with open(path, "wb") as output:
+        record_with_writer(FakeOpenVR, FakeVRSystem(), output, binary=True, max_polls=10)
+    assert path.stat().st_size == 6 * TRACKER_RECORD_DTYPE.itemsize
+    poses = load_tracker_records(str(path), tracker=1)
+    assert poses.p[0].tolist() == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
@@ -1,79 +1,43 @@
 import sys
+import os
 import json
+import itertools
 import numpy as np
 
-# q is quaternion with elements (x, y, z, w)
-def quat2rmat(q: np.array):
-    return np.array(
-        [
-            [
-                q[0] * q[0] + q[1] * q[1] - q[2] * q[2] - q[3] * q[3],
-                2 * q[1] * q[2] - 2 * q[0] * q[3],
-                2 * q[1] * q[3] + 2 * q[0] * q[2],
-            ],
-            [
-                2 * q[1] * q[2] + 2 * q[0] * q[3],
-                q[0] * q[0] - q[1] * q[1] + q[2] * q[2] - q[3] * q[3],
-                2 * q[2] * q[3] - 2 * q[0] * q[1],
-            ],
-            [
-                2 * q[1] * q[3] - 2 * q[0] * q[2],
-                2 * q[2] * q[3] + 2 * q[0] * q[1],
-                q[0] * q[0] - q[1] * q[1] - q[2] * q[2] + q[3] * q[3],
-            ],
-        ]
-    )
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from extract_vio_poses import camera_rotations
 
+# Lines are converted in chunks, with all poses of a chunk converted with a few array operations
+CHUNK_LINES = 8192
 
-# Quick tool for recovering the camera pose matrix from VIO data.
-# In VIO data, it is stored as orientation=R, position=-R.t() * p
-# Therefore view matrix is (R, -Rp), and camera matrix is inverse of that
-if __name__ == "__main__":
-    for line in sys.stdin:
-        j = json.loads(line)
-        if "position" in j and "orientation" in j:
-            p = np.array(
-                [
-                    [
-                        j["position"]["x"],
-                    ],
-                    [
-                        j["position"]["y"],
-                    ],
-                    [
-                        j["position"]["z"],
-                    ],
-                ]
-            )
-            q = np.array(
-                [
-                    j["orientation"]["x"],
-                    j["orientation"]["y"],
-                    j["orientation"]["z"],
-                    j["orientation"]["w"],
-                ]
-            )
-            R = quat2rmat(q)
 
-            # Recover original view matrix
-            V = np.identity(4)
-            V[:3, :3] = R
-            V[:3, 3:4] = -R @ p
+def convert_lines(lines):
+    js = [json.loads(line) for line in lines]
+    pose_indices = [i for i, j in enumerate(js) if "position" in j and "orientation" in j]
+    output = list(lines)
+    if not pose_indices:
+        return output
+    poses = [js[i] for i in pose_indices]
+    p = np.array([[j["position"][k] for k in "xyz"] for j in poses]).T
+    q = np.array([[j["orientation"][k] for k in "xyzw"] for j in poses])
+    # Python lists, since json.dumps() of numpy values is slow
+    columns = camera_rotations(q).transpose(2, 1, 0).tolist()
+    for i, j, (x, y, z), (col0, col1, col2) in zip(pose_indices, poses, p.T.tolist(), columns):
+        del j["orientation"]
+        j["position"] = {"x": x, "y": y, "z": z}
+        j["rotation"] = {"col0": col0, "col1": col1, "col2": col2}
+        output[i] = json.dumps(j) + "\n"
+    return output
 
-            # Recover camera matrix from view matrix
-            C = np.linalg.inv(V)
 
-            del j["orientation"]
-            j["position"] = {
-                "x": C[0, 3],
-                "y": C[1, 3],
-                "z": C[2, 3],
-            }
-            j["rotation"] = {
-                "col0": [v for v in C[:3, 0]],
-                "col1": [v for v in C[:3, 1]],
-                "col2": [v for v in C[:3, 2]],
-            }
-            print(json.dumps(j))
-        else:
-            print(line)
+# Quick tool for recovering the camera pose matrix from VIO data.
+# In VIO data, it is stored as orientation=R, position=-R.t() * p
+# Therefore view matrix is (R, -Rp), and camera matrix is inverse of that (see extract_vio_poses.camera_rotations)
+# Note: src/extract_vio_poses.py does the same directly from the raw VIO data
+if __name__ == "__main__":
+    lines = iter(sys.stdin)
+    while True:
+        chunk = list(itertools.islice(lines, CHUNK_LINES))
+        if not chunk:
+            break
+        sys.stdout.writelines(convert_lines(chunk))
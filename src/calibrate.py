@@ -1,48 +1,227 @@
 import numpy as np
 
-# Note: Calibration is not finished. This python version is based on libs/calibrate_vio_tracker/src/main.cpp, which also is not finished and probably has some math bug. Basic derivation of the math is in docs/calibration_math.jpg, but may have some error. In that image, 'R_vio(i)' and 't_VIO' are orientation and position of the VIO device in the Apriltag's local (real-world) coordinates at frame 'i', which is what the 'find_tag_space_poses' program outputs.
+# Calibration finds the tracker pose in the VIO device's local coordinates, from synced tracker and VIO poses.
+# This is the classic hand-eye calibration problem: with tracker poses T(i) in tracking space, VIO poses V(i)
+# in VIO space (or the Apriltag's local coordinates, which is what the 'find_tag_space_poses' program outputs),
+# and X the tracker pose in VIO device coordinates, T(i) = Y V(i) X for some fixed (unknown) Y.
+# So the relative motions A = T(i)^-1 T(j) and B = V(i)^-1 V(j) between any two frames satisfy B X = X A,
+# which is solved in least-squares sense over all the pose pairs at once.
+# Earlier two-frame version was based on libs/calibrate_vio_tracker/src/main.cpp, basic derivation of the math
+# is in docs/calibration_math.jpg.
+#
+# Note: the rotation is only determined by relative motions around at least two different (non-parallel) axes,
+# so the data should have the device rotated around more than one axis; otherwise calibrate() raises ValueError.
+MIN_USABLE_PAIRS = 2
+# Smallest accepted ratio of the second to the first singular value of the usable rotation axes
+MIN_AXIS_SPREAD = 0.01
+MAX_CONDITION_NUMBER = 1e10
+
 
-# Find calibration matrix (tracker position in VIO local coords)
-# TODO: currently just returns the position, not relative orientation (tracker orientation in VIO local coords),
-# however that should be solvable from just one tracker-VIO pose correspondence
 def calibrate_from_two_frames(R_tag, dR_vio, dT_vio, dT_tracker):
     """
-    Calibrate from just two frames of pose data
-    TODO: think math is correct, but could not get working yet
+    Calibrate tracker position from just two frames of pose data
+    TODO: think math is correct, but could not get working yet; see calibrate() for the global version
+
+    R_tag: 3x3 Numpy array
+        Rotation of the tag in the tracking space. This depends on how you have placed the tag in relation to the tracking space. See docs/calibration_tag_setup_example.jpg for example where R_tag should be
+        R_tag =
+            [
+                [ -1,  0,  0 ],
+                [  0,  0,  1 ],
+                [  0,  1,  0 ],
+            ]
+        Note that the base station should be the one that tracking space is related to.
+        You can check this by testing near which base station the tracker position is reported as (0, 0, 0).
     """
-    x = dR_vio.inverse() * (dT_tracker - R_tag * dT_vio)
+    x = np.linalg.inv(dR_vio) @ (dT_tracker - R_tag @ dT_vio)
     return x
 
-"""
-R_tag: 3x3 Numpy array
-    Rotation of the tag in the tracking space. This depends on how you have placed the tag in relation to the tracking space. See docs/calibration_tag_setup_example.jpg for example where R_tag should be
-    R_tag = 
-        [
-            [ -1,  0,  0 ],
-            [  0,  0,  1 ],
-            [  0,  1,  0 ],
-        ]
-    Note that the base station should be the one that tracking space is related to.
-    You can check this by testing near which base station the tracker position is reported as (0, 0, 0).
-"""
-def calibrate(R_tag, p_vio, R_vio, p_tracker, vio_to_tracker):
+
+def rotation_logs(R):
+    """Rotation vectors (axis * angle, 3xN) of a 3x3xN stack of rotations"""
+    cos_angles = np.clip((np.einsum("iin->n", R) - 1.0) / 2.0, -1.0, 1.0)
+    angles = np.arccos(cos_angles)
+    skew = np.array([R[2, 1] - R[1, 2], R[0, 2] - R[2, 0], R[1, 0] - R[0, 1]])
+    # angle / (2 sin(angle)) -> 1/2 for small angles
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors = np.where(angles < 1e-6, 0.5, angles / (2.0 * np.sin(angles)))
+    return skew * factors
+
+
+def relative_poses(R, p, i, j):
+    """Relative poses (M(i)^-1 M(j)) between frames i and j (index arrays) of 3x3xN rotations and 3xN positions"""
+    R_relative = np.einsum("kin,kjn->ijn", R[:, :, i], R[:, :, j])
+    p_relative = np.einsum("kin,kn->in", R[:, :, i], p[:, j] - p[:, i])
+    return R_relative, p_relative
+
+
+def pose_pairs(n, pair_gap, max_pairs=None, seed=0):
+    """Frame index pairs (i, i + pair_gap), optionally a random subset of at most max_pairs of them"""
+    i = np.arange(max(0, n - pair_gap))
+    if max_pairs is not None and len(i) > max_pairs:
+        i = np.sort(np.random.default_rng(seed).choice(i, max_pairs, replace=False))
+    return i, i + pair_gap
+
+
+def calibrate(p_vio, R_vio, p_tracker, R_tracker, vio_to_tracker, pair_gap=10, max_pairs=None, min_angle=0.01):
     """
-    For now just calibrate from two frames, instead of global optimal
+    Find calibration matrix X (4x4 tracker pose in VIO device local coordinates) from all synced pose
+    correspondences. R_vio and R_tracker are true rotation matrices (3x3xN); for poses loaded with poses.py,
+    use calibrate_poses(). vio_to_tracker maps VIO frames to tracker frames (see map_vio_to_tracker_with_sync).
+    Uses relative motions between frames pair_gap VIO frames apart (optionally a random subset of max_pairs),
+    pairs that rotate less than min_angle radians do not constrain the rotation and are left out.
+    Raises ValueError if the motions do not determine X (too few usable pairs, or all rotations around one axis).
+    Returns X, and per-pair rotation residuals (radians) and translation residuals (meters).
     """
+    vio_to_tracker = np.asarray(vio_to_tracker)
+    i, j = pose_pairs(len(vio_to_tracker), pair_gap, max_pairs)
+    R_B, p_B = relative_poses(R_vio, p_vio, i, j)
+    R_A, p_A = relative_poses(R_tracker, p_tracker, vio_to_tracker[i], vio_to_tracker[j])
+
+    # Rotation: R_B R_X = R_X R_A, so the rotation vectors are related by log(R_B) = R_X log(R_A).
+    # Solve R_X as the least-squares rotation between them (Kabsch)
+    logs_A = rotation_logs(R_A)
+    logs_B = rotation_logs(R_B)
+    angles_A = np.linalg.norm(logs_A, axis=0)
+    usable = (angles_A > min_angle) & (angles_A < np.pi - min_angle)
+    if usable.sum() < MIN_USABLE_PAIRS:
+        raise ValueError("Only {} of {} pose pairs rotate more than {} radians, need at least {}".format(
+            usable.sum(), len(usable), min_angle, MIN_USABLE_PAIRS
+        ))
+    axes = logs_A[:, usable] / angles_A[usable]
+    axis_singular_values = np.linalg.svd(axes, compute_uv=False)
+    if axis_singular_values[1] < MIN_AXIS_SPREAD * axis_singular_values[0]:
+        raise ValueError("Pose pairs rotate around only one axis, which does not determine the calibration")
+    U, _, Vt = np.linalg.svd(logs_B[:, usable] @ logs_A[:, usable].T)
+    D = np.diag([1.0, 1.0, np.sign(np.linalg.det(U @ Vt))])
+    R_X = U @ D @ Vt
+
+    # Translation: R_B t_X + t_B = R_X t_A + t_X, so (R_B - I) t_X = R_X t_A - t_B for all pairs,
+    # solved with normal equations
+    C = R_B - np.identity(3)[:, :, np.newaxis]
+    d = R_X @ p_A - p_B
+    CtC = np.einsum("kin,kjn->ij", C, C)
+    if np.linalg.matrix_rank(CtC) < 3 or np.linalg.cond(CtC) > MAX_CONDITION_NUMBER:
+        raise ValueError("Translation of the calibration is not determined by the pose pairs")
+    t_X = np.linalg.solve(CtC, np.einsum("kin,kn->i", C, d))
+
+    X = np.identity(4)
+    X[:3, :3] = R_X
+    X[:3, 3] = t_X
+
+    # Residuals of B X = X A
+    rotation_errors = np.einsum("ij,jkn->ikn", R_X.T, np.einsum("ijn,jk->ikn", R_B, R_X))
+    rotation_residuals = np.linalg.norm(rotation_logs(np.einsum("jin,jkn->ikn", R_A, rotation_errors)), axis=0)
+    translation_residuals = np.linalg.norm(np.einsum("ijn,j->in", C, t_X) - d, axis=0)
+    return X, rotation_residuals, translation_residuals
 
-    prev_vio = n_vio // 4
-    next_vio = (n_vio * 3) // 4
-    prev_tracker = vio_to_tracker[prev_vio]
-    next_tracker = vio_to_tracker[next_vio]
 
-    x = calibrate_from_two_frames(
-        R_tag,
-        R_vio[:, :, next_vio] - R_vio[:, :, prev_vio],
-        p_vio[:, next_vio] - p_vio[:, prev_vio],
-        p_tracker[:, next_tracker] - p_tracker[:, prev_tracker],
+def calibrate_poses(vio, tracker, sync, max_time_error=0.01, **options):
+    """
+    calibrate() for VIO and tracker poses loaded with poses.py, synced with sync (t_vio + sync = t_tracker).
+    VIO frames without a tracker sample within max_time_error seconds (e.g. in tracking dropouts) are left out.
+    Options are as in calibrate().
+    Note: record_tracker_data.py writes the rows of the OpenVR pose matrix as the "colN" fields, and poses.py reads
+    them as columns, so loaded tracker rotations are transposed; they are transposed back here.
+    """
+    from sync import map_vio_to_tracker_with_sync
+
+    vio_to_tracker = np.asarray(map_vio_to_tracker_with_sync(vio.t, tracker.t, sync))
+    keep = np.abs(np.asarray(tracker.t)[vio_to_tracker] - (np.asarray(vio.t) + sync)) <= max_time_error
+    return calibrate(
+        vio.p[:, keep], vio.r[:, :, keep], tracker.p, tracker.r.transpose(1, 0, 2), vio_to_tracker[keep], **options
     )
 
-    return x
+
+def random_poses(n, rng):
+    q = rng.normal(size=(4, n))
+    w, x, y, z = q / np.linalg.norm(q, axis=0)
+    R = np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+            [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+            [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+        ]
+    )
+    return R, rng.normal(size=(3, n))
+
+
+def test_rotation_logs():
+    angle = 0.3
+    R = np.array([[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]])
+    logs = rotation_logs(np.stack([R, np.identity(3)], axis=2))
+    assert np.allclose(logs[:, 0], [0.0, 0.0, angle])
+    assert np.allclose(logs[:, 1], 0.0)
+
 
 def test_calibrate():
-    pass
+    # Tracker rigidly attached to the VIO device (X), VIO space related to tracking space by Y
+    rng = np.random.default_rng(0)
+    n_vio = 2000
+    R_X, t_X = [a[..., 0] for a in random_poses(1, rng)]
+    R_Y, t_Y = [a[..., 0] for a in random_poses(1, rng)]
+    R_vio, p_vio = random_poses(n_vio, rng)
+    # T = Y V X
+    R_tracker = np.einsum("ij,jkn,kl->iln", R_Y, R_vio, R_X)
+    p_tracker = np.einsum("ij,jkn,k->in", R_Y, R_vio, t_X) + R_Y @ p_vio + t_Y[:, np.newaxis]
+    p_tracker += rng.normal(scale=0.001, size=p_tracker.shape)
+    # Tracker has two samples per VIO frame
+    R_tracker = np.repeat(R_tracker, 2, axis=2)
+    p_tracker = np.repeat(p_tracker, 2, axis=1)
+    vio_to_tracker = 2 * np.arange(n_vio)
+
+    X, rotation_residuals, translation_residuals = calibrate(
+        p_vio, R_vio, p_tracker, R_tracker, vio_to_tracker, max_pairs=500
+    )
+    assert np.allclose(X[:3, :3], R_X, atol=1e-6)
+    assert np.allclose(X[:3, 3], t_X, atol=0.001)
+    assert rotation_residuals.shape == translation_residuals.shape == (500,)
+    assert rotation_residuals.max() < 1e-6
+    assert np.median(translation_residuals) < 0.005
+
+
+def test_calibrate_degenerate():
+    rng = np.random.default_rng(1)
+    n_vio = 500
+    p_vio = rng.normal(size=(3, n_vio))
+    vio_to_tracker = np.arange(n_vio)
+
+    def rotations_around(axis, angles):
+        K = np.array([[0.0, -axis[2], axis[1]], [axis[2], 0.0, -axis[0]], [-axis[1], axis[0], 0.0]])
+        return np.stack([np.identity(3) + np.sin(a) * K + (1 - np.cos(a)) * K @ K for a in angles], axis=2)
+
+    # No rotation at all
+    R = np.repeat(np.identity(3)[:, :, np.newaxis], n_vio, axis=2)
+    try:
+        calibrate(p_vio, R, p_vio, R, vio_to_tracker)
+        assert False
+    except ValueError as e:
+        assert "rotate more than" in str(e)
+
+    # Rotation around one axis only
+    R = rotations_around(np.array([0.0, 0.0, 1.0]), np.linspace(0, 20, n_vio))
+    try:
+        calibrate(p_vio, R, p_vio, R, vio_to_tracker)
+        assert False
+    except ValueError as e:
+        assert "one axis" in str(e)
+
+
+def test_calibrate_synthetic(tmp_path):
+    from extract_vio_poses import load_vio_poses
+    from poses import load_pose_file
+    from synthetic import generate
+
+    # Through the file formats and loaders, against the known truth
+    truth = generate(str(tmp_path), duration=40.0, sync=2.0, tracker_rate=1000.0, seed=3)
+    tracker = load_pose_file(str(tmp_path / "tracker.jsonl"))
+    with open(tmp_path / "vio.jsonl", "rb") as f:
+        vio = load_vio_poses(f)
+    vio.t = vio.t - vio.t[0]
+    tracker.t = tracker.t - tracker.t[0]
+
+    X, rotation_residuals, translation_residuals = calibrate_poses(vio, tracker, truth["sync"])
+    X_true = np.array(truth["tracker_to_device"])
+    rotation_error = np.linalg.norm(rotation_logs((X[:3, :3].T @ X_true[:3, :3])[:, :, np.newaxis]))
+    assert rotation_error < 0.005
+    assert np.linalg.norm(X[:3, 3] - X_true[:3, 3]) < 0.005
@@ -0,0 +1,33 @@
+import argparse
+from poses import *
+
+# Convert tracker or VIO JSONL data into the binary pose store format (see poses.py).
+# After converting, load_pose_file() picks up the store automatically, so the tools
+# that load the same recording many times (sync.py, align_trajectories.py, plots) skip the JSONL parsing.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        action="append",
+        help="Input JSONL file(s) with tracker or VIO pose data",
+        required=True,
+    )
+    parser.add_argument(
+        "--pose_name",
+        dest="pose_name",
+        help="Name of pose to use in VIO data (VIO_pose, tag_space_pose...). Leave out for tracker data.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Output pose store directory (default: <input>.poses, or <input>.<pose_name>.poses). Only with a single input.",
+    )
+    args = parser.parse_args()
+    if args.output is not None and len(args.input) > 1:
+        parser.error("--output can only be used with a single input file")
+    for input_path in args.input:
+        store_path = convert_to_pose_store(input_path, args.pose_name, args.output)
+        print("Converted {} -> {}".format(input_path, store_path))
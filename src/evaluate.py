@@ -0,0 +1,221 @@
+import argparse
+import json
+import numpy as np
+from poses import load_pose_file
+from resample import interpolation_indices, resample_poses
+
+# VIO accuracy against the tracker, for device poses that are synced and aligned into tracking space
+# (e.g. final_device_data.poses of src/pipeline.py): absolute trajectory error (ATE) and relative pose error
+# (RPE) over several time deltas. Tracker poses are interpolated at the device timestamps (like src/resample.py),
+# all computed with array operations over the whole trajectories.
+#
+# Note: device rotations are camera orientations and tracker rotations are tracker orientations, which differ by
+# the (unknown) constant tracker-to-device rotation. So rotation errors compare the rotation angles of relative
+# motions, which do not depend on it. Likewise, like the alignment, positions are compared directly.
+DEFAULT_DELTAS = [0.1, 1.0, 10.0]
+# Without a given max_gap, reference gaps longer than this many median reference intervals (but at least
+# MIN_MAX_GAP seconds) are left out, so downsampled tracker data (e.g. src/pipeline.py defaults) still matches
+GAP_INTERVALS = 3.0
+MIN_MAX_GAP = 0.1
+
+
+def error_stats(errors):
+    if len(errors) == 0:
+        return {"count": 0}
+    return {
+        "count": int(len(errors)),
+        "rmse": float(np.sqrt(np.mean(errors ** 2))),
+        "mean": float(np.mean(errors)),
+        "median": float(np.median(errors)),
+        "std": float(np.std(errors)),
+        "max": float(np.max(errors)),
+    }
+
+
+def rotation_angles(R):
+    """Rotation angles (radians) of rotation matrices (3x3xN)"""
+    return np.arccos(np.clip((np.einsum("iin->n", R) - 1.0) / 2.0, -1.0, 1.0))
+
+
+def default_max_gap(reference):
+    """Longest reference interval (seconds) that is not a gap, scaled to the median reference interval"""
+    t = np.asarray(reference.t)
+    if len(t) < 2:
+        return MIN_MAX_GAP
+    return max(MIN_MAX_GAP, GAP_INTERVALS * float(np.median(np.diff(t))))
+
+
+def matching_poses(reference, poses, max_gap=MIN_MAX_GAP):
+    """
+    Reference poses interpolated at the times of poses, for the poses within the reference time range that are
+    not in a gap (longer than max_gap seconds) of the reference data. Returns (indices of poses, reference poses).
+    """
+    t = np.asarray(poses.t)
+    inside = (t >= reference.t[0]) & (t <= reference.t[-1])
+    i, _ = interpolation_indices(reference.t, t)
+    inside &= reference.t[i + 1] - reference.t[i] <= max_gap
+    indices = np.flatnonzero(inside)
+    return indices, resample_poses(reference, t[indices])
+
+
+def absolute_trajectory_error(reference, poses):
+    """Position errors (m) of poses against reference poses at the same times"""
+    return np.linalg.norm(poses.p - reference.p, axis=0)
+
+
+def relative_pose_errors(reference, poses, delta, tolerance):
+    """
+    Errors of relative motions from each pose to the pose closest to delta seconds later (if within tolerance
+    seconds of that): translation errors (m, difference of position changes) and rotation errors
+    (radians, difference of rotation angles).
+    """
+    t = np.asarray(poses.t)
+    if len(t) < 2:
+        return np.zeros(0), np.zeros(0)
+    i = np.arange(len(t))
+    j = np.clip(np.searchsorted(t, t + delta), 1, len(t) - 1)
+    j = np.where(np.abs(t[j - 1] - t - delta) < np.abs(t[j] - t - delta), j - 1, j)
+    valid = (j > i) & (np.abs(t[j] - t - delta) <= tolerance)
+    i, j = i[valid], j[valid]
+    translation_errors = np.linalg.norm((poses.p[:, j] - poses.p[:, i]) - (reference.p[:, j] - reference.p[:, i]), axis=0)
+    # Angles of R_i^T R_j
+    angles = rotation_angles(np.einsum("jin,jkn->ikn", poses.r[:, :, i], poses.r[:, :, j]))
+    reference_angles = rotation_angles(np.einsum("jin,jkn->ikn", reference.r[:, :, i], reference.r[:, :, j]))
+    return translation_errors, np.abs(angles - reference_angles)
+
+
+def evaluate(reference, poses, deltas=DEFAULT_DELTAS, max_gap=None):
+    """
+    ATE and RPE (for each delta in seconds) of poses against reference poses, as a JSON-compatible dict.
+    Poses in longer gaps than max_gap seconds of the reference are left out (default: see default_max_gap()).
+    """
+    if max_gap is None:
+        max_gap = default_max_gap(reference)
+    indices, matched = matching_poses(reference, poses, max_gap)
+    data = type(poses)()
+    data.t = np.asarray(poses.t)[indices]
+    data.p = np.asarray(poses.p)[:, indices]
+    data.r = np.asarray(poses.r)[:, :, indices]
+    report = {
+        "samples": int(len(poses.t)),
+        "max_gap": float(max_gap),
+        "matched_samples": int(len(indices)),
+        "duration": float(data.t[-1] - data.t[0]) if len(indices) > 0 else 0.0,
+        "ate": error_stats(absolute_trajectory_error(matched, data)),
+        "rpe": {},
+    }
+    # Device samples are about evenly spaced; allow pairs up to half a median interval off
+    tolerance = max(np.median(np.diff(data.t)) / 2.0, 1e-9) if len(indices) > 1 else 0.0
+    for delta in deltas:
+        translation_errors, rotation_errors = relative_pose_errors(matched, data, delta, tolerance)
+        report["rpe"][str(delta)] = {
+            "translation": error_stats(translation_errors),
+            "rotation_degrees": error_stats(np.degrees(rotation_errors)),
+        }
+    return report
+
+
+def print_report(path, report):
+    ate = report["ate"]
+    print("{}: {} of {} samples matched ({:.1f}s)".format(
+        path, report["matched_samples"], report["samples"], report["duration"]
+    ))
+    if ate["count"] > 0:
+        print("  ATE: rmse {:.4f}m, median {:.4f}m, max {:.4f}m".format(ate["rmse"], ate["median"], ate["max"]))
+    for delta, rpe in report["rpe"].items():
+        if rpe["translation"]["count"] > 0:
+            print("  RPE {}s: translation rmse {:.4f}m, rotation rmse {:.3f}deg ({} pairs)".format(
+                delta, rpe["translation"]["rmse"], rpe["rotation_degrees"]["rmse"], rpe["translation"]["count"]
+            ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t",
+        "--tracker_input",
+        dest="tracker_input",
+        help="Reference tracker data (JSONL, pose store or binary tracker records), in the same time as device data",
+        required=True,
+    )
+    parser.add_argument(
+        "-d",
+        "--device_input",
+        dest="device_input",
+        action="append",
+        help="Synced and aligned device poses (e.g. final_device_data.poses or .jsonl of src/pipeline.py)",
+        required=True,
+    )
+    parser.add_argument(
+        "--delta",
+        dest="deltas",
+        action="append",
+        help="Time delta (seconds) of relative pose errors, can be given many times (default: {})".format(DEFAULT_DELTAS),
+        type=float,
+    )
+    parser.add_argument(
+        "--max_gap",
+        dest="max_gap",
+        help="Device samples in longer gaps (seconds) of the tracker data are left out "
+             "(default: {} median tracker intervals, at least {}s)".format(GAP_INTERVALS, MIN_MAX_GAP),
+        type=float,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Output file for the report (JSON)",
+    )
+    args = parser.parse_args()
+    tracker = load_pose_file(args.tracker_input)
+    reports = {}
+    for device_input in args.device_input:
+        reports[device_input] = evaluate(
+            tracker, load_pose_file(device_input), args.deltas or DEFAULT_DELTAS, args.max_gap
+        )
+        print_report(device_input, reports[device_input])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+def test_evaluate():
+    from poses import Poses
+    import quaternions
+
+    def poses_at(t, rotation_offset=np.identity(3)):
+        data = Poses()
+        data.t = t
+        data.p = np.stack([np.cos(t), np.sin(0.5 * t), 0.1 * t])
+        angles = np.stack([0.3 * t, np.sin(t), 0 * t], axis=1)
+        R = quaternions.to_rotation_matrices(quaternions.exp(angles))
+        data.r = np.einsum("ijn,jk->ikn", R, rotation_offset)
+        return data
+
+    # 1kHz reference with a gap, 30Hz device with a constant rotation offset
+    t_reference = np.arange(60000) / 1000.0
+    reference = poses_at(np.concatenate([t_reference[:30000], t_reference[31000:]]))
+    offset = quaternions.to_rotation_matrices(quaternions.exp(np.array([[0.2, -0.5, 1.0]])))[:, :, 0]
+    device = poses_at(np.arange(-30, 1830) / 30.0, offset)
+
+    report = evaluate(reference, device, [0.1, 1.0])
+    assert report["samples"] == 1860
+    # Outside the reference and in the gap are left out
+    assert report["matched_samples"] == 1800 - 30
+    assert report["ate"]["max"] < 1e-6
+    for rpe in report["rpe"].values():
+        assert rpe["translation"]["max"] < 1e-6 and rpe["rotation_degrees"]["max"] < 1e-3
+    assert report["rpe"]["1.0"]["translation"]["count"] < report["rpe"]["0.1"]["translation"]["count"]
+
+    # Downsampled reference (1s intervals): gap limit follows the reference interval
+    strided = poses_at(t_reference[::1000])
+    report = evaluate(strided, device, [])
+    assert report["max_gap"] == 3.0 and report["matched_samples"] == 30 * 59 + 1
+    assert evaluate(strided, device, [], max_gap=0.1)["matched_samples"] == 0
+
+    # Position noise shows in ATE
+    noise = np.random.default_rng(0).normal(scale=0.01, size=device.p.shape)
+    device.p = device.p + noise
+    report = evaluate(reference, device)
+    assert abs(report["ate"]["rmse"] - 0.01 * np.sqrt(3)) < 0.002
+    assert abs(report["rpe"]["1.0"]["translation"]["rmse"] - 0.01 * np.sqrt(6)) < 0.003
@@ -0,0 +1,164 @@
+import argparse
+import json
+import sys
+import numpy as np
+import quaternions
+
+# Extract VIO poses from raw android-viotester data in one streaming pass, replacing
+# preprocess-vio-data.sh (jq), rebasing the timestamps (jq) and vio_poses_to_camera_matrices.py.
+# Raw recordings are mostly accelerometer and gyroscope lines, so the file is read in large blocks and
+# only lines starting with '{"arcore"' are located (bytes.find) and parsed; other lines are never split or parsed.
+# Note: this relies on viotester writing the "arcore" key first on pose lines, which it does.
+#
+# Output lines are in the same format as vio_poses_to_camera_matrices.py output:
+#   {"time": ..., "position": {"x": ..., "y": ..., "z": ...}, "rotation": {"col0": [...], "col1": [...], "col2": [...]}}
+READ_BLOCK_BYTES = 1 << 24
+ARCORE_LINE_START = b'\n{"arcore"'
+
+
+def arcore_lines(f, block_bytes=READ_BLOCK_BYTES):
+    """Yield lists of raw arcore lines (bytes) per block of a binary file, skipping all other lines"""
+    remainder = b""
+    while True:
+        block = f.read(block_bytes)
+        # Data always starts at a line start, so the newline before it makes the first line findable too
+        data = b"\n" + remainder + block
+        if not block:
+            # Last line without a newline at the end
+            data += b"\n"
+        last_newline = data.rfind(b"\n")
+        lines = []
+        i = data.find(ARCORE_LINE_START, 0, last_newline)
+        while i != -1:
+            end = data.find(b"\n", i + 1)
+            lines.append(data[i + 1 : end])
+            i = data.find(ARCORE_LINE_START, end, last_newline)
+        if lines:
+            yield lines
+        if not block:
+            break
+        remainder = data[last_newline + 1 :]
+
+
+def camera_rotations(orientations):
+    """
+    Camera rotations (3x3xN) of VIO data orientations (Nx4, fields in x, y, z, w order).
+    VIO data stores the view matrix V = (R | -R p) as orientation R and position p,
+    camera matrix is the inverse of that, C = (R^T | p).
+    Note: like the original per-line quat2rmat() of the converter scripts, this uses the "x" field
+    as the scalar part of the quaternion; kept that way so that converted data stays the same.
+    """
+    return quaternions.to_rotation_matrices(orientations).transpose(1, 0, 2)
+
+
+# Note: pose values are written with 9 significant digits (VIO poses are float32 precision to begin with),
+# because formatting full float repr()s would take most of the run time. Timestamps keep nanoseconds.
+POSE_LINE_FORMAT = (
+    '{"time": %.9f, "position": {"x": %.9g, "y": %.9g, "z": %.9g}, '
+    '"rotation": {"col0": [%.9g, %.9g, %.9g], "col1": [%.9g, %.9g, %.9g], "col2": [%.9g, %.9g, %.9g]}}\n'
+)
+
+
+def parse_arcore_lines(lines):
+    """Timestamps (N), camera positions (3xN) and camera rotations (3x3xN) of raw arcore lines"""
+    # One JSON array per block is much faster to parse than the lines one by one
+    js = json.loads(b"[" + b",".join(lines) + b"]")
+    t = np.array([j["time"] for j in js])
+    p = np.array([[j["arcore"]["position"][k] for k in "xyz"] for j in js]).T
+    q = np.array([[j["arcore"]["orientation"][k] for k in "xyzw"] for j in js])
+    return t, p, camera_rotations(q)
+
+
+def camera_matrix_lines(lines, t0):
+    """Convert raw arcore lines into camera matrix pose lines, with t0 subtracted from timestamps"""
+    t, p, C = parse_arcore_lines(lines)
+    # Columns one after another, like the "colN" fields
+    values = np.concatenate([(t - t0)[np.newaxis], p, C.transpose(1, 0, 2).reshape(9, -1)]).T.tolist()
+    return [POSE_LINE_FORMAT % tuple(row) for row in values]
+
+
+def extract_vio_poses(input_file, output_file, rebase_time=True, block_bytes=READ_BLOCK_BYTES):
+    """Extract camera matrix poses from raw viotester data (binary input file, text output file), returns number of poses"""
+    t0 = None
+    n = 0
+    for lines in arcore_lines(input_file, block_bytes):
+        if t0 is None:
+            t0 = json.loads(lines[0])["time"] if rebase_time else 0.0
+        output_file.writelines(camera_matrix_lines(lines, t0))
+        n += len(lines)
+    return n
+
+
+def load_vio_poses(input_file, block_bytes=READ_BLOCK_BYTES):
+    """Camera matrix poses of raw viotester data (binary input file) as Poses, with the original timestamps"""
+    from poses import Poses
+
+    blocks = [parse_arcore_lines(lines) for lines in arcore_lines(input_file, block_bytes)]
+    data = Poses()
+    data.t = np.concatenate([t for t, _, _ in blocks]) if blocks else np.zeros(0)
+    data.p = np.concatenate([p for _, p, _ in blocks], axis=1) if blocks else np.zeros((3, 0))
+    data.r = np.concatenate([C for _, _, C in blocks], axis=2) if blocks else np.zeros((3, 3, 0))
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        help="Raw android-viotester data (JSONL), by default read from stdin",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Output file for camera matrix poses, by default written to stdout",
+    )
+    parser.add_argument(
+        "--keep_time",
+        dest="keep_time",
+        help="Keep original timestamps, instead of making them start from 0",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    input_file = open(args.input, "rb") if args.input is not None else sys.stdin.buffer
+    output_file = open(args.output, "w") if args.output is not None else sys.stdout
+    with input_file, output_file:
+        extract_vio_poses(input_file, output_file, not args.keep_time)
+
+
+def test_arcore_lines():
+    import io
+
+    data = b'{"arcore":1}\n{"sensor":2}\n{"arcore":3}\n{"frames":4}\n{"arcore":5}'
+    for block_bytes in [1, 5, 13, 1000]:
+        lines = [line for block in arcore_lines(io.BytesIO(data), block_bytes) for line in block]
+        assert lines == [b'{"arcore":1}', b'{"arcore":3}', b'{"arcore":5}']
+
+
+def test_extract_vio_poses(tmp_path):
+    import io
+    from synthetic import generate, random_trajectory, vio_poses
+
+    truth = generate(str(tmp_path), duration=10.0, sync=1.0, vio_position_noise=0.0, vio_rotation_noise=0.0,
+                     dropouts_per_minute=0.0, seed=3)
+    output = io.StringIO()
+    with open(tmp_path / "vio.jsonl", "rb") as f:
+        n = extract_vio_poses(f, output, block_bytes=4096)
+    assert n == truth["arcore_lines"]
+    poses = [json.loads(line) for line in output.getvalue().splitlines()]
+    t = np.array([j["time"] for j in poses])
+    assert t[0] == 0.0 and np.allclose(np.diff(t), 1.0 / 30.0, atol=1e-5)
+
+    R, p = vio_poses(random_trajectory(np.random.default_rng(3)), truth["sync"] + t)
+    for i in [0, n // 2, n - 1]:
+        assert np.allclose([poses[i]["position"][k] for k in "xyz"], p[:, i], atol=1e-6)
+        C = np.array([poses[i]["rotation"]["col" + str(c)] for c in range(3)]).T
+        assert np.allclose(C, R[:, :, i], atol=1e-6)
+
+    with open(tmp_path / "vio.jsonl", "rb") as f:
+        loaded = load_vio_poses(f, block_bytes=4096)
+    assert np.allclose(loaded.t - loaded.t[0], t, atol=1e-6)
+    assert np.allclose(loaded.p, p, atol=1e-6)
+    assert np.allclose(loaded.r, R, atol=1e-6)
@@ -0,0 +1,540 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from poses import Poses, load_pose_file, save_pose_store, load_pose_store
+from evaluate import evaluate
+from extract_vio_poses import load_vio_poses
+from resample import resample_uniform
+from sync import (
+    sync_movement_speeds,
+    sync_rotation_diffs,
+    sync_rotation_speeds,
+    sync_speed_correlation,
+    fit_device_to_tracker,
+    tracker_step_signals,
+)
+
+# Whole pipeline of run_whole_pipeline.sh in one process: extract VIO poses from the raw device data
+# (preprocess + convert), rebase timestamps, downsample tracker data, sync, and align device poses into
+# tracking space. Stages pass Poses in memory.
+#
+# Every stage's output is cached (pose stores and JSON files in the cache directory), keyed on a hash of
+# the stage's parameters and its inputs: input files by content, earlier stages by their keys. So a re-run
+# only recomputes the stages whose inputs or parameters changed.
+# Note: bump PIPELINE_VERSION when changing what a stage computes, so old cached outputs are not used.
+PIPELINE_VERSION = 1
+HASH_BLOCK_BYTES = 1 << 24
+
+SYNC_METHODS = ["movement_speeds", "speed_correlation", "rotation_diffs", "rotation_speeds"]
+
+
+def file_digest(path, cache_dir):
+    """
+    Content hash of a file. Hashes are remembered by path, size and modification time,
+    so unchanged multi-GB recordings are not re-read on every run.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digests_path = os.path.join(cache_dir, "file_digests.json")
+    digests = {}
+    if os.path.exists(digests_path):
+        with open(digests_path) as f:
+            digests = json.load(f)
+    known = digests.get(path)
+    if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["digest"]
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b""):
+            h.update(block)
+    digests[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": h.hexdigest()}
+    with open(digests_path + ".tmp", "w") as f:
+        json.dump(digests, f)
+    os.replace(digests_path + ".tmp", digests_path)
+    return h.hexdigest()
+
+
+def stage_key(name, parameters, *inputs):
+    """Cache key of a stage from its name, parameters (JSON-serializable) and input keys/digests"""
+    description = json.dumps([PIPELINE_VERSION, name, parameters, inputs], sort_keys=True)
+    return "{}-{}".format(name, hashlib.blake2b(description.encode(), digest_size=12).hexdigest())
+
+
+class StageCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.computed = []  # Names of the stages that were not found in the cache
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _store(self, key, write):
+        # Write into a temporary directory first, so an interrupted run does not leave a broken cache entry.
+        # Temporary directories are per process, as batch workers can compute the same stage (same input data)
+        tmp_path = "{}.{}.tmp".format(self._path(key), os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        write(tmp_path)
+        try:
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            # Another process stored the same entry first
+            if not os.path.isdir(self._path(key)):
+                raise
+            shutil.rmtree(tmp_path)
+
+    def poses(self, key, compute):
+        path = self._path(key)
+        if not os.path.isdir(path):
+            print("{}: computing".format(key))
+            self.computed.append(key.rsplit("-", 1)[0])
+            self._store(key, lambda tmp_path: save_pose_store(compute(), tmp_path))
+        else:
+            print("{}: cached".format(key))
+        return load_pose_store(path)
+
+    def result(self, key, compute):
+        path = self._path(key)
+        if not os.path.isdir(path):
+            print("{}: computing".format(key))
+            self.computed.append(key.rsplit("-", 1)[0])
+            result = compute()
+
+            def write(tmp_path):
+                with open(os.path.join(tmp_path, "result.json"), "w") as f:
+                    json.dump(result, f, indent=2)
+            self._store(key, write)
+        else:
+            print("{}: cached".format(key))
+        with open(os.path.join(path, "result.json")) as f:
+            return json.load(f)
+
+
+def rebased(poses):
+    data = Poses()
+    data.t = poses.t - poses.t[0]
+    data.p = poses.p
+    data.r = poses.r
+    return data
+
+
+def find_sync(method, vio, tracker, precision_ms=None, workers=1, tracker_signals=None):
+    if method == "movement_speeds":
+        return sync_movement_speeds(vio.t, vio.p, tracker.t, tracker.p, precision_ms=precision_ms, workers=workers)
+    if method == "speed_correlation":
+        # Syncs between the timestamps, which is the same as relative to the starts for the rebased data
+        return sync_speed_correlation(
+            vio.t, vio.p, vio.r, tracker.t, tracker.p, tracker.r, tracker_signals=tracker_signals
+        )
+    if method == "rotation_diffs":
+        return sync_rotation_diffs(vio.t, vio.r, tracker.t, tracker.r, precision_ms=precision_ms, workers=workers)
+    return sync_rotation_speeds(
+        vio.t, vio.r, tracker.t, tracker.r, precision_ms, workers, tracker_signals=tracker_signals
+    )
+
+
+def aligned_poses(vio, M, scale, sync):
+    """Device poses transformed into tracking space with transform M (from fit_device_to_tracker), and synced"""
+    data = Poses()
+    data.t = vio.t + sync
+    data.p = M[:3, :3] @ vio.p + M[:3, 3:4]
+    data.r = np.einsum("ij,jkn->ikn", M[:3, :3] / scale, vio.r)
+    return data
+
+
+def tracker_stages(cache, tracker_input, cache_dir, tracker_stride=1000, tracker_rate=None):
+    """Downsampled (or resampled) and rebased tracker data, returns (stage key, Poses)"""
+    # Tracker input can be JSONL, a binary pose store (directory) or binary tracker records
+    if os.path.isdir(tracker_input):
+        tracker_digest = stage_key("tracker_store", {}, *[
+            file_digest(os.path.join(tracker_input, name), cache_dir) for name in sorted(os.listdir(tracker_input))
+        ])
+    else:
+        tracker_digest = file_digest(tracker_input, cache_dir)
+    def downsample():
+        if tracker_rate is not None:
+            return resample_uniform(rebased(load_pose_file(tracker_input)), tracker_rate)
+        return rebased(load_pose_file(tracker_input, stride=tracker_stride))
+    tracker_parameters = {"stride": tracker_stride} if tracker_rate is None else {"rate": tracker_rate}
+    tracker_key = stage_key("tracker", tracker_parameters, tracker_digest)
+    return tracker_key, cache.poses(tracker_key, downsample)
+
+
+def vio_stages(cache, device_input, device_digest):
+    """VIO poses extracted from raw device data and rebased, returns (stage key, Poses)"""
+    def extract():
+        with open(device_input, "rb") as f:
+            return load_vio_poses(f)
+    vio_key = stage_key("vio", {}, device_digest)
+    vio = cache.poses(vio_key, extract)
+
+    rebased_vio_key = stage_key("rebased_vio", {}, vio_key)
+    return rebased_vio_key, cache.poses(rebased_vio_key, lambda: rebased(vio))
+
+
+def sync_stages(
+    cache,
+    vio_key,
+    vio,
+    tracker_key,
+    tracker,
+    sync_method="movement_speeds",
+    sync_precision_ms=None,
+    with_scale=False,
+    workers=1,
+    tracker_signals=None,
+):
+    """Sync and align stages of one device, returns 'aligned' Poses and 'sync' and 'align' results"""
+    sync_parameters = {"method": sync_method, "precision_ms": sync_precision_ms}
+    sync_key = stage_key("sync", sync_parameters, vio_key, tracker_key)
+    sync_result = cache.result(sync_key, lambda: {
+        "sync": float(find_sync(sync_method, vio, tracker, sync_precision_ms, workers, tracker_signals))
+    })
+
+    def align():
+        M, scale, rms = fit_device_to_tracker(vio.t, vio.p, tracker.t, tracker.p, sync_result["sync"], with_scale)
+        return {"transform": M.tolist(), "scale": float(scale), "rms": float(rms)}
+    align_key = stage_key("align", {"with_scale": with_scale}, sync_key)
+    align_result = cache.result(align_key, align)
+
+    aligned_key = stage_key("aligned", {}, align_key)
+    aligned = cache.poses(aligned_key, lambda: aligned_poses(
+        vio, np.array(align_result["transform"]), align_result["scale"], sync_result["sync"]
+    ))
+    return {
+        "aligned": aligned,
+        "sync": sync_result,
+        "align": align_result,
+    }
+
+
+def run_pipeline(
+    device_input,
+    tracker_input,
+    cache_dir,
+    tracker_stride=1000,
+    tracker_rate=None,
+    sync_method="movement_speeds",
+    sync_precision_ms=None,
+    with_scale=False,
+    workers=1,
+):
+    """
+    Run all stages (see top of the file), returns (cache, outputs) where outputs has
+    'vio', 'tracker' and 'aligned' Poses and the 'sync' and 'align' results.
+    Tracker data is downsampled by keeping every tracker_stride'th sample, or with tracker_rate,
+    by resampling (interpolating) it to a uniform grid of tracker_rate samples per second.
+    """
+    cache = StageCache(cache_dir)
+    vio_key, vio = vio_stages(cache, device_input, file_digest(device_input, cache_dir))
+    tracker_key, tracker = tracker_stages(cache, tracker_input, cache_dir, tracker_stride, tracker_rate)
+    outputs = sync_stages(
+        cache, vio_key, vio, tracker_key, tracker, sync_method, sync_precision_ms, with_scale, workers
+    )
+    return cache, dict(outputs, vio=vio, tracker=tracker)
+
+
+# Batch mode: tracker data and its per-step sync signals are shared by all devices. With several device workers,
+# each worker process receives them once (initializer), not once per device.
+_batch_tracker = None
+
+
+def _set_batch_tracker(tracker_key, tracker, tracker_signals):
+    global _batch_tracker
+    _batch_tracker = (tracker_key, tracker, tracker_signals)
+
+
+def _run_device_stages(task):
+    device_input, device_digest, cache_dir, options = task
+    tracker_key, tracker, tracker_signals = _batch_tracker
+    cache = StageCache(cache_dir)
+    vio_key, vio = vio_stages(cache, device_input, device_digest)
+    outputs = sync_stages(cache, vio_key, vio, tracker_key, tracker, tracker_signals=tracker_signals, **options)
+    return cache.computed, dict(outputs, vio=vio)
+
+
+def run_batch(
+    device_inputs,
+    tracker_input,
+    cache_dir,
+    tracker_stride=1000,
+    tracker_rate=None,
+    sync_method="movement_speeds",
+    sync_precision_ms=None,
+    with_scale=False,
+    workers=1,
+    device_workers=1,
+):
+    """
+    Run the pipeline for many devices against the same tracker data, which is loaded (and downsampled) once.
+    Devices are processed in device_workers processes. Returns (cache, tracker Poses, outputs of each device),
+    with the names of the stages that were computed for each device in the outputs' 'computed'.
+    """
+    cache = StageCache(cache_dir)
+    tracker_key, tracker = tracker_stages(cache, tracker_input, cache_dir, tracker_stride, tracker_rate)
+    tracker_signals = tracker_step_signals(tracker.p, tracker.r) \
+        if sync_method in ["speed_correlation", "rotation_speeds"] else None
+    # Note: file digests are computed here, not in the workers, which would all rewrite the same digest file
+    tasks = [
+        (device_input, file_digest(device_input, cache_dir), cache_dir, dict(
+            sync_method=sync_method, sync_precision_ms=sync_precision_ms, with_scale=with_scale, workers=workers
+        ))
+        for device_input in device_inputs
+    ]
+    _set_batch_tracker(tracker_key, tracker, tracker_signals)
+    if device_workers > 1:
+        with ProcessPoolExecutor(
+            device_workers, initializer=_set_batch_tracker, initargs=(tracker_key, tracker, tracker_signals)
+        ) as executor:
+            results = list(executor.map(_run_device_stages, tasks))
+    else:
+        results = [_run_device_stages(task) for task in tasks]
+    return cache, tracker, [dict(outputs, computed=computed) for computed, outputs in results]
+
+
+def device_output_names(device_inputs):
+    """Output directory names for devices: input file names without extension, or with their index if not unique"""
+    names = [os.path.splitext(os.path.basename(path))[0] for path in device_inputs]
+    if len(set(names)) < len(names):
+        names = ["{}_{}".format(i, name) for i, name in enumerate(names)]
+    return names
+
+
+def batch_summary(device_inputs, tracker, outputs):
+    """Summary rows of batch results: sync, alignment error and ATE against the tracker data for each device"""
+    rows = []
+    for name, device_input, output in zip(device_output_names(device_inputs), device_inputs, outputs):
+        ate = evaluate(tracker, output["aligned"], deltas=[])["ate"]
+        rows.append({
+            "name": name,
+            "device_input": device_input,
+            "sync": output["sync"]["sync"],
+            "rms": output["align"]["rms"],
+            "scale": output["align"]["scale"],
+            "ate_rmse": ate.get("rmse"),
+        })
+    return rows
+
+
+def print_summary(rows):
+    print("{:<24} {:>10} {:>10} {:>8} {:>10}".format("device", "sync (s)", "rms (m)", "scale", "ATE (m)"))
+    for row in rows:
+        print("{:<24} {:>10.4f} {:>10.4f} {:>8.4f} {:>10}".format(
+            row["name"], row["sync"], row["rms"], row["scale"],
+            "-" if row["ate_rmse"] is None else "{:.4f}".format(row["ate_rmse"]),
+        ))
+
+
+def write_device_outputs(outputs, output_dir):
+    # Pose stores can be given to the plot scripts (and anything else using load_pose_file) directly
+    os.makedirs(output_dir, exist_ok=True)
+    for name, store_name in [
+        ("vio", "device_camera_matrices.poses"),
+        ("aligned", "final_device_data.poses"),
+    ]:
+        save_pose_store(outputs[name], os.path.join(output_dir, store_name))
+    write_tracker_format(outputs["aligned"], os.path.join(output_dir, "final_device_data.jsonl"))
+    with open(os.path.join(output_dir, "result.json"), "w") as f:
+        json.dump({"sync": outputs["sync"]["sync"], **outputs["align"]}, f, indent=2)
+
+
+def write_tracker_format(poses, path):
+    """Write poses as JSONL in the tracker data format (like align_trajectories.py output)"""
+    with open(path, "w") as f:
+        for i in range(len(poses.t)):
+            f.write(json.dumps({
+                "time": float(poses.t[i]),
+                "position": {"x": float(poses.p[0, i]), "y": float(poses.p[1, i]), "z": float(poses.p[2, i])},
+                "rotation": {"col" + str(c): poses.r[:, c, i].tolist() for c in range(3)},
+            }) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--device_input",
+        dest="device_input",
+        action="append",
+        help="Raw android-viotester data (JSONL) of the device. Give many times to sync several devices against the "
+        "same tracker data, with outputs in <output_dir>/<device file name>/",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--tracker_input",
+        dest="tracker_input",
+        help="Tracker data (JSONL, pose store or binary tracker records)",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        dest="output_dir",
+        help="Output directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        help="Directory for cached stage outputs (default: <output_dir>/cache)",
+    )
+    parser.add_argument(
+        "--tracker_stride",
+        dest="tracker_stride",
+        help="Only use every Nth sample of the tracker data",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--tracker_rate",
+        dest="tracker_rate",
+        help="Resample tracker data to this many samples per second (interpolating), instead of --tracker_stride",
+        type=float,
+    )
+    parser.add_argument(
+        "--sync_method",
+        dest="sync_method",
+        help="Sync method",
+        choices=SYNC_METHODS,
+        default="movement_speeds",
+    )
+    parser.add_argument(
+        "--sync_precision_ms",
+        dest="sync_precision_ms",
+        help="Search sync coarse-to-fine down to this precision (milliseconds), instead of a fixed grid of sync candidates",
+        type=float,
+    )
+    parser.add_argument(
+        "--with_scale",
+        dest="with_scale",
+        help="Also fit scale between device and tracking space (similarity instead of rigid transform)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of worker processes for evaluating sync candidates",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--device_workers",
+        dest="device_workers",
+        help="Number of worker processes for processing devices in parallel (with several --device_input)",
+        type=int,
+        default=1,
+    )
+    args = parser.parse_args()
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.join(args.output_dir, "cache")
+    options = dict(
+        tracker_stride=args.tracker_stride,
+        tracker_rate=args.tracker_rate,
+        sync_method=args.sync_method,
+        sync_precision_ms=args.sync_precision_ms,
+        with_scale=args.with_scale,
+        workers=args.workers,
+    )
+    if len(args.device_input) == 1:
+        cache, outputs = run_pipeline(args.device_input[0], args.tracker_input, cache_dir, **options)
+        save_pose_store(outputs["tracker"], os.path.join(args.output_dir, "tracker_downsampled.poses"))
+        write_device_outputs(outputs, args.output_dir)
+        print("Optimal sync:", outputs["sync"]["sync"])
+        print("Optimal sync error:", outputs["align"]["rms"])
+    else:
+        cache, tracker, outputs = run_batch(
+            args.device_input, args.tracker_input, cache_dir, device_workers=args.device_workers, **options
+        )
+        save_pose_store(tracker, os.path.join(args.output_dir, "tracker_downsampled.poses"))
+        for name, device_outputs in zip(device_output_names(args.device_input), outputs):
+            write_device_outputs(device_outputs, os.path.join(args.output_dir, name))
+        summary = batch_summary(args.device_input, tracker, outputs)
+        with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        print_summary(summary)
+
+
+def test_run_pipeline(tmp_path):
+    from synthetic import generate
+
+    truth = generate(str(tmp_path / "data"), duration=20.0, sync=2.0, tracker_rate=500.0, seed=2)
+    device_input = str(tmp_path / "data" / "vio.jsonl")
+    tracker_input = str(tmp_path / "data" / "tracker.jsonl")
+    cache_dir = str(tmp_path / "cache")
+
+    cache, outputs = run_pipeline(device_input, tracker_input, cache_dir, tracker_stride=5)
+    assert cache.computed == ["vio", "rebased_vio", "tracker", "sync", "align", "aligned"]
+    assert abs(outputs["sync"]["sync"] - truth["sync"]) < 0.05
+    assert outputs["vio"].t[0] == 0.0 and outputs["tracker"].t[0] == 0.0
+
+    cache, cached_outputs = run_pipeline(device_input, tracker_input, cache_dir, tracker_stride=5)
+    assert cache.computed == []
+    assert (cached_outputs["aligned"].p == outputs["aligned"].p).all()
+
+    # Only the stages depending on the changed parameter are recomputed
+    cache, _ = run_pipeline(device_input, tracker_input, cache_dir, tracker_stride=5, with_scale=True)
+    assert cache.computed == ["align", "aligned"]
+    cache, _ = run_pipeline(device_input, tracker_input, cache_dir, tracker_stride=4)
+    assert cache.computed == ["tracker", "sync", "align", "aligned"]
+    cache, resampled_outputs = run_pipeline(device_input, tracker_input, cache_dir, tracker_rate=100.0)
+    assert cache.computed == ["tracker", "sync", "align", "aligned"]
+    assert np.allclose(np.diff(resampled_outputs["tracker"].t), 0.01)
+    assert abs(resampled_outputs["sync"]["sync"] - truth["sync"]) < 0.05
+
+    # Changed input content is noticed, even with the same size
+    with open(device_input, "r+b") as f:
+        f.seek(-3, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-3, os.SEEK_END)
+        f.write(b"1" if last != b"1" else b"2")
+    cache, _ = run_pipeline(device_input, tracker_input, cache_dir, tracker_stride=5)
+    assert cache.computed[0] == "vio"
+
+
+def test_run_batch(tmp_path):
+    from synthetic import generate
+
+    truth = generate(str(tmp_path / "data"), duration=20.0, sync=2.0, tracker_rate=500.0, seed=4)
+    tracker_input = str(tmp_path / "data" / "tracker.jsonl")
+    # Second device: the same recording, starting 3 seconds later
+    device_inputs = [str(tmp_path / "data" / "vio.jsonl"), str(tmp_path / "late.jsonl")]
+    with open(device_inputs[0]) as f, open(device_inputs[1], "w") as late:
+        lines = f.readlines()
+        t0 = next(json.loads(line)["time"] for line in lines if line.startswith('{"arcore"'))
+        late_lines = [line for line in lines if json.loads(line)["time"] >= t0 + 3.0]
+        late.writelines(late_lines)
+        late_t0 = next(json.loads(line)["time"] for line in late_lines if line.startswith('{"arcore"'))
+    cache_dir = str(tmp_path / "cache")
+
+    for device_workers in [1, 2]:
+        cache, tracker, outputs = run_batch(
+            device_inputs, tracker_input, cache_dir, tracker_stride=5, sync_method="speed_correlation",
+            device_workers=device_workers,
+        )
+        assert len(outputs) == 2
+        assert abs(outputs[0]["sync"]["sync"] - truth["sync"]) < 0.05
+        assert abs(outputs[1]["sync"]["sync"] - truth["sync"] - (late_t0 - t0)) < 0.05
+    # Tracker stages once, device stages per device; cached on the second run
+    assert cache.computed == []
+    assert [output["computed"] for output in outputs] == [[], []]
+
+    rows = batch_summary(device_inputs, tracker, outputs)
+    assert [row["name"] for row in rows] == ["vio", "late"]
+    assert all(row["ate_rmse"] < 0.05 for row in rows)
+    assert device_output_names(["a/vio.jsonl", "b/vio.jsonl"]) == ["0_vio", "1_vio"]
+
+
+def test_batch_summary_default_settings(tmp_path):
+    from synthetic import generate
+
+    # Default tracker_stride keeps about one sample per second of 1kHz tracker data
+    generate(str(tmp_path / "data"), duration=30.0, sync=2.0, tracker_rate=1000.0, seed=5)
+    device_inputs = [str(tmp_path / "data" / "vio.jsonl")] * 2
+    cache, tracker, outputs = run_batch(device_inputs, str(tmp_path / "data" / "tracker.jsonl"), str(tmp_path / "cache"))
+    rows = batch_summary(device_inputs, tracker, outputs)
+    assert all(row["ate_rmse"] is not None for row in rows)
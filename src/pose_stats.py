@@ -0,0 +1,287 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import numpy as np
+from poses import (
+    Poses, TRACKER_RECORD_DTYPE, TRACKER_RECORD_SUFFIX, is_pose_store_up_to_date, load_pose_store, load_poses,
+    load_tracker_data, pose_store_path, tracker_records_to_poses
+)
+
+# Statistics of a tracker or VIO recording in one pass with constant memory, for checking (possibly multi-GB)
+# recordings before syncing them: sampling intervals, duplicated timestamps, gaps, speeds, angular speeds and
+# path length. Poses are read in chunks (JSONL lines, or slices of a memory-mapped pose store or binary tracker
+# records), and the distributions are collected into fixed log-spaced histograms, so percentiles are
+# approximate (within a fraction of a bin, about 2%).
+STATS_CHUNK_ROWS = 1 << 16
+HISTOGRAM_BINS_PER_DECADE = 50
+LARGEST_GAPS = 10
+
+
+def pose_chunks(path, pose_name=None, tracker=None, chunk_rows=STATS_CHUNK_ROWS):
+    """Yield Poses of consecutive parts of a pose file (JSONL, pose store or binary tracker records)"""
+    if path.endswith(TRACKER_RECORD_SUFFIX):
+        records = np.memmap(path, dtype=TRACKER_RECORD_DTYPE, mode="r") if os.path.getsize(path) > 0 \
+            else np.zeros(0, dtype=TRACKER_RECORD_DTYPE)
+        for start in range(0, len(records), chunk_rows):
+            chunk = records[start : start + chunk_rows]
+            yield tracker_records_to_poses(chunk if tracker is None else chunk[chunk["tracker"] == tracker])
+        return
+    store_path = path if os.path.isdir(path) else pose_store_path(path, pose_name)
+    if os.path.isdir(path) or is_pose_store_up_to_date(store_path, path):
+        store = load_pose_store(store_path)
+        for start in range(0, len(store.t), chunk_rows):
+            chunk = Poses()
+            chunk.t = np.asarray(store.t[start : start + chunk_rows])
+            chunk.p = np.asarray(store.p[:, start : start + chunk_rows])
+            chunk.r = np.asarray(store.r[:, :, start : start + chunk_rows])
+            yield chunk
+        return
+    with open(path, "r") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                break
+            yield load_tracker_data(lines) if pose_name is None else load_poses(lines, pose_name)
+
+
+class LogHistogram:
+    """Counts of positive values in log-spaced bins from low to high (values outside go to the first or last bin)"""
+
+    def __init__(self, low, high, bins_per_decade=HISTOGRAM_BINS_PER_DECADE):
+        n_bins = int(round(np.log10(high / low) * bins_per_decade))
+        self.edges = np.logspace(np.log10(low), np.log10(high), n_bins + 1)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+
+    def add(self, values):
+        bins = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def percentiles(self, qs):
+        """Approximate percentiles (qs in 0...100), interpolated geometrically within bins"""
+        cumulative = np.cumsum(self.counts)
+        if cumulative[-1] == 0:
+            return [None] * len(qs)
+        results = []
+        for q in qs:
+            rank = q / 100.0 * cumulative[-1]
+            i = min(np.searchsorted(cumulative, rank, side="left"), len(self.counts) - 1)
+            before = cumulative[i - 1] if i > 0 else 0
+            u = (rank - before) / self.counts[i] if self.counts[i] > 0 else 0.0
+            results.append(float(self.edges[i] * (self.edges[i + 1] / self.edges[i]) ** np.clip(u, 0.0, 1.0)))
+        return results
+
+    def nonzero_bins(self):
+        """(low edge, high edge, count) of the bins with values"""
+        return [
+            (float(self.edges[i]), float(self.edges[i + 1]), int(self.counts[i]))
+            for i in np.flatnonzero(self.counts)
+        ]
+
+
+class TrajectoryStats:
+    """Statistics accumulated over consecutive chunks of Poses, with the previous sample carried between chunks"""
+
+    def __init__(self, gap_seconds=0.1):
+        self.gap_seconds = gap_seconds
+        self.n = 0
+        self.t_first = None
+        self.t_last = None
+        self.previous = None  # (t, p, r) of the last sample
+        self.duplicate_times = 0
+        self.backwards_times = 0
+        self.zero_poses = 0
+        self.path_length = 0.0
+        self.total_rotation = 0.0
+        self.gaps = 0
+        self.gap_time = 0.0
+        self.largest_gaps = []  # Heap of (gap, time)
+        self.intervals = LogHistogram(1e-6, 1e2)
+        self.speeds = LogHistogram(1e-6, 1e3)
+        self.angular_speeds = LogHistogram(1e-6, 1e4)
+
+    def add(self, poses):
+        n = len(poses.t)
+        if n == 0:
+            return
+        t, p, r = np.asarray(poses.t, dtype=float), np.asarray(poses.p, dtype=float), np.asarray(poses.r, dtype=float)
+        if self.previous is not None:
+            t0, p0, r0 = self.previous
+            t = np.concatenate([[t0], t])
+            p = np.concatenate([p0[:, np.newaxis], p], axis=1)
+            r = np.concatenate([r0[:, :, np.newaxis], r], axis=2)
+        else:
+            self.t_first = float(t[0])
+        self.previous = (t[-1], p[:, -1], r[:, :, -1])
+        self.t_last = float(t[-1])
+        self.n += n
+        zero = (p == 0.0).all(axis=0)
+        self.zero_poses += int(zero[-n:].sum())
+
+        dt = np.diff(t)
+        self.duplicate_times += int((dt == 0.0).sum())
+        self.backwards_times += int((dt < 0.0).sum())
+        forward = dt > 0.0
+        self.intervals.add(dt[forward])
+        gap = dt > self.gap_seconds
+        self.gaps += int(gap.sum())
+        self.gap_time += float(dt[gap].sum())
+        for i in np.flatnonzero(gap):
+            heapq.heappush(self.largest_gaps, (float(dt[i]), float(t[i])))
+            if len(self.largest_gaps) > LARGEST_GAPS:
+                heapq.heappop(self.largest_gaps)
+
+        # Steps between tracked (non-zero) poses only; lost tracking would show as huge jumps
+        tracked = ~zero[:-1] & ~zero[1:]
+        distances = np.linalg.norm(np.diff(p, axis=1), axis=0)
+        # Angle of the relative rotation R0^T R1, from its trace
+        traces = np.einsum("jin,jin->n", r[:, :, :-1], r[:, :, 1:])
+        angles = np.arccos(np.clip((traces - 1.0) / 2.0, -1.0, 1.0))
+        has_rotations = (r != 0.0).any(axis=(0, 1))
+        rotated = tracked & has_rotations[:-1] & has_rotations[1:]
+        self.path_length += float(distances[tracked].sum())
+        self.total_rotation += float(angles[rotated].sum())
+        self.speeds.add(distances[tracked & forward] / dt[tracked & forward])
+        self.angular_speeds.add(angles[rotated & forward] / dt[rotated & forward])
+
+    def report(self, percentiles=(1, 5, 50, 95, 99, 100)):
+        duration = self.t_last - self.t_first if self.n > 0 else 0.0
+        interval_percentiles = self.intervals.percentiles([50])
+        return {
+            "samples": self.n,
+            "start_time": self.t_first,
+            "end_time": self.t_last,
+            "duration": duration,
+            "mean_rate": (self.n - 1) / duration if duration > 0 else None,
+            "median_rate": 1.0 / interval_percentiles[0] if interval_percentiles[0] else None,
+            "duplicate_timestamps": self.duplicate_times,
+            "backwards_timestamps": self.backwards_times,
+            "zero_poses": self.zero_poses,
+            "gaps": self.gaps,
+            "gap_time": self.gap_time,
+            "largest_gaps": [{"time": t, "gap": gap} for gap, t in sorted(self.largest_gaps, reverse=True)],
+            "path_length": self.path_length,
+            "total_rotation": self.total_rotation,
+            "speed_percentiles": dict(zip(map(str, percentiles), self.speeds.percentiles(percentiles))),
+            "angular_speed_percentiles": dict(zip(map(str, percentiles), self.angular_speeds.percentiles(percentiles))),
+            # Sampling rates (1 / interval) of the intervals between samples
+            "rate_histogram": [
+                {"min_rate": 1.0 / high, "max_rate": 1.0 / low, "intervals": count}
+                for low, high, count in self.intervals.nonzero_bins()
+            ],
+        }
+
+
+def trajectory_stats(path, pose_name=None, tracker=None, gap_seconds=0.1, chunk_rows=STATS_CHUNK_ROWS):
+    stats = TrajectoryStats(gap_seconds)
+    for chunk in pose_chunks(path, pose_name, tracker, chunk_rows):
+        stats.add(chunk)
+    return stats.report()
+
+
+def print_report(path, report):
+    print(path)
+    if report["samples"] == 0:
+        print("  no samples")
+        return
+    print("  {} samples, {:.3f}s ({} ... {})".format(
+        report["samples"], report["duration"], report["start_time"], report["end_time"]
+    ))
+    if report["mean_rate"] is not None:
+        print("  rate: mean {:.1f}Hz, median {:.1f}Hz".format(report["mean_rate"], report["median_rate"] or 0.0))
+    print("  timestamps: {} duplicated, {} backwards; {} zero poses".format(
+        report["duplicate_timestamps"], report["backwards_timestamps"], report["zero_poses"]
+    ))
+    print("  gaps: {} ({:.3f}s in total)".format(report["gaps"], report["gap_time"]))
+    for gap in report["largest_gaps"]:
+        print("    {:.3f}s at t={}".format(gap["gap"], gap["time"]))
+    print("  path length {:.3f}m, total rotation {:.1f}rad".format(report["path_length"], report["total_rotation"]))
+    for name, unit in [("speed_percentiles", "m/s"), ("angular_speed_percentiles", "rad/s")]:
+        print("  {}: {}".format(name.replace("_", " "), ", ".join(
+            "p{}={}".format(q, "-" if v is None else "{:.4g}{}".format(v, unit)) for q, v in report[name].items()
+        )))
+    print("  sampling rates:")
+    for bin in report["rate_histogram"]:
+        print("    {:10.1f}...{:10.1f}Hz {:10d}".format(bin["min_rate"], bin["max_rate"], bin["intervals"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        action="append",
+        help="Input tracker or VIO pose data (JSONL, pose store or binary tracker records)",
+        required=True,
+    )
+    parser.add_argument(
+        "--pose_name",
+        dest="pose_name",
+        help="Name of pose to use in VIO data (VIO_pose, tag_space_pose...). Leave out for tracker data.",
+    )
+    parser.add_argument(
+        "--tracker",
+        dest="tracker",
+        help="Only use this tracker's records in binary tracker records",
+        type=int,
+    )
+    parser.add_argument(
+        "--gap",
+        dest="gap",
+        help="Intervals between samples longer than this (seconds) count as gaps",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--json",
+        dest="json",
+        help="Output file for the statistics of all inputs as JSON",
+    )
+    args = parser.parse_args()
+    reports = {}
+    for path in args.input:
+        reports[path] = trajectory_stats(path, args.pose_name, args.tracker, args.gap)
+        print_report(path, reports[path])
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+def test_log_histogram():
+    histogram = LogHistogram(1e-3, 1e3)
+    values = np.random.default_rng(0).uniform(1.0, 2.0, 10000)
+    histogram.add(values)
+    assert histogram.total() == 10000
+    for q, value in zip([1, 50, 99], histogram.percentiles([1, 50, 99])):
+        assert abs(value / np.percentile(values, q) - 1.0) < 0.01
+
+
+def test_trajectory_stats(tmp_path):
+    from poses import save_pose_store
+
+    # 100Hz circle with 1m radius, 1 rad/s, with a duplicated timestamp, a gap and a lost tracking sample
+    t = np.arange(2000) / 100.0
+    t = np.concatenate([t[:500], t[499:1000], t[1050:]])
+    poses = Poses()
+    poses.t = t
+    poses.p = np.stack([np.cos(t), np.sin(t), 0 * t])
+    poses.r = np.array([[np.cos(t), -np.sin(t), 0 * t], [np.sin(t), np.cos(t), 0 * t], [0 * t, 0 * t, 1 + 0 * t]])
+    poses.p[:, 1500] = 0.0
+    save_pose_store(poses, str(tmp_path / "circle.poses"))
+
+    for chunk_rows in [STATS_CHUNK_ROWS, 333]:
+        report = trajectory_stats(str(tmp_path / "circle.poses"), chunk_rows=chunk_rows)
+        assert report["samples"] == len(t) and report["duration"] == t[-1]
+        assert report["duplicate_timestamps"] == 1 and report["zero_poses"] == 1
+        assert report["gaps"] == 1 and report["largest_gaps"] == [{"time": t[1000], "gap": t[1001] - t[1000]}]
+        assert abs(report["median_rate"] / 100.0 - 1.0) < 0.05
+        # Straight across the gap, without the steps to and from the zero pose
+        assert abs(report["path_length"] - (t[-1] - 0.51 + 2 * np.sin(0.255) - 0.02)) < 1e-3
+        assert abs(report["speed_percentiles"]["50"] - 1.0) < 0.03
+        assert abs(report["angular_speed_percentiles"]["50"] - 1.0) < 0.03
+        assert sum(b["intervals"] for b in report["rate_histogram"]) == len(t) - 2
@@ -1,5 +1,7 @@
 import numpy as np
 import json
+import os
+import itertools
 
 # _to_camera_matrices stuff?
 
@@ -10,44 +12,297 @@ class Poses:
         self.r = np.array(None)  # Rotations (3x3xN matrix)
 
 
-def load_poses(lines, pose_name):
-    lines = list(lines)
-    n = len(lines)
+# Lines are parsed in chunks into one growable (N x 13) row buffer:
+# time, position x/y/z and the rotation matrix columns (col0, col1, col2).
+# The Poses arrays are views into that buffer, so peak memory is roughly the size
+# of the output arrays, instead of holding every raw line in memory too.
+LOAD_CHUNK_LINES = 8192
+ROW_SIZE = 13
+
+
+def _pose_row(j, pose_name):
+    pose = j[pose_name]
+    assert len(pose) == 3 and all(len(row) == 4 for row in pose)
+    return (
+        j["time"],
+        pose[0][3], pose[1][3], pose[2][3],
+        pose[0][0], pose[1][0], pose[2][0],
+        pose[0][1], pose[1][1], pose[2][1],
+        pose[0][2], pose[1][2], pose[2][2],
+    )
+
+
+def _tracker_row(j):
+    position = j["position"]
+    if "rotation" in j:
+        rotation = j["rotation"]
+        return (j["time"], position["x"], position["y"], position["z"],
+                *rotation["col0"], *rotation["col1"], *rotation["col2"])
+    return (j["time"], position["x"], position["y"], position["z"]) + (0.0,) * 9
+
+
+def _rows_to_poses(rows):
     data = Poses()
-    data.t = np.zeros(n)
-    data.p = np.zeros((3, n))
-    data.r = np.zeros((3, 3, n))
-    for i, line in enumerate(lines):
-        j = json.loads(line)
-        data.t[i] = j["time"]
-
-        pose = np.array(j[pose_name])
-        assert pose.shape == (3, 4)
-
-        data.p[:, i] = pose[:, 3]
-        data.r[:, :, i] = pose[0:3, 0:3]
+    data.t = rows[:, 0]
+    data.p = rows[:, 1:4].T
+    # Columns are stored one after another, so rows[i, 4:] reshaped is [column][row]
+    data.r = rows[:, 4:].reshape(-1, 3, 3).transpose(2, 1, 0)
     return data
 
 
+def _load_rows(lines, parse_row, max_rows=None, t_start=None, t_end=None, stride=1):
+    """
+    Parse JSONL lines into pose rows, keeping only rows with t_start <= time < t_end,
+    then every stride'th of those rows, and at most max_rows rows.
+    """
+    assert stride >= 1
+    has_window = t_start is not None or t_end is not None
+    rows = np.empty((1024, ROW_SIZE))
+    n = 0
+    i_selectable = 0  # Index of the row among rows that passed the time window
+    while True:
+        chunk = list(itertools.islice(lines, LOAD_CHUNK_LINES))
+        if not chunk:
+            break
+        chunk_rows = []
+        for line in chunk:
+            # Without a time window, skip unselected lines before parsing them
+            if not has_window:
+                i_selectable += 1
+                if (i_selectable - 1) % stride != 0:
+                    continue
+            row = parse_row(json.loads(line))
+            if has_window:
+                if (t_start is not None and row[0] < t_start) or (t_end is not None and row[0] >= t_end):
+                    continue
+                i_selectable += 1
+                if (i_selectable - 1) % stride != 0:
+                    continue
+            chunk_rows.append(row)
+        del chunk
+        if max_rows is not None:
+            chunk_rows = chunk_rows[: max_rows - n]
+        if not chunk_rows:
+            if max_rows is not None and n >= max_rows:
+                break
+            continue
+        k = len(chunk_rows)
+        if n + k > rows.shape[0]:
+            rows.resize((max(n + k, rows.shape[0] * 3 // 2), ROW_SIZE), refcheck=False)
+        rows[n : n + k] = chunk_rows
+        n += k
+        if max_rows is not None and n >= max_rows:
+            break
+    rows.resize((n, ROW_SIZE), refcheck=False)
+    return rows
+
+
+def load_poses(lines, pose_name, max_rows=None, t_start=None, t_end=None, stride=1):
+    rows = _load_rows(
+        iter(lines), lambda j: _pose_row(j, pose_name), max_rows, t_start, t_end, stride
+    )
+    return _rows_to_poses(rows)
+
+
 # Legacy format, should change format of tracker data so it is similar to VIO pose data, so it will be easier to handle both
-def load_tracker_data(lines):
-    lines = list(lines)
-    n = len(lines)
+def load_tracker_data(lines, max_rows=None, t_start=None, t_end=None, stride=1):
+    rows = _load_rows(iter(lines), _tracker_row, max_rows, t_start, t_end, stride)
+    return _rows_to_poses(rows)
+
+
+def select_poses(poses, max_rows=None, t_start=None, t_end=None, stride=1):
+    """Same row selection as the loaders, for already loaded poses (e.g. a memory-mapped pose store)"""
+    if t_start is None and t_end is None:
+        indices = slice(0, max_rows * stride if max_rows is not None else None, stride)
+    else:
+        in_window = np.ones(len(poses.t), dtype=bool)
+        if t_start is not None:
+            in_window &= poses.t >= t_start
+        if t_end is not None:
+            in_window &= poses.t < t_end
+        indices = np.nonzero(in_window)[0][::stride][:max_rows]
+    data = Poses()
+    data.t = poses.t[indices]
+    data.p = poses.p[:, indices]
+    data.r = poses.r[:, :, indices]
+    return data
+
+
+# Binary pose store: a directory with one .npy file per Poses array (t.npy, p.npy, r.npy).
+# The arrays are memory-mapped when loading, so opening a store is (almost) free
+# regardless of the recording length, and only the parts that are used are read from disk.
+POSE_STORE_COLUMNS = ("t", "p", "r")
+
+
+def pose_store_path(jsonl_path, pose_name=None):
+    """
+    Default location of the binary pose store converted from a JSONL file.
+    VIO files can hold several poses (VIO_pose, tag_space_pose...), so the pose name is part of the path.
+    """
+    if pose_name is None:
+        return jsonl_path + ".poses"
+    return "{}.{}.poses".format(jsonl_path, pose_name)
+
+
+def save_pose_store(poses, path):
+    os.makedirs(path, exist_ok=True)
+    for column in POSE_STORE_COLUMNS:
+        np.save(os.path.join(path, column + ".npy"), np.ascontiguousarray(getattr(poses, column)))
+
+
+def load_pose_store(path, mmap=True):
+    # Copy-on-write mapping, so callers can still modify the arrays in place
+    # (e.g. 'poses.t -= poses.t[0]') without touching the file
+    mmap_mode = "c" if mmap else None
     data = Poses()
-    data.t = np.zeros(n)
-    data.p = np.zeros((3, n))
-    data.r = np.zeros((3, 3, n))
-    for i, line in enumerate(lines):
-        j = json.loads(line)
-        data.t[i] = j["time"]
-        data.p[:, i] = [
-            j["position"]["x"],
-            j["position"]["y"],
-            j["position"]["z"],
-        ]
-        if "rotation" in j:
-            data.r[:, 0, i] = j["rotation"]["col0"]
-            data.r[:, 1, i] = j["rotation"]["col1"]
-            data.r[:, 2, i] = j["rotation"]["col2"]
+    for column in POSE_STORE_COLUMNS:
+        setattr(data, column, np.load(os.path.join(path, column + ".npy"), mmap_mode=mmap_mode))
     return data
 
+
+def is_pose_store_up_to_date(store_path, jsonl_path):
+    if not os.path.isdir(store_path):
+        return False
+    if not os.path.exists(jsonl_path):
+        return True
+    store_mtime = min(
+        os.path.getmtime(os.path.join(store_path, column + ".npy"))
+        for column in POSE_STORE_COLUMNS
+    )
+    return store_mtime >= os.path.getmtime(jsonl_path)
+
+
+# Binary tracker records, written by 'record_tracker_data.py --binary': fixed-size records of
+# time, tracker (device index) and the raw 3x4 pose matrix (OpenVR matrices are float32 anyway).
+TRACKER_RECORD_DTYPE = np.dtype([("time", "<f8"), ("tracker", "<u4"), ("m", "<f4", (3, 4))])
+TRACKER_RECORD_SUFFIX = ".trackerbin"
+
+
+def tracker_records_to_poses(records):
+    data = Poses()
+    data.t = records["time"].astype(np.float64)
+    m = records["m"].astype(np.float64)
+    data.p = m[:, :, 3].T
+    # Same layout as the JSONL tracker data, where "colN" is m[N][:3]
+    data.r = m[:, :, :3].transpose(2, 1, 0)
+    return data
+
+
+def load_tracker_records(path, tracker=None, **selection):
+    """Load binary tracker records (optionally only one tracker's), selecting rows as in load_poses()"""
+    records = np.memmap(path, dtype=TRACKER_RECORD_DTYPE, mode="r") if os.path.getsize(path) > 0 \
+        else np.zeros(0, dtype=TRACKER_RECORD_DTYPE)
+    if tracker is not None:
+        records = records[records["tracker"] == tracker]
+    poses = tracker_records_to_poses(records)
+    return select_poses(poses, **selection) if selection else poses
+
+
+def load_pose_file(path, pose_name=None, **selection):
+    """
+    Load poses from a tracker (pose_name=None) or VIO (pose_name given) JSONL file.
+    If the path is a pose store, or a converted pose store exists next to the JSONL file
+    and is newer than it, the binary store is used instead of parsing the JSONL.
+    Binary tracker records (TRACKER_RECORD_SUFFIX) are loaded with load_tracker_records().
+    Keyword arguments (max_rows, t_start, t_end, stride) select rows as in load_poses().
+    """
+    if path.endswith(TRACKER_RECORD_SUFFIX):
+        return load_tracker_records(path, **selection)
+    store_path = path if os.path.isdir(path) else pose_store_path(path, pose_name)
+    if os.path.isdir(path) or is_pose_store_up_to_date(store_path, path):
+        poses = load_pose_store(store_path)
+        return select_poses(poses, **selection) if selection else poses
+    with open(path, "r") as f:
+        if pose_name is None:
+            return load_tracker_data(f, **selection)
+        return load_poses(f, pose_name, **selection)
+
+
+def convert_to_pose_store(jsonl_path, pose_name=None, store_path=None):
+    """Parse a tracker or VIO JSONL file once, and save it as a binary pose store"""
+    if store_path is None:
+        store_path = pose_store_path(jsonl_path, pose_name)
+    with open(jsonl_path, "r") as f:
+        if pose_name is None:
+            poses = load_tracker_data(f)
+        else:
+            poses = load_poses(f, pose_name)
+    save_pose_store(poses, store_path)
+    return store_path
+
+
+def test_pose_store(tmp_path):
+    jsonl_path = str(tmp_path / "tracker.jsonl")
+    with open(jsonl_path, "w") as f:
+        for i in range(3):
+            j = {
+                "time": 0.5 * i,
+                "tracker": 1,
+                "position": {"x": float(i), "y": 2.0 * i, "z": 3.0 * i},
+                "rotation": {"col0": [1, 0, 0], "col1": [0, 1, 0], "col2": [0, 0, i]},
+            }
+            f.write(json.dumps(j) + "\n")
+    with open(jsonl_path, "r") as f:
+        expected = load_tracker_data(f)
+
+    store_path = convert_to_pose_store(jsonl_path)
+    assert store_path == jsonl_path + ".poses"
+    for loaded in [load_pose_file(jsonl_path), load_pose_file(store_path)]:
+        assert isinstance(loaded.t, np.memmap)
+        for column in POSE_STORE_COLUMNS:
+            assert (getattr(loaded, column) == getattr(expected, column)).all()
+        # Copy-on-write, the store itself is not modified
+        loaded.t -= loaded.t[0] + 1.0
+    assert (load_pose_file(jsonl_path).t == expected.t).all()
+
+
+def test_load_tracker_records(tmp_path):
+    path = str(tmp_path / ("tracker" + TRACKER_RECORD_SUFFIX))
+    records = np.zeros(6, dtype=TRACKER_RECORD_DTYPE)
+    records["time"] = np.arange(6) * 0.5
+    records["tracker"] = [1, 2, 1, 2, 1, 2]
+    records["m"] = [[[1, 0, 0, i], [0, 1, 0, 2 * i], [0, 0, 1, 3 * i]] for i in range(6)]
+    records["m"][:, 0, 1] = 0.5
+    records.tofile(path)
+    line = json.dumps({
+        "time": 0.0, "tracker": 1, "position": {"x": 0, "y": 0, "z": 0},
+        "rotation": {"col0": [1, 0.5, 0], "col1": [0, 1, 0], "col2": [0, 0, 1]},
+    })
+    expected = load_tracker_data([line])
+
+    loaded = load_pose_file(path)
+    assert loaded.t.shape == (6,)
+    assert (loaded.r[:, :, 0] == expected.r[:, :, 0]).all()
+    tracker_1 = load_tracker_records(path, tracker=1, stride=2)
+    assert (tracker_1.t == [0.0, 2.0]).all()
+    assert (tracker_1.p[:, 1] == [4, 8, 12]).all()
+
+
+def test_load_selection():
+    lines = [
+        json.dumps({"time": 0.1 * i, "VIO_pose": [[1, 0, 0, i], [0, 1, 0, 2 * i], [0, 0, 1, 3 * i]]})
+        for i in range(100)
+    ]
+    all_poses = load_poses(lines, "VIO_pose")
+    assert all_poses.t.shape == (100,)
+    assert all_poses.p.shape == (3, 100)
+    assert all_poses.r.shape == (3, 3, 100)
+    assert (all_poses.p[:, 7] == [7, 14, 21]).all()
+    assert (all_poses.r[:, :, 7] == np.identity(3)).all()
+
+    selections = [
+        dict(stride=10),
+        dict(max_rows=5),
+        dict(stride=3, max_rows=4),
+        dict(t_start=2.0, t_end=5.0),
+        dict(t_start=2.0, t_end=5.0, stride=7, max_rows=3),
+    ]
+    for selection in selections:
+        loaded = load_poses(iter(lines), "VIO_pose", **selection)
+        selected = select_poses(all_poses, **selection)
+        assert loaded.t.shape == selected.t.shape
+        assert (loaded.t == selected.t).all()
+        assert (loaded.p == selected.p).all()
+        assert (loaded.r == selected.r).all()
+    assert len(load_poses(lines, "VIO_pose", stride=10).t) == 10
+    assert len(load_poses(lines, "VIO_pose", max_rows=5).t) == 5
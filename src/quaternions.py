@@ -0,0 +1,154 @@
+import numpy as np
+
+# Batched quaternion operations. Quaternions are Nx4 arrays of (w, x, y, z) rows, rotation matrices are
+# 3x3xN stacks like Poses.r.
+
+
+def from_rotation_matrices(R):
+    """Unit quaternions (Nx4) of 3x3xN rotation matrices"""
+    trace = np.einsum("iin->n", R)
+    # Largest of 4w^2, 4x^2, 4y^2, 4z^2 gives the numerically stable branch
+    squares = np.array([1.0 + trace, 1.0 + 2.0 * R[0, 0] - trace, 1.0 + 2.0 * R[1, 1] - trace,
+                        1.0 + 2.0 * R[2, 2] - trace])
+    branch = squares.argmax(axis=0)
+    q = np.empty((R.shape[2], 4))
+    for b in range(4):
+        i = branch == b
+        Ri = R[:, :, i]
+        d = np.sqrt(np.maximum(squares[b, i], 0.0))
+        if b == 0:
+            q[i] = np.array([d, (Ri[2, 1] - Ri[1, 2]) / d, (Ri[0, 2] - Ri[2, 0]) / d, (Ri[1, 0] - Ri[0, 1]) / d]).T
+        elif b == 1:
+            q[i] = np.array([(Ri[2, 1] - Ri[1, 2]) / d, d, (Ri[0, 1] + Ri[1, 0]) / d, (Ri[0, 2] + Ri[2, 0]) / d]).T
+        elif b == 2:
+            q[i] = np.array([(Ri[0, 2] - Ri[2, 0]) / d, (Ri[0, 1] + Ri[1, 0]) / d, d, (Ri[1, 2] + Ri[2, 1]) / d]).T
+        else:
+            q[i] = np.array([(Ri[1, 0] - Ri[0, 1]) / d, (Ri[0, 2] + Ri[2, 0]) / d, (Ri[1, 2] + Ri[2, 1]) / d, d]).T
+    return q / 2.0
+
+
+def to_rotation_matrices(q):
+    """Rotation matrices (3x3xN) of unit quaternions (Nx4)"""
+    w, x, y, z = q.T
+    return np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+            [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+            [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+        ]
+    )
+
+
+def normalize(q):
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def multiply(q0, q1):
+    """Hamilton products q0 q1 (Nx4), which rotate by q1 first, then by q0"""
+    w0, x0, y0, z0 = q0.T
+    w1, x1, y1, z1 = q1.T
+    return np.stack(
+        [
+            w0 * w1 - x0 * x1 - y0 * y1 - z0 * z1,
+            w0 * x1 + x0 * w1 + y0 * z1 - z0 * y1,
+            w0 * y1 - x0 * z1 + y0 * w1 + z0 * x1,
+            w0 * z1 + x0 * y1 - y0 * x1 + z0 * w1,
+        ],
+        axis=1,
+    )
+
+
+def inverse(q):
+    """Inverses of quaternions (Nx4); for unit quaternions, the inverse rotations"""
+    return q * np.array([1.0, -1.0, -1.0, -1.0]) / np.einsum("ni,ni->n", q, q)[:, np.newaxis]
+
+
+def exp(v):
+    """Unit quaternions (Nx4) of rotation vectors (Nx3, axis * angle)"""
+    angles = np.linalg.norm(v, axis=1, keepdims=True)
+    # sin(angle / 2) / angle, with its limit 1/2 for small angles
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors = np.where(angles < 1e-8, 0.5, np.sin(angles / 2.0) / angles)
+    return np.concatenate([np.cos(angles / 2.0), v * factors], axis=1)
+
+
+def log(q):
+    """Rotation vectors (Nx3, axis * angle, angle in [0, pi]) of quaternions (Nx4), inverse of exp()"""
+    q = normalize(q)
+    # q and -q are the same rotation, the one with w >= 0 has the smaller angle
+    q = np.where(q[:, :1] < 0.0, -q, q)
+    norms = np.linalg.norm(q[:, 1:], axis=1, keepdims=True)
+    angles = 2.0 * np.arctan2(norms, q[:, :1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors = np.where(norms < 1e-12, 2.0, angles / norms)
+    return q[:, 1:] * factors
+
+
+def slerp(q0, q1, u, linear_threshold=0.9995):
+    """
+    Spherical linear interpolation from unit quaternions q0 to q1 (Nx4) by fractions u (N),
+    along the shorter arc. Nearly equal quaternions are interpolated linearly (and normalized),
+    where sin(angle) would be too small to divide with.
+    """
+    u = np.asarray(u, dtype=float)[:, np.newaxis]
+    dots = np.einsum("ni,ni->n", q0, q1)[:, np.newaxis]
+    # q and -q are the same rotation; flip to interpolate the shorter way
+    q1 = np.where(dots < 0.0, -q1, q1)
+    dots = np.abs(dots)
+    linear = dots > linear_threshold
+    angles = np.arccos(np.clip(dots, -1.0, 1.0))
+    sin_angles = np.where(linear, 1.0, np.sin(angles))
+    w0 = np.where(linear, 1.0 - u, np.sin((1.0 - u) * angles) / sin_angles)
+    w1 = np.where(linear, u, np.sin(u * angles) / sin_angles)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def test_rotation_matrices():
+    rng = np.random.default_rng(0)
+    q = rng.normal(size=(100, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    q[:4] = np.identity(4)  # all branches of from_rotation_matrices
+    R = to_rotation_matrices(q)
+    assert np.allclose(np.einsum("jin,jkn->ikn", R, R), np.identity(3)[:, :, np.newaxis])
+    q_back = from_rotation_matrices(R)
+    # Same rotation, possibly with the opposite sign
+    assert np.allclose(np.abs(np.einsum("ni,ni->n", q, q_back)), 1.0)
+
+
+def test_slerp():
+    # Rotations around z, angle 2 * atan2(z, w)
+    def z_rotations(angles):
+        return np.stack([np.cos(angles / 2), 0 * angles, 0 * angles, np.sin(angles / 2)], axis=1)
+
+    q0 = z_rotations(np.array([0.0, 0.0, 1.0, 0.0]))
+    q1 = z_rotations(np.array([1.0, 3.0, 1.0 + 1e-6, 0.0]))
+    q1[1] *= -1.0  # same rotation with opposite sign
+    q = slerp(q0, q1, np.array([0.25, 0.5, 0.5, 0.7]))
+    angles = 2 * np.arctan2(q[:, 3], q[:, 0])
+    assert np.allclose(angles, [0.25, 1.5, 1.0 + 5e-7, 0.0])
+
+
+def test_multiply_inverse():
+    rng = np.random.default_rng(1)
+    q0 = normalize(rng.normal(size=(50, 4)))
+    q1 = normalize(rng.normal(size=(50, 4)))
+    R01 = np.einsum("ijn,jkn->ikn", to_rotation_matrices(q0), to_rotation_matrices(q1))
+    assert np.allclose(to_rotation_matrices(multiply(q0, q1)), R01)
+    assert np.allclose(multiply(q0, inverse(q0)), [1.0, 0.0, 0.0, 0.0])
+    assert np.allclose(inverse(2.0 * q0), inverse(q0) / 2.0)
+
+
+def test_exp_log():
+    rng = np.random.default_rng(2)
+    v = rng.normal(size=(100, 3))
+    v *= rng.uniform(0.0, np.pi, (100, 1)) / np.linalg.norm(v, axis=1, keepdims=True)
+    v[0] = 0.0
+    v[1] = [1e-10, 0.0, 0.0]
+    q = exp(v)
+    assert np.allclose(np.linalg.norm(q, axis=1), 1.0)
+    assert np.allclose(log(q), v)
+    assert np.allclose(log(-q), v)
+    # Rotation by angle around z
+    assert np.allclose(to_rotation_matrices(exp(np.array([[0.0, 0.0, 0.3]])))[:2, :2, 0],
+                       [[np.cos(0.3), -np.sin(0.3)], [np.sin(0.3), np.cos(0.3)]])
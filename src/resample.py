@@ -0,0 +1,125 @@
+import argparse
+import numpy as np
+from poses import Poses, load_pose_file, save_pose_store
+import quaternions
+
+# Resample poses at arbitrary timestamps (e.g. exactly at VIO frame times, or a uniform grid),
+# interpolating positions linearly and rotations with quaternion SLERP between the surrounding samples.
+# Unlike keeping every Nth line (downsample.sh, or --tracker_stride), the result does not depend on
+# polling jitter or duplicated timestamps in the data.
+
+
+def interpolation_indices(t, t_query):
+    """
+    Indices i of the samples before each query time (t[i] <= t_query < t[i + 1]), and the fractions
+    between samples i and i + 1. Query times outside the data get the first or last sample.
+    With duplicated timestamps, the last of the duplicates is used.
+    """
+    i = np.clip(np.searchsorted(t, t_query, side="right") - 1, 0, len(t) - 2)
+    dt = t[i + 1] - t[i]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.where(dt > 0.0, (t_query - t[i]) / dt, 0.0)
+    return i, np.clip(u, 0.0, 1.0)
+
+
+def resample_poses(poses, t_query):
+    """Poses at timestamps t_query (sorted or not), interpolated from poses (sorted by time, at least 2 samples)"""
+    t_query = np.asarray(t_query, dtype=float)
+    i, u = interpolation_indices(poses.t, t_query)
+    data = Poses()
+    data.t = t_query
+    data.p = poses.p[:, i] * (1.0 - u) + poses.p[:, i + 1] * u
+    # Quaternions only for the samples that are needed, not all of the (possibly much longer) input
+    used, inverse = np.unique(np.concatenate([i, i + 1]), return_inverse=True)
+    q = quaternions.from_rotation_matrices(poses.r[:, :, used])
+    data.r = quaternions.to_rotation_matrices(quaternions.slerp(q[inverse[: len(i)]], q[inverse[len(i) :]], u))
+    return data
+
+
+def uniform_times(t_start, t_end, rate):
+    """Uniform grid of timestamps from t_start up to t_end (inclusive), rate samples per second"""
+    return t_start + np.arange(int(np.floor((t_end - t_start) * rate + 1e-9)) + 1) / rate
+
+
+def resample_uniform(poses, rate):
+    return resample_poses(poses, uniform_times(poses.t[0], poses.t[-1], rate))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        help="Input tracker or VIO pose data (JSONL or pose store)",
+        required=True,
+    )
+    parser.add_argument(
+        "--pose_name",
+        dest="pose_name",
+        help="Name of pose to use in VIO data (VIO_pose, tag_space_pose...). Leave out for tracker data.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Output pose store directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        help="Resample to a uniform grid with this many samples per second",
+        type=float,
+    )
+    parser.add_argument(
+        "--times_from",
+        dest="times_from",
+        help="Resample at the timestamps of this pose data instead (e.g. VIO frames), with --times_pose_name for VIO data",
+    )
+    parser.add_argument(
+        "--times_pose_name",
+        dest="times_pose_name",
+        help="Name of pose in --times_from data",
+    )
+    args = parser.parse_args()
+    if (args.rate is None) == (args.times_from is None):
+        parser.error("give either --rate or --times_from")
+    poses = load_pose_file(args.input, args.pose_name)
+    if args.rate is not None:
+        resampled = resample_uniform(poses, args.rate)
+    else:
+        resampled = resample_poses(poses, load_pose_file(args.times_from, args.times_pose_name).t)
+    save_pose_store(resampled, args.output)
+    print("Resampled {} poses into {} poses".format(len(poses.t), len(resampled.t)))
+
+
+def test_interpolation_indices():
+    t = np.array([0.0, 1.0, 1.0, 2.0, 4.0])
+    i, u = interpolation_indices(t, np.array([-1.0, 0.5, 1.0, 1.5, 3.0, 4.0, 5.0]))
+    assert i.tolist() == [0, 0, 2, 2, 3, 3, 3]
+    assert u.tolist() == [0.0, 0.5, 0.0, 0.5, 0.5, 1.0, 1.0]
+
+
+def test_resample_poses():
+    # Constant-speed rotation around z and linear movement; interpolation is exact for both
+    def poses_at(t):
+        data = Poses()
+        data.t = t
+        angles = 0.8 * t
+        q = np.stack([np.cos(angles / 2), 0 * t, 0 * t, np.sin(angles / 2)], axis=1)
+        data.r = quaternions.to_rotation_matrices(q)
+        data.p = np.stack([t, 2 * t, -t])
+        return data
+
+    rng = np.random.default_rng(0)
+    samples = poses_at(np.sort(rng.uniform(0.0, 10.0, 500)))
+    t_query = rng.uniform(samples.t[0], samples.t[-1], 1000)
+    resampled = resample_poses(samples, t_query)
+    expected = poses_at(t_query)
+    assert np.allclose(resampled.p, expected.p)
+    assert np.allclose(resampled.r, expected.r)
+
+    uniform = resample_uniform(samples, 10.0)
+    assert np.allclose(np.diff(uniform.t), 0.1)
+    assert uniform.t[0] == samples.t[0] and uniform.t[-1] <= samples.t[-1]
@@ -2,6 +2,8 @@ import argparse
 import json
 import numpy as np
 import math
+import multiprocessing
+from multiprocessing import shared_memory
 from poses import *
 
 
@@ -18,11 +20,45 @@ def angle_between_rotations(A: np.array, B: np.array):
     return min(angle, 2.0 * math.pi - angle)
 
 
+def angles_between_rotations(A: np.array, B: np.array, identity_tolerance=0.001):
+    """
+    Batched angle_between_rotations for two 3x3xN stacks of rotations (like Poses.r),
+    returns the N angles between A[:, :, i] and B[:, :, i].
+    identity_tolerance=None disables treating too similar rotations as 0 angle
+    (which would drop most of the rotation between consecutive high-rate tracker samples).
+    """
+    R = np.einsum("ijn,kjn->ikn", A, B)  # A[:, :, n] @ B[:, :, n].T
+    cos_angles = (np.einsum("iin->n", R) - 1.0) / 2.0
+    # Clip rounding errors outside acos domain
+    angles = np.arccos(np.clip(cos_angles, -1.0, 1.0))
+    angles = np.minimum(angles, 2.0 * math.pi - angles)
+    if identity_tolerance is not None:
+        too_similar = (R - np.identity(3)[:, :, np.newaxis]).max(axis=(0, 1)) < identity_tolerance
+        angles[too_similar] = 0.0
+    return angles
+
+
+def consecutive_rotation_angles(R: np.array, identity_tolerance=0.001):
+    """Angles between each pair of consecutive rotations in a 3x3xN stack (N-1 angles)"""
+    return angles_between_rotations(R[:, :, :-1], R[:, :, 1:], identity_tolerance)
+
+
+def tracker_step_signals(p_tracker, R_tracker):
+    """
+    Per-step tracker signals used by sync_rotation_speeds() and sync_speed_correlation(), so they can be
+    computed once when syncing several devices against the same tracker data.
+    """
+    return dict(
+        rotation_angles=consecutive_rotation_angles(R_tracker),
+        distances=np.linalg.norm(np.diff(p_tracker, axis=1), axis=0),
+        unfiltered_rotation_angles=consecutive_rotation_angles(R_tracker, identity_tolerance=None),
+    )
+
+
 def movement_speeds(t, p):
     dts = t[1:-1] - t[0:-2]
     dps = p[:, 1:-1] - p[:, 0:-2]
     ds = np.linalg.norm(dps, axis=0, keepdims=True)
-    print('dsshape', ds.shape)
     return ds / dts
 
 
@@ -30,141 +66,456 @@ def movement_speeds(t, p):
 # (consider this when recording the dataset)
 
 
+def map_vio_to_tracker_with_syncs(t_vio, t_tracker, syncs):
+    """
+    Map VIO sample indices to tracker sample indices for many sync candidates at once.
+    Returns (len(syncs) x len(t_vio)) integer array, where row i maps the VIO samples with syncs[i].
+    Timestamps are expected to be sorted.
+    """
+    # Add sync to VIO timestamp; 1.0s sync means
+    # VIO track starts 1 sec after tracker started recording
+    t = np.asarray(t_vio)[np.newaxis, :] + np.asarray(syncs)[:, np.newaxis]
+    # First tracker timestamp that is greater-or-equal to the synced VIO timestamp,
+    # or the last tracker sample if there is none
+    vio_to_tracker = np.searchsorted(t_tracker, t, side="left")
+    return np.minimum(vio_to_tracker, len(t_tracker) - 1)
+
+
 def map_vio_to_tracker_with_sync(t_vio, t_tracker, sync):
-    n_vio = len(t_vio)
-    n_tracker = len(t_tracker)
-    i_tracker = 0
-    vio_to_tracker_map = [0] * n_vio  # TODO consider numpy int array
-    for i_vio in range(n_vio):
-        # Add sync to VIO timestamp; 1.0s sync means
-        # VIO track starts 1 sec after tracker started recording
-        t = t_vio[i_vio] + sync
-        # Seek to first tracker timestamp that is greater-or-equal
-        # to the synced VIO timestamp
-        while t_tracker[i_tracker] < t and i_tracker < n_tracker - 1:
-            i_tracker += 1
-        vio_to_tracker_map[i_vio] = i_tracker
-    return vio_to_tracker_map
-
-
-def sync_rotation_diffs(t_vio, R_vio, t_tracker, R_tracker):
-    """TODO: port from calibrate_vio_tracker.cpp"""
-    sync = 0.0
+    return map_vio_to_tracker_with_syncs(t_vio, t_tracker, [sync])[0].tolist()
+
+
+# Upper limit for the size of (sync candidates x VIO samples) arrays that are evaluated at once
+SYNC_BLOCK_ELEMENTS = 1 << 22
+
+
+def sync_candidate_blocks(n_syncs, n_vio):
+    """Split sync candidates into blocks (slices) so that candidate x sample arrays stay reasonably small"""
+    block_size = max(1, SYNC_BLOCK_ELEMENTS // max(1, n_vio))
+    return [slice(i, min(i + block_size, n_syncs)) for i in range(0, n_syncs, block_size)]
+
+
+# Arrays shared with the worker processes of ParallelScores, by name
+_worker_arrays = {}
+_worker_shared_memories = []
+
+
+def _attach_shared_arrays(array_specs):
+    for name, (shared_memory_name, shape, dtype) in array_specs.items():
+        shm = shared_memory.SharedMemory(name=shared_memory_name)
+        _worker_shared_memories.append(shm)
+        _worker_arrays[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def _score_with_shared_arrays(task):
+    score_function, syncs, stride, options = task
+    return score_function(syncs, stride, **_worker_arrays, **options)
+
+
+class ParallelScores:
+    """
+    Score function for search_sync(), that evaluates score_function(syncs, stride, **arrays, **options)
+    with the sync candidates split across worker processes.
+    The arrays are copied into shared memory once, instead of pickling them for every task,
+    and the results are concatenated in candidate order, so they are identical to evaluating serially.
+    With workers=1, everything runs in this process.
+    Use as a context manager, so that the workers and shared memory are cleaned up.
+    """
+
+    def __init__(self, score_function, arrays, workers=1, **options):
+        self.score_function = score_function
+        self.arrays = arrays
+        self.workers = workers
+        self.options = options
+        self.pool = None
+        self.shared_memories = []
+
+    def __enter__(self):
+        if self.workers > 1:
+            array_specs = {}
+            for name, array in self.arrays.items():
+                array = np.ascontiguousarray(array)
+                shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+                self.shared_memories.append(shm)
+                np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+                array_specs[name] = (shm.name, array.shape, array.dtype)
+            self.pool = multiprocessing.Pool(
+                self.workers, initializer=_attach_shared_arrays, initargs=(array_specs,)
+            )
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for shm in self.shared_memories:
+            shm.close()
+            shm.unlink()
+        self.shared_memories = []
+
+    def __call__(self, syncs, stride):
+        if self.pool is None:
+            return self.score_function(syncs, stride, **self.arrays, **self.options)
+        chunks = np.array_split(syncs, min(self.workers, len(syncs)))
+        tasks = [(self.score_function, chunk, stride, self.options) for chunk in chunks]
+        return np.concatenate(self.pool.map(_score_with_shared_arrays, tasks))
+
+
+def negative_angle_variances(syncs, stride, t_vio, R_vio_flat, t_tracker, R_tracker_flat):
+    """Scores for sync_rotation_diffs(), rotations are flattened to 9xN"""
+    t = t_vio[::stride]
+    R = R_vio_flat[:, ::stride]
+    result = np.empty(len(syncs))
+    for block in sync_candidate_blocks(len(syncs), 9 * len(t)):
+        vio_to_tracker = map_vio_to_tracker_with_syncs(t, t_tracker, syncs[block])
+        traces = np.einsum("kcn,kn->cn", R_tracker_flat[:, vio_to_tracker], R)
+        angles = np.degrees(np.arccos(np.clip((traces - 1.0) / 2.0, -1.0, 1.0)))
+        result[block] = -angles.var(axis=1)
+    return result
+
+
+def sync_rotation_diffs(
+    t_vio, R_vio, t_tracker, R_tracker, step=0.1, precision_ms=None, workers=1, return_scores=False
+):
+    """
+    Find sync by comparing orientations (ported from find_sync_from_orientations in calibrate_vio_tracker).
+    For the correct sync, the angle between VIO and corresponding tracker orientations should be almost
+    the same throughout the track, so find the sync that minimizes the angles' deviation from their mean.
+    Sync candidates are step seconds apart, see search_sync() for precision_ms
+    and ParallelScores for workers. With return_scores, returns (sync, syncs, -angle_variances).
+    """
+    max_sync = (t_tracker[-1] - t_tracker[0]) - (t_vio[-1] - t_vio[0])
+    n_candidates = int(math.ceil(max_sync / step)) + 1
+
+    # trace(A @ B.T) is the sum of elementwise products, so the angles for all candidates
+    # come from one gather of the (flattened) tracker rotations
+    arrays = dict(
+        t_vio=t_vio,
+        R_vio_flat=R_vio.reshape(9, -1),
+        t_tracker=t_tracker,
+        R_tracker_flat=R_tracker.reshape(9, -1),
+    )
+    with ParallelScores(negative_angle_variances, arrays, workers) as score:
+        sync, syncs, scores = search_sync(
+            score,
+            max_sync,
+            precision_ms,
+            n_candidates=n_candidates,
+            coarse_stride=coarse_search_stride(len(t_vio)),
+        )
+    if return_scores:
+        return sync, syncs, scores
     return sync
 
 
-def sync_rotation_speeds(t_vio, R_vio, t_tracker, R_tracker):
-    """Find sync by comparing rotation speeds"""
+# Coarse search levels evaluate about this many VIO samples per sync candidate
+COARSE_SEARCH_SAMPLES = 2000
+# sync_speed_correlation() needs at least this many grid samples of VIO data to correlate
+MIN_CORRELATION_SAMPLES = 10
+
+
+def coarse_search_stride(n_vio):
+    return max(1, n_vio // COARSE_SEARCH_SAMPLES)
+
+
+def best_local_maxima(syncs, scores, n_peaks):
+    """Syncs of the n_peaks highest local maxima of scores (syncs must be sorted)"""
+    padded = np.concatenate([[-np.inf], scores, [-np.inf]])
+    is_peak = (scores >= padded[:-2]) & (scores >= padded[2:])
+    peaks = np.nonzero(is_peak)[0]
+    peaks = peaks[np.argsort(-scores[peaks], kind="stable")[:n_peaks]]
+    return syncs[peaks]
+
+
+def parabola_peak(syncs, scores, i, step):
+    """Refine the sync of the maximum scores[i] by fitting a parabola to it and its neighbours"""
+    if i == 0 or i == len(syncs) - 1:
+        return syncs[i]
+    if not np.isclose(syncs[i] - syncs[i - 1], step) or not np.isclose(syncs[i + 1] - syncs[i], step):
+        return syncs[i]
+    left, center, right = scores[i - 1 : i + 2]
+    curvature = left - 2.0 * center + right
+    if not curvature < 0.0:
+        return syncs[i]
+    offset = 0.5 * step * (left - right) / curvature
+    return syncs[i] + np.clip(offset, -0.5 * step, 0.5 * step)
+
+
+def search_sync(score, max_sync, precision_ms=None, n_candidates=100, coarse_stride=1, n_peaks=3, refine_factor=10):
+    """
+    Find the sync in [0, max_sync] with the highest score.
+    score(syncs, stride) must return an array of scores (higher is better) for the sync candidates,
+    computed from every stride'th VIO sample.
+
+    Without precision_ms, a fixed grid of n_candidates syncs is evaluated with all samples.
+    With precision_ms (milliseconds), a coarse grid of n_candidates syncs is evaluated with every
+    coarse_stride'th sample first, then progressively finer grids around the n_peaks best local maxima
+    (with less decimation) until the grid spacing is below the precision, and finally the best sync
+    is refined by fitting a parabola to its neighbours.
+
+    Returns (best_sync, syncs, scores), with all evaluated syncs (sorted) and their scores.
+    """
+    if precision_ms is None:
+        syncs = np.linspace(0.0, max_sync, n_candidates)
+        scores = score(syncs, 1)
+        return syncs[np.argmax(scores)], syncs, scores
+
+    precision = precision_ms / 1000.0
+    syncs = np.linspace(0.0, max_sync, n_candidates)
+    step = syncs[1] - syncs[0] if n_candidates > 1 else 0.0
+    stride = coarse_stride if step > precision else 1
+    all_syncs = []
+    all_scores = []
+    while True:
+        scores = score(syncs, stride)
+        all_syncs.append(syncs)
+        all_scores.append(scores)
+        if step <= precision:
+            break
+        peaks = best_local_maxima(syncs, scores, n_peaks)
+        step /= refine_factor
+        # Last level is always evaluated with all samples
+        stride = max(1, stride // refine_factor) if step > precision else 1
+        offsets = np.arange(-refine_factor, refine_factor + 1) * step
+        syncs = np.unique(np.clip((peaks[:, np.newaxis] + offsets).ravel(), 0.0, max_sync))
+
+    i_best = np.argmax(scores)
+    best_sync = parabola_peak(syncs, scores, i_best, step)
+
+    all_syncs = np.concatenate(all_syncs)
+    all_scores = np.concatenate(all_scores)
+    order = np.argsort(all_syncs, kind="stable")
+    return best_sync, all_syncs[order], all_scores[order]
+
+
+def rotation_speed_similarities(syncs, stride, t_vio, v_vio, t_tracker, v_tracker):
+    """Scores for sync_rotation_speeds(), v_vio and v_tracker are the angles between consecutive rotations"""
+    v_vio_normalized = normalized(v_vio[::stride])
+    t = t_vio[:-1:stride]
+    result = np.empty(len(syncs))
+    for block in sync_candidate_blocks(len(syncs), len(t)):
+        vio_to_tracker = map_vio_to_tracker_with_syncs(t, t_tracker, syncs[block])
+        v_tracker_matched = v_tracker[np.minimum(vio_to_tracker, len(v_tracker) - 1)]
+        result[block] = (v_tracker_matched * v_vio_normalized).sum(axis=1) / np.linalg.norm(
+            v_tracker_matched, axis=1
+        )
+    # No similarity at all (negative, or no tracker movement) counts as zero, so that
+    # without any positive similarity the first sync is picked
+    result[np.isnan(result)] = 0.0
+    return np.maximum(result, 0.0)
+
+
+def sync_rotation_speeds(
+    t_vio, R_vio, t_tracker, R_tracker, precision_ms=None, workers=1, return_scores=False, tracker_signals=None
+):
+    """
+    Find sync by comparing rotation speeds.
+    See search_sync() for precision_ms and ParallelScores for workers, and tracker_step_signals() for tracker_signals.
+    With return_scores, returns (sync, syncs, similarities).
+    """
     max_sync = (t_tracker[-1] - t_tracker[0]) - (t_vio[-1] - t_vio[0])
-    syncs = np.linspace(0.0, max_sync, 100)
-
-    n_vio = len(t_vio)
-    n_tracker = len(t_tracker)
 
-    v_vio = np.array(
-        [
-            angle_between_rotations(R_vio[:, :, i], R_vio[:, :, i + 1])
-            for i in range(n_vio - 1)
-        ]
-    )
-    v_tracker = np.array(
-        [
-            angle_between_rotations(R_tracker[:, :, i], R_tracker[:, :, i + 1])
-            for i in range(n_tracker - 1)
-        ]
+    arrays = dict(
+        t_vio=t_vio,
+        v_vio=consecutive_rotation_angles(R_vio),
+        t_tracker=t_tracker,
+        v_tracker=tracker_signals["rotation_angles"] if tracker_signals is not None
+        else consecutive_rotation_angles(R_tracker),
     )
+    with ParallelScores(rotation_speed_similarities, arrays, workers) as score:
+        sync, syncs, scores = search_sync(
+            score, max_sync, precision_ms, n_candidates=100, coarse_stride=coarse_search_stride(len(t_vio))
+        )
+    if return_scores:
+        return sync, syncs, scores
+    return sync
 
-    i_best_sync = 0
-    max_similarity = 0
-    for i_sync, sync in enumerate(syncs):
-        vio_to_tracker = map_vio_to_tracker_with_sync(t_vio, t_tracker, sync)
 
-        v_tracker_matched = np.array(
-            [v_tracker[vio_to_tracker[i_vio]] for i_vio in range(n_vio - 1)]
+def resampled_speeds(t, distances, t_start, dt, n):
+    """
+    Average speeds on the uniform time grid t_start + i*dt, from per-step distances (or angles).
+    Resamples the cumulative distance and differentiates that, so uneven sampling,
+    duplicate timestamps and higher sampling rates than the grid are all handled.
+    """
+    cumulative = np.concatenate([[0.0], np.cumsum(distances)])
+    grid = t_start + dt * np.arange(n + 1)
+    return np.diff(np.interp(grid, t, cumulative)) / dt
+
+
+def normalized_cross_correlation(v_vio, v_tracker, n_lags):
+    """
+    Normalized cross-correlation (Pearson correlation) between v_vio and the windows
+    v_tracker[k:k+len(v_vio)] for lags k in [0, n_lags), computed with FFT.
+    """
+    n = len(v_vio)
+    v = v_vio - v_vio.mean()
+    size = 1 << int(math.ceil(math.log2(len(v_tracker) + n)))
+    # products[k] = sum_j v[j] * v_tracker[j + k]
+    products = np.fft.irfft(np.fft.rfft(v_tracker, size) * np.conj(np.fft.rfft(v, size)), size)[:n_lags]
+    # Window sums for the tracker mean and variance at each lag
+    cumulative = np.concatenate([[0.0], np.cumsum(v_tracker)])
+    cumulative_squares = np.concatenate([[0.0], np.cumsum(v_tracker * v_tracker)])
+    window_sums = cumulative[n : n + n_lags] - cumulative[:n_lags]
+    window_squares = cumulative_squares[n : n + n_lags] - cumulative_squares[:n_lags]
+    window_variances = np.maximum(window_squares - window_sums * window_sums / n, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = products / np.sqrt(np.dot(v, v) * window_variances)
+    return np.nan_to_num(correlation, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def sync_speed_correlation(
+    t_vio, p_vio, R_vio, t_tracker, p_tracker, R_tracker, dt=0.01, return_scores=False, tracker_signals=None
+):
+    """
+    Find sync by cross-correlating angular and linear speeds of VIO and tracker data.
+    Both are resampled onto a uniform time grid (dt seconds), and the normalized cross-correlation
+    for all syncs in [0, max_sync] is computed with FFT in O(N log N). The syncs are the grid lags,
+    refined with a parabola fit around the best one.
+    See tracker_step_signals() for tracker_signals.
+    Note: unlike the other sync_* methods, which search syncs in [0, max_sync] and so expect both recordings
+    rebased to start from 0, the syncs are offsets between the given timestamps (t_vio + sync = t_tracker, like
+    map_vio_to_tracker_with_syncs() uses them), i.e. t_tracker[0] - t_vio[0] + [0, max_sync]. For rebased data
+    the two are the same.
+    Raises ValueError if the VIO data is longer than the tracker data, or too short to correlate.
+    With return_scores, returns (sync, syncs, correlations).
+    """
+    if tracker_signals is None:
+        tracker_signals = tracker_step_signals(p_tracker, R_tracker) if R_tracker.any() else dict(
+            distances=np.linalg.norm(np.diff(p_tracker, axis=1), axis=0)
+        )
+    max_sync = (t_tracker[-1] - t_tracker[0]) - (t_vio[-1] - t_vio[0])
+    if max_sync < 0.0:
+        raise ValueError("VIO data ({:.3f}s) is longer than tracker data ({:.3f}s), cannot sync".format(
+            t_vio[-1] - t_vio[0], t_tracker[-1] - t_tracker[0]
+        ))
+    n_lags = int(math.floor(max_sync / dt)) + 1
+    n_vio_grid = int(math.floor((t_vio[-1] - t_vio[0]) / dt))
+    if n_vio_grid < MIN_CORRELATION_SAMPLES:
+        raise ValueError("VIO data ({:.3f}s) is too short for speed correlation, need at least {:.3f}s".format(
+            t_vio[-1] - t_vio[0], MIN_CORRELATION_SAMPLES * dt
+        ))
+    n_tracker_grid = n_vio_grid + n_lags - 1
+
+    signals = [
+        (np.linalg.norm(np.diff(p_vio, axis=1), axis=0), tracker_signals["distances"]),
+    ]
+    # Data without rotations has all-zero rotation matrices
+    if R_vio.any() and R_tracker.any():
+        signals.append(
+            (
+                consecutive_rotation_angles(R_vio, identity_tolerance=None),
+                tracker_signals["unfiltered_rotation_angles"],
+            )
         )
+    correlations = []
+    for distances_vio, distances_tracker in signals:
+        v_vio = resampled_speeds(t_vio, distances_vio, t_vio[0], dt, n_vio_grid)
+        v_tracker = resampled_speeds(t_tracker, distances_tracker, t_tracker[0], dt, n_tracker_grid)
+        # Skip signals without any information (e.g. no movement)
+        if v_vio.std() > 0.0:
+            correlations.append(normalized_cross_correlation(v_vio, v_tracker, n_lags))
+    correlation = np.mean(correlations, axis=0) if correlations else np.zeros(n_lags)
+
+    # VIO grid sample j matches tracker grid sample j + lag
+    syncs = (t_tracker[0] - t_vio[0]) + dt * np.arange(n_lags)
+    sync = parabola_peak(syncs, correlation, np.argmax(correlation), dt)
+    if return_scores:
+        return sync, syncs, correlation
+    return sync
 
-        similarity = np.dot(normalized(v_vio), normalized(v_tracker_matched))
-        if similarity > max_similarity:
-            i_best_sync = i_sync
-            max_similarity = similarity
-
-    return syncs[i_best_sync]
-
-
-def sync_movement_speeds(t_vio, p_vio, t_tracker, p_tracker):
-    """TODO: port from align_trajectories.py"""
-    """TODO: test it again here after porting"""
-
-    # def sync_errors(sync: float, N: int):
-    #     # Find M from Nth tracker frame
-    #     M_tracker = np.identity(4)
-    #     M_tracker[0:3, 3] = tracker.ps[0:3, N]
-    #     M_tracker[:3, 0] = tracker.frame_xs[:3, N]
-    #     M_tracker[:3, 1] = tracker.frame_ys[:3, N]
-    #     M_tracker[:3, 2] = tracker.frame_zs[:3, N]
-    #     # print(M_tracker)
-
-    #     corresponding_device_N = tracker_idx_to_device_idx(N, sync)
-    #     # print('corresponding_device_N', corresponding_device_N)
-    #     M_device = np.identity(4)
-    #     M_device[0:3, 3] = device.ps[0:3, corresponding_device_N]
-    #     M_device[:3, 0] = device.frame_xs[:3, corresponding_device_N]
-    #     M_device[:3, 1] = device.frame_ys[:3, corresponding_device_N]
-    #     M_device[:3, 2] = device.frame_zs[:3, corresponding_device_N]
-    #     # print(M_device)
-    #     # NOTE ds should be scaled by (ts[n] - ts[n-1]), since sampling freq is different
-
-    #     M_device_to_tracker = M_tracker @ np.linalg.inv(M_device)
-    #     errors = []
-    #     transform_test_indices = [10 * x for x in range(100)]
-    #     for tracker_idx in transform_test_indices:
-    #         device_idx = tracker_idx_to_device_idx(tracker_idx, sync)
-    #         tracker_point = tracker.ps[0:3, tracker_idx]
-    #         device_test_point = device.ps[0:3, device_idx]
-    #         test_point_in_tracker_space = (
-    #             M_device_to_tracker[:3, :3] @ device_test_point
-    #             + M_device_to_tracker[0:3, 3]
-    #         )
-    #         dp = test_point_in_tracker_space - tracker_point
-    #         # TODO: error is not really fully error, there is supposed to be a constant distance
-    #         # between tracker and device pose in real-world coords.
-    #         # Perhaps we should be comparing to the mean? (variance)
-    #         # However, seems useful to minimize.
-    #         error = np.linalg.norm(dp)
-    #         errors.append(error)
-    #     return np.mean(errors), M_device_to_tracker
-
-    # # Try different sync candidates, pick one that minimizes average distance from
-    # # transformed device position to the tracker position.
-    # # Currently for the transform we just try some pairs of tracker and device poses,
-    # # and calculate M directly from that (instead of some global optimization that would
-    # # minimize total error when considering the whole trajectories).
-    # errors_per_sync = []
-    # M_per_sync = []
-    # sync_candidates = np.linspace(-20.0, 20.0, 1001)
-    # # TODO more intelligent picking
-    # N_candidates = [math.floor(i * 0.2 * tracker.ts.shape[0]) for i in range(1, 5)]
-    # # print('N_candidates:', N_candidates)
-    # for sync in sync_candidates:
-    #     sync_errors_for_N = []
-    #     Ms_for_N = []
-    #     for N in N_candidates:
-    #         mean_error, M = sync_errors(sync, N)
-    #         sync_errors_for_N.append(mean_error)
-    #         Ms_for_N.append(M)
-    #     best_N_index = np.argmin(sync_errors_for_N)
-    #     errors_per_sync.append(sync_errors_for_N[best_N_index])
-    #     M_per_sync.append(Ms_for_N[best_N_index])
-    # best_sync = sync_candidates[np.argmin(errors_per_sync)]
-    # best_M = M_per_sync[np.argmin(errors_per_sync)]
-    # # print('Optimal sync error:', min(errors_per_sync))
-
-    best_sync=0.0
-
-    return best_sync
+
+def fit_rigid_transforms(A, B, with_scale=False):
+    """
+    Closed-form least-squares rigid (Kabsch) or similarity (Umeyama, with_scale) transforms:
+    finds s, R, t minimizing sum_i |s * R @ A[:, i] + t - B[c, :, i]|^2 for each c.
+    A is 3xN, B is Cx3xN (one set of target points per candidate).
+    Returns R (Cx3x3), t (Cx3), s (C) and RMS errors (C).
+    """
+    n = A.shape[1]
+    mean_a = A.mean(axis=1)
+    mean_b = B.mean(axis=2)
+    A0 = A - mean_a[:, np.newaxis]
+    B0 = B - mean_b[:, :, np.newaxis]
+    covariances = np.einsum("cin,jn->cij", B0, A0) / n
+    U, S, Vt = np.linalg.svd(covariances)
+    # Make sure result is a rotation, not a reflection
+    d = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    D = np.ones((len(d), 3))
+    D[:, 2] = d
+    R = (U * D[:, np.newaxis, :]) @ Vt
+    trace_DS = (D * S).sum(axis=1)
+    var_a = (A0 * A0).sum() / n
+    var_b = np.einsum("cin,cin->c", B0, B0) / n
+    s = trace_DS / var_a if with_scale else np.ones(len(d))
+    t = mean_b - s[:, np.newaxis] * (R @ mean_a)
+    # Residual in closed form, without transforming the points
+    mean_squared_errors = np.maximum(s * s * var_a + var_b - 2.0 * s * trace_DS, 0.0)
+    return R, t, s, np.sqrt(mean_squared_errors)
+
+
+def negative_position_errors(syncs, stride, t_vio, p_vio, t_tracker, p_tracker, with_scale=False):
+    """Scores for sync_movement_speeds()"""
+    t = t_vio[::stride]
+    p = p_vio[:, ::stride]
+    result = np.empty(len(syncs))
+    for block in sync_candidate_blocks(len(syncs), 3 * len(t)):
+        vio_to_tracker = map_vio_to_tracker_with_syncs(t, t_tracker, syncs[block])
+        matched_tracker_positions = p_tracker[:, vio_to_tracker].transpose(1, 0, 2)
+        result[block] = -fit_rigid_transforms(p, matched_tracker_positions, with_scale)[3]
+    return result
+
+
+def sync_movement_speeds(
+    t_vio,
+    p_vio,
+    t_tracker,
+    p_tracker,
+    with_scale=False,
+    n_candidates=1001,
+    precision_ms=None,
+    workers=1,
+    return_scores=False,
+):
+    """
+    Find sync by fitting a rigid (or similarity, with_scale) transform from VIO positions to the
+    corresponding tracker positions for each sync candidate, and picking the sync with smallest RMS error.
+    The transform is fitted over the whole trajectory (Kabsch/Umeyama), see fit_device_to_tracker().
+    See search_sync() for precision_ms and ParallelScores for workers.
+    With return_scores, returns (sync, syncs, -rms_errors).
+    """
+    max_sync = (t_tracker[-1] - t_tracker[0]) - (t_vio[-1] - t_vio[0])
+
+    arrays = dict(t_vio=t_vio, p_vio=p_vio, t_tracker=t_tracker, p_tracker=p_tracker)
+    with ParallelScores(negative_position_errors, arrays, workers, with_scale=with_scale) as score:
+        sync, syncs, scores = search_sync(
+            score,
+            max_sync,
+            precision_ms,
+            n_candidates=n_candidates,
+            coarse_stride=coarse_search_stride(len(t_vio)),
+        )
+    if return_scores:
+        return sync, syncs, scores
+    return sync
+
+
+def fit_device_to_tracker(t_vio, p_vio, t_tracker, p_tracker, sync, with_scale=False):
+    """
+    Transform from VIO device space to tracking space with the given sync.
+    Returns 4x4 matrix M (with the scale in the upper-left 3x3 part), scale and RMS position error.
+    """
+    vio_to_tracker = map_vio_to_tracker_with_syncs(t_vio, t_tracker, [sync])
+    R, t, s, errors = fit_rigid_transforms(p_vio, p_tracker[:, vio_to_tracker].transpose(1, 0, 2), with_scale)
+    M = np.identity(4)
+    M[:3, :3] = s[0] * R[0]
+    M[:3, 3] = t[0]
+    return M, s[0], errors[0]
 
 
 if __name__ == "__main__":
+    # In the order of the printed syncs
+    sync_methods = ["movement_speeds", "rotation_diffs", "rotation_speeds", "speed_correlation"]
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-t",
@@ -186,25 +537,94 @@ if __name__ == "__main__":
         help="Name of pose to use in the data (VIO_pose, tag_space_pose...)",
         required=True,
     )
+    parser.add_argument(
+        "--tracker_stride",
+        dest="tracker_stride",
+        help="Only use every Nth line of the tracker data (downsampling while loading, instead of downsample.sh)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--sync_precision_ms",
+        dest="sync_precision_ms",
+        help="Search sync coarse-to-fine down to this precision (milliseconds), instead of a fixed grid of sync candidates",
+        type=float,
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of worker processes for evaluating sync candidates",
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         "--plot",
         dest="plot",
         help="Plot syncs for manual validation of results",
         action='store_true'
     )
+    parser.add_argument(
+        "--calibrate",
+        dest="calibrate",
+        help="Also find the tracker pose in VIO device coordinates, using the --calibration_sync sync",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--calibration_sync",
+        dest="calibration_sync",
+        help="Sync method used for calibration; rotation_diffs compares absolute orientations, so it only works "
+             "if VIO and tracking space orientations are already aligned",
+        choices=sync_methods,
+        default="speed_correlation",
+    )
+    parser.add_argument(
+        "--calibration_max_pairs",
+        dest="calibration_max_pairs",
+        help="Use at most this many (randomly chosen) pose pairs for calibration",
+        type=int,
+    )
     args = parser.parse_args()
-    with open(args.tracker_input, "r") as f:
-        tracker = load_tracker_data(f)
-    with open(args.device_input, "r") as f:
-        vio = load_poses(f, args.pose_name)
-
+    tracker = load_pose_file(args.tracker_input, stride=args.tracker_stride)
+    vio = load_pose_file(args.device_input, args.pose_name)
+
+    # Note: the other methods give syncs relative to the recording starts, speed correlation between the
+    # timestamps; they are the same for inputs that start from 0 (like the outputs of the earlier steps)
+    try:
+        correlation_sync, correlation_syncs, correlations = sync_speed_correlation(
+            vio.t, vio.p, vio.r, tracker.t, tracker.p, tracker.r, return_scores=True
+        )
+    except ValueError as e:
+        # Only this method fails (e.g. too short VIO data), the others are still printed
+        print("speed correlation sync failed:", e)
+        correlation_sync, correlation_syncs, correlations = None, [], []
     syncs = [
-        sync_movement_speeds(vio.t, vio.p, tracker.t, tracker.p),
-        sync_rotation_diffs(vio.t, vio.r, tracker.t, tracker.r),
-        sync_rotation_speeds(vio.t, vio.r, tracker.t, tracker.r),
+        sync_movement_speeds(
+            vio.t, vio.p, tracker.t, tracker.p, precision_ms=args.sync_precision_ms, workers=args.workers
+        ),
+        sync_rotation_diffs(
+            vio.t, vio.r, tracker.t, tracker.r, precision_ms=args.sync_precision_ms, workers=args.workers
+        ),
+        sync_rotation_speeds(vio.t, vio.r, tracker.t, tracker.r, args.sync_precision_ms, args.workers),
+        correlation_sync,
     ]
     print("syncs:", syncs)
 
+    if args.calibrate:
+        from calibrate import calibrate_poses
+
+        calibration_sync = syncs[sync_methods.index(args.calibration_sync)]
+        if calibration_sync is None:
+            parser.error("no {} sync for calibration, choose another --calibration_sync".format(args.calibration_sync))
+        print("calibration sync ({}): {}".format(args.calibration_sync, calibration_sync))
+        X, rotation_residuals, translation_residuals = calibrate_poses(
+            vio, tracker, calibration_sync, max_pairs=args.calibration_max_pairs
+        )
+        print("calibration (tracker pose in VIO device coordinates):")
+        print(X)
+        print("median residuals: rotation {:.4f} rad, translation {:.4f} m".format(
+            np.median(rotation_residuals), np.median(translation_residuals)
+        ))
+
     if args.plot:
 
         import matplotlib.pyplot as plt
@@ -212,7 +632,7 @@ if __name__ == "__main__":
         # TODO: see plot code from align_trajectories.py
         # and plot_device_and_tracker.py
 
-        fig, axs = plt.subplots(4, 1, constrained_layout=True)
+        fig, axs = plt.subplots(5, 1, constrained_layout=True)
 
         def plot(ax, method_name, sync):
             ax.set_title("sync = {:.2f}s".format(sync))
@@ -224,17 +644,28 @@ if __name__ == "__main__":
             'Sync movement speeds',
             'Sync rotation diff',
             'Sync rotation speeds',
+            'Sync speed correlation',
         ]
 
+        # Cross-correlation of speeds comes for every sync candidate
+        axs[0].plot(correlation_syncs, correlations)
+        axs[0].set_title('Speed cross-correlation for syncs')
+        axs[0].set_xlabel('tracker-device time offset (seconds)')
+        axs[0].set_ylabel('correlation')
+
         for ax, sync, method_name in zip(axs[1:], syncs, method_names):
+            if sync is None:
+                continue
             v_tracker = movement_speeds(tracker.t, tracker.p)
             synced_vio_times = vio.t + sync
             v_vio = movement_speeds(synced_vio_times, vio.p)
             print('shapes', vio.t.shape, v_vio.shape)
-            ax.plot(tracker.t[:-2], v_tracker, "-", color="r", label='Tracker')
-            ax.plot(vio.t[:-2], v_vio, "-", color="g", label='VIO device')
+            ax.plot(tracker.t[:-2], v_tracker[0], "-", color="r", label='Tracker')
+            ax.plot(synced_vio_times[:-2], v_vio[0], "-", color="g", label='VIO device')
             plot(ax, method_name, sync)
 
+        plt.show()
+
 
 def test_map_vio_to_tracker_with_sync():
     assert map_vio_to_tracker_with_sync(
@@ -254,7 +685,232 @@ def test_map_vio_to_tracker_with_sync():
     ) == [3, 4, 4]
 
 
+def test_map_vio_to_tracker_with_syncs():
+    def reference_map(t_vio, t_tracker, sync):
+        # Two-pointer walk of the original implementation
+        i_tracker = 0
+        vio_to_tracker = []
+        for t in t_vio:
+            while t_tracker[i_tracker] < t + sync and i_tracker < len(t_tracker) - 1:
+                i_tracker += 1
+            vio_to_tracker.append(i_tracker)
+        return vio_to_tracker
+
+    rng = np.random.default_rng(0)
+    t_vio = np.cumsum(rng.uniform(0.0, 0.05, 200))
+    t_tracker = np.cumsum(rng.choice([0.0, 0.001, 0.01], 3000))  # with duplicate timestamps
+    syncs = np.linspace(-1.0, t_tracker[-1], 37)
+    vio_to_tracker = map_vio_to_tracker_with_syncs(t_vio, t_tracker, syncs)
+    assert vio_to_tracker.shape == (37, 200)
+    for i, sync in enumerate(syncs):
+        assert vio_to_tracker[i].tolist() == reference_map(t_vio, t_tracker, sync)
+
+
 def test_angle_between_rotations():
     assert (
         angle_between_rotations(np.identity(3), np.rot90(np.identity(3))) == math.pi / 2
     )
+
+
+def random_rotations(n, seed=0):
+    # Rotations from normalized random quaternions
+    q = np.random.default_rng(seed).normal(size=(4, n))
+    w, x, y, z = q / np.linalg.norm(q, axis=0)
+    return np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+            [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+            [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+        ]
+    )
+
+
+def test_angles_between_rotations():
+    A = random_rotations(50, seed=1)
+    B = random_rotations(50, seed=2)
+    B[:, :, 0] = A[:, :, 0]  # identical rotations
+    B[:, :, 1] = A[:, :, 1] @ np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    angles = angles_between_rotations(A, B)
+    assert angles[0] == 0.0
+    assert np.isclose(angles[1], math.pi / 2)
+    for i in range(50):
+        assert np.isclose(angles[i], angle_between_rotations(A[:, :, i], B[:, :, i]))
+
+    consecutive = consecutive_rotation_angles(A)
+    assert consecutive.shape == (49,)
+    for i in range(49):
+        assert np.isclose(consecutive[i], angle_between_rotations(A[:, :, i], A[:, :, i + 1]))
+
+
+def test_search_sync():
+    true_sync = 3.14159
+    evaluated = []
+
+    def score(syncs, stride):
+        evaluated.append(len(syncs))
+        return -((syncs - true_sync) ** 2)
+
+    sync, syncs, scores = search_sync(score, 10.0)
+    assert len(syncs) == 100 and abs(sync - true_sync) < 0.1
+
+    evaluated.clear()
+    sync, syncs, scores = search_sync(score, 10.0, precision_ms=0.01, coarse_stride=100)
+    assert abs(sync - true_sync) < 1e-5
+    assert sum(evaluated) < 500
+    assert (np.diff(syncs) >= 0).all()
+
+
+def test_sync_rotation_speeds():
+    # Tracker rotating with varying speed, and VIO seeing the same rotations 2.5 seconds later
+    t_tracker = np.arange(0.0, 20.0, 0.01)
+    t_vio = np.arange(0.0, 10.0, 0.033)
+    true_sync = 2.5
+
+    def rotations(t):
+        angle = np.sin(t) + 0.5 * np.sin(2.7 * t)
+        R = np.zeros((3, 3, len(t)))
+        R[0, 0] = R[1, 1] = np.cos(angle)
+        R[0, 1] = -np.sin(angle)
+        R[1, 0] = np.sin(angle)
+        R[2, 2] = 1.0
+        return R
+
+    R_tracker = rotations(t_tracker)
+    R_vio = rotations(t_vio + true_sync)
+    assert abs(sync_rotation_speeds(t_vio, R_vio, t_tracker, R_tracker) - true_sync) < 0.1
+    sync = sync_rotation_speeds(t_vio, R_vio, t_tracker, R_tracker, precision_ms=1.0)
+    assert abs(sync - true_sync) < 0.02
+
+
+def test_sync_speed_correlation():
+    # Unevenly sampled tracker with duplicate timestamps, VIO seeing the same motion 4.321 seconds later
+    rng = np.random.default_rng(0)
+    t_tracker = np.sort(rng.uniform(0.0, 30.0, 20000))
+    t_tracker[1::7] = t_tracker[0::7][: len(t_tracker[1::7])]
+    t_tracker.sort()
+    t_vio = np.arange(0.0, 15.0, 0.033)
+    true_sync = 4.321
+
+    def positions(t):
+        return np.array([np.sin(1.3 * t), np.cos(0.7 * t) * np.sin(2.1 * t), 0.1 * t])
+
+    R_tracker = np.zeros((3, 3, len(t_tracker)))
+    R_vio = np.zeros((3, 3, len(t_vio)))
+    sync, syncs, correlations = sync_speed_correlation(
+        t_vio, positions(t_vio + true_sync), R_vio, t_tracker, positions(t_tracker), R_tracker,
+        return_scores=True,
+    )
+    assert abs(sync - true_sync) < 0.005
+    assert len(syncs) == len(correlations)
+    assert correlations.max() > 0.99
+
+    # Syncs are between the given timestamps, not relative to the recording starts
+    sync = sync_speed_correlation(
+        t_vio + 100.0, positions(t_vio + true_sync), R_vio, t_tracker, positions(t_tracker), R_tracker
+    )
+    assert abs(sync - (true_sync - 100.0)) < 0.005
+
+    # VIO data longer than tracker data, and too short to correlate
+    for t in [np.arange(0.0, 40.0, 0.033), np.array([0.0, 0.033])]:
+        try:
+            sync_speed_correlation(t, positions(t), np.zeros((3, 3, len(t))), t_tracker, positions(t_tracker), R_tracker)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_sync_rotation_diffs():
+    # VIO device rigidly attached to the tracker (constant relative orientation),
+    # VIO recording starting 3.7 seconds after the tracker recording
+    rng = np.random.default_rng(0)
+    knots = np.cumsum(rng.normal(size=(3, 60)), axis=1)
+    t_tracker = np.arange(0.0, 30.0, 0.01)
+    t_vio = np.arange(0.0, 15.0, 0.033)
+    true_sync = 3.7
+
+    def rotations(t):
+        # Rotations about x, y and z axes with random-walk angles
+        angles = np.array([np.interp(t, np.arange(60.0), k) for k in knots])
+        c, s = np.cos(angles), np.sin(angles)
+        one, zero = np.ones_like(t), np.zeros_like(t)
+        Rx = np.array([[one, zero, zero], [zero, c[0], -s[0]], [zero, s[0], c[0]]])
+        Ry = np.array([[c[1], zero, s[1]], [zero, one, zero], [-s[1], zero, c[1]]])
+        Rz = np.array([[c[2], -s[2], zero], [s[2], c[2], zero], [zero, zero, one]])
+        return np.einsum("ijn,jkn,kln->iln", Rx, Ry, Rz)
+
+    R_tracker = rotations(t_tracker)
+    R_offset = random_rotations(1, seed=3)[:, :, 0]
+    R_vio = np.einsum("ijn,jk->ikn", rotations(t_vio + true_sync), R_offset)
+    assert abs(sync_rotation_diffs(t_vio, R_vio, t_tracker, R_tracker) - true_sync) < 0.1
+    sync = sync_rotation_diffs(t_vio, R_vio, t_tracker, R_tracker, precision_ms=1.0)
+    assert abs(sync - true_sync) < 0.01
+
+
+def test_fit_rigid_transforms():
+    rng = np.random.default_rng(0)
+    A = rng.normal(size=(3, 100))
+    R_true = random_rotations(2, seed=4).transpose(2, 0, 1)
+    t_true = rng.normal(size=(2, 3))
+    s_true = np.array([1.0, 2.5])
+    B = s_true[:, np.newaxis, np.newaxis] * (R_true @ A) + t_true[:, :, np.newaxis]
+    R, t, s, errors = fit_rigid_transforms(A, B, with_scale=True)
+    assert np.allclose(R, R_true) and np.allclose(t, t_true) and np.allclose(s, s_true)
+    assert np.allclose(errors, 0.0, atol=1e-6)
+
+    # Without scale, error matches transforming the points
+    B += rng.normal(scale=0.01, size=B.shape)
+    R, t, s, errors = fit_rigid_transforms(A, B)
+    assert (s == 1.0).all()
+    for c in range(2):
+        residuals = R[c] @ A + t[c][:, np.newaxis] - B[c]
+        assert np.isclose(errors[c], np.sqrt((residuals * residuals).sum(axis=0).mean()))
+
+
+def test_sync_movement_speeds():
+    t_tracker = np.arange(0.0, 30.0, 0.01)
+    t_vio = np.arange(0.0, 15.0, 0.033)
+    true_sync = 6.2
+
+    def positions(t):
+        return np.array([np.sin(1.3 * t), np.cos(0.7 * t) * np.sin(2.1 * t), 0.3 * np.sin(0.2 * t)])
+
+    M_true = np.identity(4)
+    M_true[:3, :3] = random_rotations(1, seed=5)[:, :, 0]
+    M_true[:3, 3] = [1.0, 2.0, -0.5]
+    # VIO positions in its own space, tracker positions in tracking space
+    p_vio = positions(t_vio + true_sync)
+    p_tracker = M_true[:3, :3] @ positions(t_tracker) + M_true[:3, 3:4]
+    sync = sync_movement_speeds(t_vio, p_vio, t_tracker, p_tracker, precision_ms=1.0)
+    assert abs(sync - true_sync) < 0.01
+    M, scale, error = fit_device_to_tracker(t_vio, p_vio, t_tracker, p_tracker, sync)
+    assert np.allclose(M, M_true, atol=0.02)
+    assert error < 0.02
+
+
+def test_parallel_scores():
+    # Parallel evaluation must give exactly the same scores as serial evaluation
+    rng = np.random.default_rng(0)
+    t_tracker = np.cumsum(rng.uniform(0.0, 0.02, 3000))
+    t_vio = np.arange(0.0, t_tracker[-1] / 2, 0.033)
+    arrays = dict(
+        t_vio=t_vio,
+        p_vio=rng.normal(size=(3, len(t_vio))),
+        t_tracker=t_tracker,
+        p_tracker=rng.normal(size=(3, len(t_tracker))),
+    )
+    syncs = np.linspace(0.0, t_tracker[-1] / 2, 101)
+    with ParallelScores(negative_position_errors, arrays, workers=1, with_scale=True) as score:
+        serial = score(syncs, 1)
+    with ParallelScores(negative_position_errors, arrays, workers=3, with_scale=True) as score:
+        parallel = score(syncs, 1)
+        parallel_strided = score(syncs, 4)
+    assert np.array_equal(serial, parallel)
+    assert np.array_equal(negative_position_errors(syncs, 4, with_scale=True, **arrays), parallel_strided)
+
+    R_vio = random_rotations(len(t_vio), seed=1)
+    R_tracker = random_rotations(len(t_tracker), seed=2)
+    for workers in [1, 2]:
+        result = sync_rotation_diffs(t_vio, R_vio, t_tracker, R_tracker, workers=workers, return_scores=True)
+        if workers == 1:
+            expected = result
+        assert result[0] == expected[0] and np.array_equal(result[2], expected[2])
@@ -0,0 +1,350 @@
+import argparse
+import json
+import os
+import numpy as np
+import quaternions
+
+# Synthetic tracker and VIO recordings with known ground truth, for testing and benchmarking the pipeline
+# without SteamVR and a phone.
+#
+# The device moves along a smooth parametric trajectory (sums of sinusoids with incommensurate frequencies,
+# so that no time offset other than the true one matches). With VIO poses V(s), tracker poses are
+# T(s) = Y V(s) X, where X is the tracker pose in VIO device coordinates and Y is the VIO space in tracking space
+# (same as in calibrate.py). Tracker recording starts at s = 0 and VIO recording at s = sync, so after both
+# are rebased to start from 0, t_vio + sync = t_tracker like in sync.py.
+#
+# Outputs (written in chunks, so any duration can be generated in bounded memory):
+#   tracker.jsonl: tracker data in record_tracker_data.py format
+#   vio.jsonl: raw android-viotester data, with sensor, frames and arcore lines
+#   truth.json: sync, X, Y and the generator parameters
+#
+# Note: "colN" fields of the tracker rotation are written like record_tracker_data.py writes them: "colN" is
+# row N of the rotation matrix. poses.py and align_trajectories.py read "colN" as columns, so the loaded tracker
+# rotations are the transposes of the true ones, the same as for real recordings. The truth.json transforms are
+# the true ones (T = Y V X with the untransposed tracker rotations).
+
+CHUNK_SECONDS = 10.0
+GRAVITY = np.array([0.0, -9.81, 0.0])
+
+
+def random_trajectory(rng, n_components=3, position_amplitude=0.5, angle_amplitude=0.8):
+    """Random trajectory parameters: per-axis sums of sinusoids for position and (yaw, pitch, roll) angles"""
+    def sinusoids(amplitude):
+        return {
+            "amplitudes": rng.uniform(0.3, 1.0, (3, n_components)) * amplitude / n_components,
+            "frequencies": rng.uniform(0.03, 0.4, (3, n_components)),
+            "phases": rng.uniform(0.0, 2.0 * np.pi, (3, n_components)),
+        }
+    return {"position": sinusoids(position_amplitude), "angles": sinusoids(angle_amplitude)}
+
+
+def _sinusoid_sums(parameters, s, derivative=0):
+    # sum_k A_k sin(2 pi f_k s + phase_k) and its time derivatives, for all axes at once (3xN)
+    w = 2.0 * np.pi * parameters["frequencies"][:, :, np.newaxis]
+    x = w * s + parameters["phases"][:, :, np.newaxis]
+    A = parameters["amplitudes"][:, :, np.newaxis]
+    if derivative == 0:
+        return (A * np.sin(x)).sum(axis=1)
+    if derivative == 1:
+        return (A * w * np.cos(x)).sum(axis=1)
+    return (-A * w * w * np.sin(x)).sum(axis=1)
+
+
+def euler_rotations(angles):
+    """Rotations Rz(yaw) Ry(pitch) Rx(roll) (3x3xN) for 3xN angles"""
+    (cz, cy, cx), (sz, sy, sx) = np.cos(angles), np.sin(angles)
+    return np.array([
+        [cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx],
+        [sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx],
+        [-sy, cy * sx, cy * cx],
+    ])
+
+
+def rotation_exps(v):
+    """Rotation matrices (3x3xN) of 3xN rotation vectors (axis * angle)"""
+    return quaternions.to_rotation_matrices(quaternions.exp(v.T))
+
+
+def random_pose(rng, max_translation):
+    R = rotation_exps(rng.normal(size=(3, 1)))[:, :, 0]
+    M = np.identity(4)
+    M[:3, :3] = R
+    M[:3, 3] = rng.uniform(-max_translation, max_translation, 3)
+    return M
+
+
+def vio_poses(trajectory, s):
+    """VIO camera poses (3x3xN rotations, 3xN positions) at trajectory times s"""
+    return euler_rotations(_sinusoid_sums(trajectory["angles"], s)), _sinusoid_sums(trajectory["position"], s)
+
+
+def tracker_poses(trajectory, s, X, Y):
+    R_vio, p_vio = vio_poses(trajectory, s)
+    # T = Y V X
+    R = np.einsum("ij,jkn,kl->iln", Y[:3, :3], R_vio, X[:3, :3])
+    p = Y[:3, :3] @ (np.einsum("ijn,j->in", R_vio, X[:3, 3]) + p_vio) + Y[:3, 3:4]
+    return R, p
+
+
+def add_noise(R, p, rng, position_noise, rotation_noise):
+    if rotation_noise > 0.0:
+        R = np.einsum("ijn,jkn->ikn", R, rotation_exps(rng.normal(scale=rotation_noise, size=p.shape)))
+    if position_noise > 0.0:
+        p = p + rng.normal(scale=position_noise, size=p.shape)
+    return R, p
+
+
+def dropout_intervals(rng, t_start, t_end, dropouts_per_minute, dropout_seconds):
+    """Random (start, end) intervals of missing data, none within the first and last second"""
+    n = rng.poisson(dropouts_per_minute * (t_end - t_start) / 60.0)
+    starts = np.sort(rng.uniform(t_start + 1.0, max(t_start + 1.0, t_end - 1.0 - dropout_seconds), n))
+    return np.stack([starts, starts + dropout_seconds], axis=1)
+
+
+def keep_outside(s, intervals):
+    """Mask of times s that are not inside any of the (sorted, start-ordered) intervals"""
+    if len(intervals) == 0:
+        return np.ones(len(s), dtype=bool)
+    i = np.searchsorted(intervals[:, 0], s, side="right") - 1
+    return (i < 0) | (s >= intervals[np.maximum(i, 0), 1])
+
+
+# Note: values are written with '%.9g' (float32 precision, which is what OpenVR gives anyway), since float repr()
+# formatting would take most of the generation time. Timestamps have microsecond precision.
+def tracker_lines(t, R, p, tracker=1):
+    line_format = (
+        '{"time": %%.6f, "tracker": %d, "position": {"x": %%.9g, "y": %%.9g, "z": %%.9g}, '
+        '"rotation": {"col0": [%%.9g, %%.9g, %%.9g], "col1": [%%.9g, %%.9g, %%.9g], "col2": [%%.9g, %%.9g, %%.9g]}}\n'
+        % tracker
+    )
+    # Rows one after another, like pose_json() of record_tracker_data.py writes the "colN" fields
+    values = np.concatenate([t[np.newaxis], p, R.reshape(9, -1)]).T.tolist()
+    return [line_format % tuple(row) for row in values]
+
+
+def arcore_lines(t, R, p):
+    """
+    android-viotester arcore lines for camera poses. The converters (extract_vio_poses.camera_rotations) read
+    the camera position as is, and the camera rotation as the inverse of the orientation quaternion, taking
+    the fields in (x, y, z, w) order as (w, x, y, z); so the quaternion of R^T is written with its w into
+    the "x" field, x into "y" and so on.
+    """
+    q = quaternions.from_rotation_matrices(R.transpose(1, 0, 2))
+    values = np.concatenate([q[:, [3, 0, 1, 2]].T, p, t[np.newaxis]]).T.tolist()
+    return [
+        '{"arcore":{"orientation":{"w":%.9g,"x":%.9g,"y":%.9g,"z":%.9g},'
+        '"position":{"x":%.9g,"y":%.9g,"z":%.9g}},"time":%.6f}\n' % tuple(row)
+        for row in values
+    ]
+
+
+def sensor_lines(t, sensor_type, values):
+    line_format = '{"sensor":{"type":"%s","values":[%%.9g,%%.9g,%%.9g]},"time":%%.6f}\n' % sensor_type
+    return [line_format % tuple(row) for row in np.concatenate([values, t[np.newaxis]]).T.tolist()]
+
+
+def frame_lines(t, numbers, camera_parameters):
+    parameters = json.dumps(camera_parameters, separators=(",", ":"))
+    return [
+        '{"frames":[{"cameraInd":0,"cameraParameters":%s,"number":%d,"time":%.6f}],"number":%d,"time":%.6f}\n'
+        % (parameters, n, time, n, time)
+        for n, time in zip(numbers.tolist(), t.tolist())
+    ]
+
+
+def imu_values(trajectory, s, rng, imu_noise):
+    # Gyroscope from finite differences of the rotation, accelerometer from the analytic acceleration
+    dt = 1e-3
+    R0, _ = vio_poses(trajectory, s)
+    R1, _ = vio_poses(trajectory, s + dt)
+    dR = np.einsum("jin,jkn->ikn", R0, R1)
+    gyroscope = quaternions.log(quaternions.from_rotation_matrices(dR)).T / dt
+    a = _sinusoid_sums(trajectory["position"], s, derivative=2) - GRAVITY[:, np.newaxis]
+    accelerometer = np.einsum("jin,jn->in", R0, a)
+    return (gyroscope + rng.normal(scale=imu_noise, size=gyroscope.shape),
+            accelerometer + rng.normal(scale=imu_noise, size=accelerometer.shape))
+
+
+def generate(
+    output_dir,
+    duration=60.0,
+    sync=2.0,
+    tracker_rate=1000.0,
+    vio_rate=30.0,
+    imu_rate=200.0,
+    position_noise=0.0005,
+    rotation_noise=0.001,
+    vio_position_noise=0.002,
+    vio_rotation_noise=0.002,
+    imu_noise=0.01,
+    duplicate_fraction=0.3,
+    dropouts_per_minute=1.0,
+    dropout_seconds=0.5,
+    tracker_time_origin=1618564605.0,
+    vio_time_origin=989850.0,
+    seed=0,
+):
+    """
+    Generate tracker.jsonl, vio.jsonl and truth.json into output_dir (see top of the file).
+    duration: length of the tracker recording (seconds), VIO recording starts sync seconds later,
+        and ends one second before the tracker recording
+    duplicate_fraction: fraction of tracker samples that are repeated with the same timestamp
+        (like fast OpenVR polling does), with separately drawn noise
+    dropouts_per_minute, dropout_seconds: random gaps in both recordings
+    Returns the truth dictionary.
+    """
+    assert duration > sync + 1.0
+    rng = np.random.default_rng(seed)
+    trajectory = random_trajectory(rng)
+    X = random_pose(rng, 0.1)
+    Y = random_pose(rng, 1.0)
+    vio_duration = duration - sync - 1.0
+    tracker_dropouts = dropout_intervals(rng, 0.0, duration, dropouts_per_minute, dropout_seconds)
+    vio_dropouts = dropout_intervals(rng, sync, sync + vio_duration, dropouts_per_minute, dropout_seconds)
+    camera_parameters = {"focalLengthX": 1448.4, "focalLengthY": 1449.7, "principalPointX": 944.6,
+                         "principalPointY": 536.0}
+
+    os.makedirs(output_dir, exist_ok=True)
+    n_tracker_lines = 0
+    n_arcore_lines = 0
+    with open(os.path.join(output_dir, "tracker.jsonl"), "w") as tracker_file, \
+            open(os.path.join(output_dir, "vio.jsonl"), "w") as vio_file:
+        for chunk_start in np.arange(0.0, duration, CHUNK_SECONDS):
+            chunk_end = min(chunk_start + CHUNK_SECONDS, duration)
+
+            # Tracker samples at s = k / tracker_rate, some duplicated
+            k = np.arange(np.ceil(chunk_start * tracker_rate), np.ceil(chunk_end * tracker_rate))
+            s = k / tracker_rate
+            s = s[keep_outside(s, tracker_dropouts)]
+            counts = np.where(rng.uniform(size=len(s)) < duplicate_fraction, 2, 1)
+            counts[s == 0.0] = 1
+            s = np.repeat(s, counts)
+            R, p = add_noise(*tracker_poses(trajectory, s, X, Y), rng, position_noise, rotation_noise)
+            tracker_file.writelines(tracker_lines(tracker_time_origin + s, R, p))
+            n_tracker_lines += len(s)
+
+            # VIO: arcore poses at frames, frames lines and IMU sensor lines, in time order
+            vio_start, vio_end = max(chunk_start, sync), min(chunk_end, sync + vio_duration)
+            if vio_start >= vio_end:
+                continue
+            k = np.arange(np.ceil((vio_start - sync) * vio_rate), np.ceil((vio_end - sync) * vio_rate))
+            s = sync + k / vio_rate
+            keep = keep_outside(s, vio_dropouts)
+            s_frames, frame_numbers = s[keep], k[keep].astype(int)
+            R, p = add_noise(*vio_poses(trajectory, s_frames), rng, vio_position_noise, vio_rotation_noise)
+            k = np.arange(np.ceil((vio_start - sync) * imu_rate), np.ceil((vio_end - sync) * imu_rate))
+            s_imu = sync + k / imu_rate
+            gyroscope, accelerometer = imu_values(trajectory, s_imu, rng, imu_noise)
+
+            def vio_time(s):
+                return vio_time_origin + s - sync
+
+            lines = (
+                sensor_lines(vio_time(s_imu), "gyroscope", gyroscope)
+                + sensor_lines(vio_time(s_imu), "accelerometer", accelerometer)
+                + frame_lines(vio_time(s_frames), frame_numbers, camera_parameters)
+                + arcore_lines(vio_time(s_frames), R, p)
+            )
+            times = np.concatenate([s_imu, s_imu, s_frames, s_frames])
+            vio_file.writelines([lines[i] for i in np.argsort(times, kind="stable")])
+            n_arcore_lines += len(s_frames)
+
+    truth = {
+        "sync": sync,
+        "tracker_to_device": X.tolist(),
+        "vio_to_tracking": Y.tolist(),
+        "tracker_time_origin": tracker_time_origin,
+        "vio_time_origin": vio_time_origin,
+        "tracker_lines": n_tracker_lines,
+        "arcore_lines": n_arcore_lines,
+        "parameters": {
+            "duration": duration, "tracker_rate": tracker_rate, "vio_rate": vio_rate, "imu_rate": imu_rate,
+            "position_noise": position_noise, "rotation_noise": rotation_noise,
+            "vio_position_noise": vio_position_noise, "vio_rotation_noise": vio_rotation_noise,
+            "imu_noise": imu_noise, "duplicate_fraction": duplicate_fraction,
+            "dropouts_per_minute": dropouts_per_minute, "dropout_seconds": dropout_seconds, "seed": seed,
+        },
+    }
+    with open(os.path.join(output_dir, "truth.json"), "w") as f:
+        json.dump(truth, f, indent=2)
+    return truth
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output_dir", dest="output_dir", help="Output directory", required=True)
+    parser.add_argument("--duration", dest="duration", help="Tracker recording length (seconds)", type=float, default=60.0)
+    parser.add_argument("--sync", dest="sync", help="VIO start time in tracker time (seconds)", type=float, default=2.0)
+    parser.add_argument("--tracker_rate", dest="tracker_rate", help="Tracker samples per second", type=float, default=1000.0)
+    parser.add_argument("--vio_rate", dest="vio_rate", help="VIO frames per second", type=float, default=30.0)
+    parser.add_argument("--imu_rate", dest="imu_rate", help="IMU samples per second", type=float, default=200.0)
+    parser.add_argument("--position_noise", dest="position_noise", help="Tracker position noise (meters)", type=float, default=0.0005)
+    parser.add_argument("--rotation_noise", dest="rotation_noise", help="Tracker rotation noise (radians)", type=float, default=0.001)
+    parser.add_argument("--vio_position_noise", dest="vio_position_noise", help="VIO position noise (meters)", type=float, default=0.002)
+    parser.add_argument("--vio_rotation_noise", dest="vio_rotation_noise", help="VIO rotation noise (radians)", type=float, default=0.002)
+    parser.add_argument("--imu_noise", dest="imu_noise", help="Gyroscope (rad/s) and accelerometer (m/s^2) noise", type=float, default=0.01)
+    parser.add_argument("--duplicate_fraction", dest="duplicate_fraction", help="Fraction of tracker samples repeated with the same timestamp", type=float, default=0.3)
+    parser.add_argument("--dropouts_per_minute", dest="dropouts_per_minute", help="Average number of gaps per minute in both recordings", type=float, default=1.0)
+    parser.add_argument("--dropout_seconds", dest="dropout_seconds", help="Length of the gaps (seconds)", type=float, default=0.5)
+    parser.add_argument("--seed", dest="seed", help="Random seed", type=int, default=0)
+    args = parser.parse_args()
+    truth = generate(
+        args.output_dir,
+        duration=args.duration,
+        sync=args.sync,
+        tracker_rate=args.tracker_rate,
+        vio_rate=args.vio_rate,
+        imu_rate=args.imu_rate,
+        position_noise=args.position_noise,
+        rotation_noise=args.rotation_noise,
+        vio_position_noise=args.vio_position_noise,
+        vio_rotation_noise=args.vio_rotation_noise,
+        imu_noise=args.imu_noise,
+        duplicate_fraction=args.duplicate_fraction,
+        dropouts_per_minute=args.dropouts_per_minute,
+        dropout_seconds=args.dropout_seconds,
+        seed=args.seed,
+    )
+    print("Wrote {} tracker lines and {} VIO poses, sync {}s".format(
+        truth["tracker_lines"], truth["arcore_lines"], truth["sync"]
+    ))
+
+
+def test_generate(tmp_path):
+    from poses import load_tracker_data
+    from sync import sync_movement_speeds
+
+    truth = generate(str(tmp_path), duration=30.0, sync=3.0, tracker_rate=200.0, seed=1)
+    with open(tmp_path / "tracker.jsonl") as f:
+        tracker = load_tracker_data(f)
+    assert len(tracker.t) == truth["tracker_lines"]
+    assert (np.diff(tracker.t) >= 0.0).all() and (np.diff(tracker.t) == 0.0).any()
+    assert np.allclose(np.einsum("jin,jkn->ikn", tracker.r, tracker.r)[:, :, 0], np.identity(3), atol=1e-6)
+    # "colN" fields are matrix rows like in record_tracker_data.py, so rotations load transposed
+    X, Y = np.array(truth["tracker_to_device"]), np.array(truth["vio_to_tracking"])
+    R_true, _ = tracker_poses(random_trajectory(np.random.default_rng(1)), tracker.t[:1] - tracker.t[0], X, Y)
+    assert np.allclose(tracker.r[:, :, 0], R_true[:, :, 0].T, atol=0.01)
+
+    lines = open(tmp_path / "vio.jsonl").readlines()
+    arcore = [json.loads(line) for line in lines if line.startswith('{"arcore"')]
+    assert len(arcore) == truth["arcore_lines"]
+    assert any(line.startswith('{"sensor"') for line in lines) and any(line.startswith('{"frames"') for line in lines)
+    times = [json.loads(line)["time"] for line in lines]
+    assert times == sorted(times)
+
+    # Orientation fields decode to the camera rotation like in vio_poses_to_camera_matrices.py
+    j = arcore[0]["arcore"]
+    w, x, y, z = [j["orientation"][k] for k in "xyzw"]
+    R_view = np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+        [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+        [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+    ])
+    R_vio, _ = vio_poses(random_trajectory(np.random.default_rng(1)), np.array([truth["sync"]]))
+    assert np.allclose(R_view.T, R_vio[:, :, 0], atol=0.01)
+
+    # Rebased to start from 0, positions sync to the known offset
+    t_vio = np.array([a["time"] for a in arcore])
+    p_vio = np.array([[a["arcore"]["position"][k] for k in "xyz"] for a in arcore]).T
+    sync = sync_movement_speeds(t_vio - t_vio[0], p_vio, tracker.t - tracker.t[0], tracker.p)
+    assert abs(sync - truth["sync"]) < 0.05
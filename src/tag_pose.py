@@ -0,0 +1,273 @@
+import argparse
+import itertools
+import json
+import sys
+import numpy as np
+import quaternions
+
+# Tag space poses from the Apriltag corners detected in the VIO frames ('markers', added by
+# input_data_preprocessor), replacing libs/find_tag_space_poses (OpenCV solvePnP one frame at a time).
+# All frames are solved at once: a homography from the tag plane to the (normalized) image is found for every
+# frame, and decomposed into a rotation and translation, which are then refined by a few Gauss-Newton
+# iterations on the pixel reprojection error (like solvePnP's default iterative method does).
+#
+# Output 'tag_space_pose' is the same as from find_tag_space_poses: [R | T] (3x4, list of rows)
+# which transforms tag coordinates into camera coordinates.
+# Like the C++ version, frames without exactly one detected tag are left out. So are degenerate detections
+# (e.g. collinear or repeated corners), which have no unique pose; they get NaN poses from find_tag_space_poses().
+CHUNK_LINES = 8192
+REFINE_ITERATIONS = 10
+# Frames with worse-conditioned homography equations or Jacobians count as degenerate
+MAX_CONDITION_NUMBER = 1e12
+
+
+def tag_corners(tag_side_length):
+    """Tag corners (4x3) in tag coordinates, in the order of the detected markers"""
+    s = tag_side_length / 2.0
+    return np.array([
+        [-s, -s, 0.0],  # bottom-left
+        [s, -s, 0.0],  # bottom-right
+        [s, s, 0.0],  # top-right
+        [-s, s, 0.0],  # top-left
+    ])
+
+
+def project(R, t, X, intrinsics):
+    """Pixel coordinates (Nx4x2) of points X (4x3) for poses R (Nx3x3), t (Nx3), intrinsics (Nx4: fx, fy, cx, cy)"""
+    P = np.einsum("nij,kj->nki", R, X) + t[:, np.newaxis, :]
+    fx, fy, cx, cy = [c[:, np.newaxis] for c in intrinsics.T]
+    return np.stack([fx * P[:, :, 0] / P[:, :, 2] + cx, fy * P[:, :, 1] / P[:, :, 2] + cy], axis=2)
+
+
+def homography_poses(X, y_normalized):
+    """
+    Initial poses (R Nx3x3, t Nx3) from homographies of tag plane points X (4x3, z = 0) to normalized image points
+    (Nx4x2), and which of them are valid; poses of degenerate frames are NaN.
+    """
+    n = len(y_normalized)
+    x, y = y_normalized[:, :, 0], y_normalized[:, :, 1]
+    X0 = np.broadcast_to(X[:, 0], (n, 4))
+    X1 = np.broadcast_to(X[:, 1], (n, 4))
+    ones, zeros = np.ones((n, 4)), np.zeros((n, 4))
+    # Homography with h33 = 1 from the 4 correspondences (8 equations per frame)
+    A = np.concatenate([
+        np.stack([X0, X1, ones, zeros, zeros, zeros, -x * X0, -x * X1], axis=2),
+        np.stack([zeros, zeros, zeros, X0, X1, ones, -y * X0, -y * X1], axis=2),
+    ], axis=1)
+    b = np.concatenate([x, y], axis=1)
+    R = np.full((n, 3, 3), np.nan)
+    t = np.full((n, 3), np.nan)
+    valid = np.isfinite(A).all(axis=(1, 2))
+    valid[valid] = np.linalg.cond(A[valid]) < MAX_CONDITION_NUMBER
+    if not valid.any():
+        return R, t, valid
+    h = np.linalg.solve(A[valid], b[valid][:, :, np.newaxis])[:, :, 0]
+    H = np.concatenate([h, np.ones((len(h), 1))], axis=1).reshape(len(h), 3, 3)
+    # Repeated corners give a (nearly) singular homography, which maps part of the tag onto a line or point
+    singular = np.linalg.cond(H) >= MAX_CONDITION_NUMBER
+
+    # H = scale * [r1 r2 t], with the tag in front of the camera (t_z > 0)
+    scale = (np.linalg.norm(H[:, :, 0], axis=1) + np.linalg.norm(H[:, :, 1], axis=1)) / 2.0
+    scale *= np.sign(H[:, 2, 2])
+    r1 = H[:, :, 0] / scale[:, np.newaxis]
+    r2 = H[:, :, 1] / scale[:, np.newaxis]
+    t[valid] = H[:, :, 2] / scale[:, np.newaxis]
+    # Closest rotation to [r1 r2 r1 x r2]
+    U, _, Vt = np.linalg.svd(np.stack([r1, r2, np.cross(r1, r2)], axis=2))
+    D = np.ones((len(h), 3))
+    D[:, 2] = np.sign(np.linalg.det(U @ Vt))
+    R[valid] = np.einsum("nij,nj,njk->nik", U, D, Vt)
+    valid[np.flatnonzero(valid)[singular]] = False
+    valid &= np.isfinite(t).all(axis=1) & (t[:, 2] > 0.0)
+    R[~valid] = np.nan
+    t[~valid] = np.nan
+    return R, t, valid
+
+
+def refine_poses(R, t, X, y, intrinsics, iterations=REFINE_ITERATIONS):
+    """
+    Gauss-Newton iterations minimizing the pixel reprojection error of all frames at once.
+    Returns R, t and which frames are valid; frames whose Jacobian becomes degenerate get NaN poses.
+    """
+    fx, fy = intrinsics[:, 0:1], intrinsics[:, 1:2]
+    valid = np.ones(len(R), dtype=bool)
+    for _ in range(iterations):
+        RX = np.einsum("nij,kj->nki", R, X)
+        P = RX + t[:, np.newaxis, :]
+        z = P[:, :, 2]
+        residuals = (project(R, t, X, intrinsics) - y).reshape(len(R), 8)
+        # Derivatives of pixel coordinates with respect to camera coordinates P (Nx4x2x3)
+        dp = np.zeros(P.shape[:2] + (2, 3))
+        dp[:, :, 0, 0] = fx / z
+        dp[:, :, 0, 2] = -fx * P[:, :, 0] / (z * z)
+        dp[:, :, 1, 1] = fy / z
+        dp[:, :, 1, 2] = -fy * P[:, :, 1] / (z * z)
+        # P = exp(w) R X + t: dP/dw = -[R X]x, dP/dt = I
+        skew = np.zeros(RX.shape + (3,))
+        skew[:, :, 0, 1], skew[:, :, 0, 2] = RX[:, :, 2], -RX[:, :, 1]
+        skew[:, :, 1, 0], skew[:, :, 1, 2] = -RX[:, :, 2], RX[:, :, 0]
+        skew[:, :, 2, 0], skew[:, :, 2, 1] = RX[:, :, 1], -RX[:, :, 0]
+        J = np.concatenate([np.einsum("nkij,nkjl->nkil", dp, skew), dp], axis=3).reshape(len(R), 8, 6)
+        ok = valid & np.isfinite(J).all(axis=(1, 2)) & np.isfinite(residuals).all(axis=1)
+        ok[ok] = np.linalg.cond(J[ok]) < MAX_CONDITION_NUMBER
+        valid &= ok
+        if not ok.any():
+            break
+        J, residuals = J[ok], residuals[ok]
+        JtJ = np.einsum("nki,nkj->nij", J, J) + 1e-12 * np.identity(6)
+        delta = -np.linalg.solve(JtJ, np.einsum("nki,nk->ni", J, residuals)[:, :, np.newaxis])[:, :, 0]
+        dR = quaternions.to_rotation_matrices(quaternions.exp(delta[:, :3])).transpose(2, 0, 1)
+        R = R.copy()
+        t = t.copy()
+        R[ok] = dR @ R[ok]
+        t[ok] = t[ok] + delta[:, 3:]
+    R[~valid] = np.nan
+    t[~valid] = np.nan
+    return R, t, valid
+
+
+def find_tag_space_poses(corners, intrinsics, tag_side_length, iterations=REFINE_ITERATIONS):
+    """
+    Tag space poses for N frames from detected tag corners (Nx4x2 pixels) and camera intrinsics
+    (Nx4: focal lengths x and y, principal point x and y).
+    Returns R (Nx3x3), t (Nx3) and the RMS reprojection errors (pixels) per frame.
+    Degenerate frames (no unique pose) get NaN poses and errors, instead of failing the other frames.
+    """
+    X = tag_corners(tag_side_length)
+    fx, fy, cx, cy = [c[:, np.newaxis] for c in intrinsics.T]
+    y_normalized = np.stack([(corners[:, :, 0] - cx) / fx, (corners[:, :, 1] - cy) / fy], axis=2)
+    R, t, valid = homography_poses(X, y_normalized)
+    R[valid], t[valid], refined = refine_poses(R[valid], t[valid], X, corners[valid], intrinsics[valid], iterations)
+    valid[valid] = refined
+    errors = np.full(len(R), np.nan)
+    errors[valid] = np.sqrt(
+        ((project(R[valid], t[valid], X, intrinsics[valid]) - corners[valid]) ** 2).sum(axis=2).mean(axis=1)
+    )
+    return R, t, errors
+
+
+def add_tag_space_poses(lines, tag_side_length):
+    """Output lines (with 'tag_space_pose' and 'tag_reprojection_error' added) for the input lines with one tag"""
+    js = [json.loads(line) for line in lines]
+    js = [j for j in js if len(j.get("markers", [])) == 1]
+    if not js:
+        return [], np.zeros(0)
+    corners = np.array([j["markers"][0] for j in js], dtype=float)
+    intrinsics = np.array([[j["cameraIntrinsics"][k] for k in [
+        "focalLengthX", "focalLengthY", "principalPointX", "principalPointY"
+    ]] for j in js])
+    R, t, errors = find_tag_space_poses(corners, intrinsics, tag_side_length)
+    # Degenerate detections are left out
+    valid = np.isfinite(errors)
+    js = [j for j, ok in zip(js, valid) if ok]
+    errors = errors[valid]
+    poses = np.concatenate([R[valid], t[valid][:, :, np.newaxis]], axis=2).tolist()
+    output = []
+    for j, pose, error in zip(js, poses, errors.tolist()):
+        j["tag_space_pose"] = pose
+        j["tag_reprojection_error"] = error
+        output.append(json.dumps(j) + "\n")
+    return output, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        help="Preprocessed VIO data with 'markers' (output of input_data_preprocessor), by default read from stdin",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Output file, by default written to stdout",
+    )
+    parser.add_argument(
+        "-s",
+        "--tag_side_length",
+        dest="tag_side_length",
+        help="Length of the tag's sides in meters in the input images",
+        type=float,
+        required=True,
+    )
+    args = parser.parse_args()
+    input_file = open(args.input, "r") if args.input is not None else sys.stdin
+    output_file = open(args.output, "w") if args.output is not None else sys.stdout
+    all_errors = []
+    with input_file, output_file:
+        lines = iter(input_file)
+        while True:
+            chunk = list(itertools.islice(lines, CHUNK_LINES))
+            if not chunk:
+                break
+            output, errors = add_tag_space_poses(chunk, args.tag_side_length)
+            output_file.writelines(output)
+            all_errors.append(errors)
+    errors = np.concatenate(all_errors) if all_errors else np.zeros(0)
+    if len(errors) > 0:
+        print("Tag space poses for {} frames, reprojection error median {:.3f}px, max {:.3f}px".format(
+            len(errors), np.median(errors), errors.max()
+        ), file=sys.stderr)
+
+
+def test_find_tag_space_poses():
+    # Cameras around a 2.5cm tag, 10-40cm away
+    rng = np.random.default_rng(0)
+    n = 200
+    s = 0.025
+    R = quaternions.to_rotation_matrices(quaternions.exp(rng.normal(scale=0.4, size=(n, 3)))).transpose(2, 0, 1)
+    t = np.stack([rng.uniform(-0.05, 0.05, n), rng.uniform(-0.05, 0.05, n), rng.uniform(0.1, 0.4, n)], axis=1)
+    intrinsics = np.tile([1448.4, 1449.7, 944.6, 536.0], (n, 1))
+    corners = project(R, t, tag_corners(s), intrinsics)
+
+    R_found, t_found, errors = find_tag_space_poses(corners, intrinsics, s)
+    assert np.allclose(R_found, R, atol=1e-6)
+    assert np.allclose(t_found, t, atol=1e-8)
+    assert errors.max() < 1e-6
+
+    # With detection noise, refinement does not make the fit worse than the homography
+    noisy_corners = corners + rng.normal(scale=0.5, size=corners.shape)
+    _, _, errors = find_tag_space_poses(noisy_corners, intrinsics, s)
+    _, _, initial_errors = find_tag_space_poses(noisy_corners, intrinsics, s, iterations=0)
+    assert (errors <= initial_errors + 1e-9).all()
+    assert np.median(errors) < 0.5
+
+
+def test_add_tag_space_poses():
+    from poses import load_poses
+
+    intrinsics = {"focalLengthX": 1000.0, "focalLengthY": 1000.0, "principalPointX": 640.0, "principalPointY": 360.0}
+    R = np.identity(3)[np.newaxis]
+    corners = project(R, np.array([[0.0, 0.0, 0.3]]), tag_corners(0.05), np.array([[1000.0, 1000.0, 640.0, 360.0]]))
+    lines = [
+        json.dumps({"time": 0.0, "cameraIntrinsics": intrinsics, "markers": corners.tolist()}),
+        json.dumps({"time": 0.1, "cameraIntrinsics": intrinsics, "markers": []}),
+        json.dumps({"time": 0.2, "cameraIntrinsics": intrinsics, "markers": corners.tolist() * 2}),
+    ]
+    output, errors = add_tag_space_poses(lines, 0.05)
+    assert len(output) == len(errors) == 1
+    poses = load_poses(output, "tag_space_pose")
+    assert np.allclose(poses.p[:, 0], [0.0, 0.0, 0.3])
+    assert np.allclose(poses.r[:, :, 0], np.identity(3))
+
+
+def test_degenerate_frames():
+    intrinsics = {"focalLengthX": 1000.0, "focalLengthY": 1000.0, "principalPointX": 640.0, "principalPointY": 360.0}
+    corners = project(
+        np.identity(3)[np.newaxis], np.array([[0.0, 0.0, 0.3]]), tag_corners(0.05),
+        np.array([[1000.0, 1000.0, 640.0, 360.0]])
+    )[0].tolist()
+    collinear = [[100.0, 100.0], [200.0, 200.0], [300.0, 300.0], [400.0, 400.0]]
+    repeated = [corners[0], corners[0], corners[2], corners[3]]
+    lines = [
+        json.dumps({"time": 0.1 * i, "cameraIntrinsics": intrinsics, "markers": [markers]})
+        for i, markers in enumerate([corners, collinear, corners, repeated, corners])
+    ]
+    output, errors = add_tag_space_poses(lines, 0.05)
+    assert [json.loads(line)["time"] for line in output] == [0.0, 0.2, 0.4]
+    assert errors.max() < 1e-6
+
+    R, t, errors = find_tag_space_poses(np.array([collinear]), np.array([[1000.0, 1000.0, 640.0, 360.0]]), 0.05)
+    assert np.isnan(R).all() and np.isnan(t).all() and np.isnan(errors).all()